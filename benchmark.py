@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+################################################################################
+# Stage-level benchmark of the bus stop detection on synthetic cities.
+# Generates cities with the given numbers of activity points and routes, runs
+# every stage of the detection on them and writes the run times as JSON, e.g.
+#
+#   python benchmark.py --scales 1000:20 100000:500 --output benchmark.json
+#
+# The benchmark runs offline: the planted bus stops of a city take the place of
+# the bus stops from OSM.
+################################################################################
+
+import argparse
+from collections import OrderedDict
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import clustering
+import detect_bus_stops
+import evaluation
+import peaks
+
+# Center of the synthetic cities (the area of the sample data).
+CITY_CENTER = (39.25, -6.8)
+# Spacing of the street grid the routes run along, in meters.
+STREET_SPACING = 200.0
+# Spacing of the planted bus stops along a route, in meters.
+STOP_SPACING = 500.0
+# Activity points within this distance (along the route) of a planted stop are
+# generated around it.
+STOP_REACH = 40.0
+METERS_PER_DEGREE = 111320.0
+# Modules whose import is measured, and the heavy dependencies reported if
+# importing them loads them. All but shapely are imported by the stages that use
+# them; shapely is always loaded, since routes and bus stops are shapely
+# geometries.
+IMPORTED_MODULES = ['detect_bus_stops', 'incremental', 'detection_service']
+HEAVY_DEPENDENCIES = ['overpass', 'scipy', 'sklearn', 'matplotlib', 'pygeoj', 'shapely']
+
+################################################################################
+# Converts local metric coordinates around CITY_CENTER to WGS84.
+def to_lonlat(x, y):
+    longitudes = CITY_CENTER[0]+np.asarray(x)/(METERS_PER_DEGREE*
+                                               math.cos(math.radians(CITY_CENTER[1])))
+    latitudes = CITY_CENTER[1]+np.asarray(y)/METERS_PER_DEGREE
+    return longitudes, latitudes
+
+################################################################################
+# Returns the vertex coordinates of routes on a street grid: random walks that
+# prefer to go straight on, so that routes share streets like bus lines do.
+def generate_routes(route_count, extent, random):
+    nodes = int(extent/STREET_SPACING)
+    directions = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])
+    routes = []
+    for _ in xrange(route_count):
+        length = random.randint(25, 75)
+        node = random.randint(0, nodes, 2)
+        direction = random.randint(4)
+        vertices = [node.copy()]
+        for _ in xrange(length):
+            if random.rand() > 0.7:
+                direction = (direction+random.choice([1, 3])) % 4
+            following = node+directions[direction]
+            if not ((0 <= following) & (following < nodes)).all():
+                direction = (direction+2) % 4
+                following = node+directions[direction]
+            node = following
+            vertices.append(node.copy())
+        routes.append((np.array(vertices, dtype=float)-nodes/2.0)*STREET_SPACING)
+    return routes
+
+################################################################################
+# Returns the planted stops of the routes: every STOP_SPACING meters along each
+# route, as (route index, distance along the route) arrays and coordinates.
+def plant_stops(routes):
+    route_ids = []
+    positions = []
+    coordinates = []
+    for (i, vertices) in enumerate(routes):
+        length = np.sqrt((np.diff(vertices, axis=0)**2).sum(axis=1)).sum()
+        stop_positions = np.arange(STOP_SPACING/2, length, STOP_SPACING)
+        route_ids.append(np.full(len(stop_positions), i, dtype=np.intp))
+        positions.append(stop_positions)
+        coordinates.append(detect_bus_stops.interpolate_line(vertices, stop_positions))
+    return (np.concatenate(route_ids), np.concatenate(positions),
+            np.concatenate(coordinates).reshape(-1, 2))
+
+################################################################################
+# Returns coordinates and current activities of point_count activity points in
+# consecutive trips. Most trips ride along a route and get on or off at planted
+# stops, where the activity changes from or to in_vehicle; the others walk
+# around anywhere in the city.
+def generate_trips(point_count, routes, stop_positions, extent, random):
+    route_lengths = np.array([np.sqrt((np.diff(v, axis=0)**2).sum(axis=1)).sum()
+                              for v in routes])
+    coordinates = np.zeros((point_count, 2))
+    activities = np.zeros(point_count, dtype=object)
+    start = 0
+    while start < point_count:
+        size = min(random.randint(5, 60), point_count-start)
+        trip = slice(start, start+size)
+        if random.rand() < 0.8:
+            route = random.randint(len(routes))
+            positions = random.uniform(0, route_lengths[route])+ \
+                        np.cumsum(random.uniform(30, 150, size))
+            positions = np.mod(positions, route_lengths[route])
+            stops = np.sort(stop_positions[route])
+            at_stop = np.zeros(size, dtype=bool)
+            if len(stops) > 0:
+                nearest = np.clip(np.searchsorted(stops, positions), 1, len(stops))-1
+                candidates = np.column_stack((stops[nearest],
+                                              stops[np.minimum(nearest+1, len(stops)-1)]))
+                distances = np.abs(candidates-positions[:,np.newaxis])
+                closest = candidates[np.arange(size), distances.argmin(axis=1)]
+                at_stop = distances.min(axis=1) < STOP_REACH
+                positions = np.where(at_stop, closest, positions)
+            points = detect_bus_stops.interpolate_line(routes[route], positions)
+            noise = np.where(at_stop, 12.0, 6.0)[:,np.newaxis]
+            coordinates[trip] = points+random.normal(0, 1, (size, 2))*noise
+            activities[trip] = np.where(at_stop,
+                                        random.choice(['still', 'on_foot'], size, p=[0.6, 0.4]),
+                                        random.choice(['in_vehicle', 'still'], size, p=[0.9, 0.1]))
+        else:
+            origin = random.uniform(-extent/2, extent/2, 2)
+            coordinates[trip] = origin+np.cumsum(random.normal(0, 40, (size, 2)), axis=0)
+            activities[trip] = random.choice(['on_foot', 'still', 'on_bicycle'], size,
+                                             p=[0.5, 0.4, 0.1])
+        start += size
+    return coordinates, activities
+
+################################################################################
+# Writes features to a GeoJSON file one by one, so that large cities need not be
+# held in memory twice.
+def write_feature_collection(filename, features):
+    with open(filename, 'w') as out:
+        out.write('{\n"type": "FeatureCollection",\n"crs": { "type": "name", "properties": '+
+                  '{ "name": "urn:ogc:def:crs:OGC:1.3:CRS84" } },\n"features": [\n')
+        first = True
+        for feature in features:
+            if not first:
+                out.write(',\n')
+            json.dump(feature, out)
+            first = False
+        out.write('\n]\n}\n')
+
+################################################################################
+# Generates a synthetic city in directory: activity_points.geojson and
+# routes.geojson like the sample data, plus planted_stops.geojson with the
+# planted bus stops. Returns the WGS84 coordinates of the planted stops.
+def generate_city(directory, point_count, route_count, seed=0, missing_labels=0.1):
+    random = np.random.RandomState(seed)
+    extent = 2000.0*math.sqrt(route_count)
+    routes = generate_routes(route_count, extent, random)
+    (stop_routes, stop_positions, stop_coordinates) = plant_stops(routes)
+    stop_positions_per_route = [stop_positions[stop_routes == i] for i in xrange(len(routes))]
+    (coordinates, activities) = generate_trips(point_count, routes, stop_positions_per_route,
+                                               extent, random)
+    ############################################################################
+    # Previous activities repeat the current activity of the preceding id, some
+    # labels are missing.
+    previous = np.concatenate(([None], activities[:-1]))
+    current = activities.copy()
+    previous[random.rand(point_count) < missing_labels] = None
+    current[random.rand(point_count) < missing_labels] = None
+    longitudes, latitudes = to_lonlat(coordinates[:,0], coordinates[:,1])
+    def point_features():
+        for i in xrange(point_count):
+            yield {'type': 'Feature',
+                   'properties': {'id': i,
+                                  'timestamp': '2015-11-11T09:03:01+0300',
+                                  'created_at': '2015-11-11 06:03:12',
+                                  'previous_dominating_activity': previous[i],
+                                  'previous_dominating_activity_confidence':
+                                        None if previous[i] is None else 80,
+                                  'current_dominating_activity': current[i],
+                                  'current_dominating_activity_confidence':
+                                        None if current[i] is None else 80,
+                                  'bearing': 0, 'altitude': 0.0, 'speed': 0,
+                                  'accuracy': 20.0, 'feature': 'passive_tracking',
+                                  'route': None},
+                   'geometry': {'type': 'Point',
+                                'coordinates': [longitudes[i], latitudes[i]]}}
+    def route_features():
+        for (i, vertices) in enumerate(routes):
+            route_longitudes, route_latitudes = to_lonlat(vertices[:,0], vertices[:,1])
+            yield {'type': 'Feature', 'properties': {'route_id': i},
+                   'geometry': {'type': 'LineString',
+                                'coordinates': np.column_stack((route_longitudes,
+                                                                route_latitudes)).tolist()}}
+    stop_longitudes, stop_latitudes = to_lonlat(stop_coordinates[:,0], stop_coordinates[:,1])
+    stops = np.column_stack((stop_longitudes, stop_latitudes))
+    def stop_features():
+        for (longitude, latitude) in stops:
+            yield {'type': 'Feature', 'properties': {},
+                   'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]}}
+    write_feature_collection(os.path.join(directory, 'activity_points.geojson'), point_features())
+    write_feature_collection(os.path.join(directory, 'routes.geojson'), route_features())
+    write_feature_collection(os.path.join(directory, 'planted_stops.geojson'), stop_features())
+    return stops.tolist()
+
+################################################################################
+# Runs all detection stages on the city in directory and returns the run time
+# of each stage in seconds, some counts and the evaluation of the clustering 
+# approach against the planted stops (see evaluation.py).
+def run_stages(directory, planted_stops, peak_engine='cwt'):
+    detect_bus_stops.DATA_PATH = os.path.join(directory, '')
+    timings = OrderedDict()
+    def timed(stage, function, *args, **kwargs):
+        start = time.time()
+        result = function(*args, **kwargs)
+        timings[stage] = time.time()-start
+        return result
+    ############################################################################
+    # The files are read, parsed and projected chunk by chunk (see
+    # geojson_stream.py), so the largest cities fit in memory.
+    def load():
+        activity_points = detect_bus_stops.load_activity_points('activity_points.geojson')
+        return (activity_points,
+                detect_bus_stops.load_routes('routes.geojson', activity_points.utm_zone))
+    (activity_points, routes) = timed('streaming', load)
+    utm_zone = activity_points.utm_zone
+    timed('enhancement', detect_bus_stops.enhance_activity_points, activity_points)
+    bus_stops = detect_bus_stops.create_bus_stops(planted_stops, utm_zone)
+    index = timed('index', detect_bus_stops.create_activity_point_index, activity_points)
+    patterns = timed('pattern_extraction',
+                     detect_bus_stops.extract_activity_pattern_around_bus_stops,
+                     bus_stops, activity_points, 150, 1, index)
+    clustered_rows = np.arange(0, len(activity_points)-1)
+    clusters = timed('dbscan', clustering.dbscan, activity_points.coordinates(clustered_rows),
+                     epsilon=300, min_points=2, visualize=False)
+    sequences = timed('traversal_scoring', detect_bus_stops.score_route_steps,
+                      activity_points, routes, 200, 50, index, osm_bus_stops=bus_stops)
+    route_peaks = timed('peak_finding', peaks.find_peaks,
+                        [scores for (steps, scores) in sequences], peak_engine)
+    detected = timed('clustering_approach', detect_bus_stops.detect_bus_stops_clustering_approach,
+                     activity_points, routes, pattern_radius=150, dbscan_eps=300,
+                     dbscan_min_points=2, index=index, bus_stop_patterns=patterns,
+                     visualize=False)
+    timed('writing', detect_bus_stops.write_bus_stops, [stop[0] for stop in detected],
+          [{'activity_points': stop[1]} for stop in detected], utm_zone,
+          'detected_bus_stops.geojson', publish=False)
+    timed('publishing', detect_bus_stops.publish_layer, 'detected_bus_stops.geojson')
+    metrics = timed('evaluation', lambda: evaluation.GroundTruth(
+                        [(stop.geometry.x, stop.geometry.y) for stop in bus_stops]).evaluate(
+                        [(stop[0].x, stop[0].y) for stop in detected]))
+    counts = OrderedDict([('activity_points', len(activity_points)),
+                          ('routes', len(routes)),
+                          ('planted_stops', len(planted_stops)),
+                          ('bus_stop_patterns', len(patterns)),
+                          ('clusters', len(clusters)),
+                          ('steps', int(sum(len(scores) for (steps, scores) in sequences))),
+                          ('peaks', int(sum(len(p) for p in route_peaks))),
+                          ('detected_stops', len(detected))])
+    return timings, counts, metrics
+
+################################################################################
+# Returns the time in seconds (best of repeat runs) a fresh interpreter takes
+# to import module, and the HEAVY_DEPENDENCIES the import loaded.
+def measure_import(module, repeat=3):
+    script = ('import sys, time\n'+
+              'start = time.time()\n'+
+              'import '+module+'\n'+
+              'elapsed = time.time()-start\n'+
+              'print elapsed\n'+
+              'print " ".join(name for name in '+repr(HEAVY_DEPENDENCIES)+
+              ' if name in sys.modules)\n')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in xrange(repeat):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=directory)
+        (elapsed, loaded) = (output.split('\n')+[''])[:2]
+        times.append(float(elapsed))
+    return OrderedDict([('seconds', min(times)), ('heavy_dependencies', loaded.split())])
+
+################################################################################
+# Generates and benchmarks a city for each (points, routes) scale. Returns the
+# results as a JSON serializable dict.
+def run_benchmark(scales, seed=0, work_dir=None, peak_engine='cwt'):
+    results = OrderedDict([('created_at', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                           ('python', sys.version.split()[0]),
+                           ('platform', platform.platform()),
+                           ('numpy', np.__version__),
+                           ('peak_engine', peak_engine),
+                           ('imports', OrderedDict()),
+                           ('runs', [])])
+    for module in IMPORTED_MODULES:
+        results['imports'][module] = measure_import(module)
+        print 'import '+module+': '+('%.3f' % results['imports'][module]['seconds'])+'s'+ \
+              ''.join(', loads '+name for name in results['imports'][module]['heavy_dependencies'])
+    for (point_count, route_count) in scales:
+        directory = tempfile.mkdtemp(prefix='city_', dir=work_dir)
+        try:
+            start = time.time()
+            planted_stops = generate_city(directory, point_count, route_count, seed)
+            generation_time = time.time()-start
+            (timings, counts, metrics) = run_stages(directory, planted_stops, peak_engine)
+        finally:
+            if work_dir is None:
+                shutil.rmtree(directory)
+        results['runs'].append(OrderedDict([('points', point_count),
+                                            ('routes', route_count),
+                                            ('seed', seed),
+                                            ('generation', generation_time),
+                                            ('stages', timings),
+                                            ('counts', counts),
+                                            ('evaluation', metrics)]))
+        print str(point_count)+' points, '+str(route_count)+' routes: '+ \
+              ', '.join(stage+' '+('%.3f' % seconds)+'s' for (stage, seconds) in timings.items())
+    return results
+
+def parse_scale(scale):
+    (points, routes) = scale.split(':')
+    return int(float(points)), int(float(routes))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of the bus stop '+
+                                                 'detection on synthetic cities.')
+    parser.add_argument('--scales', nargs='+', type=parse_scale,
+                        default=[(1000, 20), (10000, 100), (100000, 500)],
+                        help='city sizes as POINTS:ROUTES, e.g. 1e6:2000')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the cities')
+    parser.add_argument('--peak-engine', default='cwt', help='peak engine, see peaks.py')
+    parser.add_argument('--work-dir', default=None,
+                        help='keep the generated cities in this directory')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file to write the results to')
+    arguments = parser.parse_args()
+    results = run_benchmark(arguments.scales, arguments.seed, arguments.work_dir,
+                            arguments.peak_engine)
+    with open(arguments.output, 'w') as out:
+        json.dump(results, out, indent=2)
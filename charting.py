@@ -94,5 +94,74 @@ def add_histogram(activity_points, figure, feature_property, num_bins=20, rows=1
     axes.set_title(feature_property)
           
 
+def add_dbscan_clusters(X, labels, core_samples_mask, figure, epsilon, min_points,
+                        rows=1, columns=1, position=1):
+    axes = figure.add_subplot(rows, columns, position)
+    # Number of clusters in labels, ignoring noise if present.
+    n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
+    # Black removed and is used for noise instead.
+    unique_labels = set(labels)
+    colors = plt.cm.Spectral(np.linspace(0, 1, len(unique_labels)))
+    for k, col in zip(unique_labels, colors):
+        if k == -1:
+            # Black used for noise.
+            col = 'k'
+
+        class_member_mask = (labels == k)
+
+        xy = X[class_member_mask & core_samples_mask]
+        axes.plot(xy[:, 0], xy[:, 1], 'o', markerfacecolor=col,
+                markeredgecolor='k', markersize=14)
+
+        xy = X[class_member_mask & ~core_samples_mask]
+        axes.plot(xy[:, 0], xy[:, 1], 'o', markerfacecolor=col,
+                markeredgecolor='k', markersize=6)
+
+    axes.set_title('Estimated number of clusters: '+str(n_clusters_)+
+                    '\nepsilon='+str(epsilon)+', min. points='+str(min_points))
+
+
+def add_activity_profile(original_points, enhanced_points=None):
+    figure1 = new_figure(title='Activity combinations', size=(20,10))
+    if enhanced_points is not None:
+        add_activity_combination_matrix(original_points, figure1, rows=1, columns=2, position=1, title='Original data')
+        add_activity_combination_matrix(enhanced_points, figure1, rows=1, columns=2, position=2, title='Enhanced data')
+    else:
+        add_activity_combination_matrix(original_points, figure1, rows=1, columns=1, position=1, title='Original data')
+
+    profiles = [('Properties profile\n(Original data)', original_points)]
+    if enhanced_points is not None:
+        profiles.append(('Properties profile\n(Enhanced data)', enhanced_points))
+    for (title, points) in profiles:
+        figure = new_figure(title=title, size=(20,10))
+        add_barchart(points, figure, 'previous_dominating_activity', rows=2, columns=3, position=1)   
+        add_barchart(points, figure, 'current_dominating_activity', rows=2, columns=3, position=2)   
+        add_histogram(points, figure, 'speed', num_bins=20, rows=2, columns=3, position=3)   
+        add_histogram(points, figure, 'previous_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=4)   
+        add_histogram(points, figure, 'current_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=5)   
+        add_histogram(points, figure, 'accuracy', num_bins=20, rows=2, columns=3, position=6)
+
+
 def show_charts():
     plt.show()   
+
+
+def save_charts(filenames):
+    for (number, filename) in zip(plt.get_fignums(), filenames):
+        plt.figure(number).savefig(filename)
+    plt.close('all')
+
+
+################################################################################
+# Render functions for rendering.BackgroundRenderer: they create charts and 
+# save them to image files instead of showing them.
+def render_dbscan_clusters(X, labels, core_samples_mask, epsilon, min_points, title, filename):
+    figure = plt.figure(figsize=(20,10))
+    figure.suptitle(title, fontsize=20)
+    add_dbscan_clusters(X, labels, core_samples_mask, figure, epsilon, min_points)
+    save_charts([filename])
+
+
+def render_activity_profile(original_points, enhanced_points, filenames):
+    add_activity_profile(original_points, enhanced_points)
+    save_charts(filenames)
@@ -1,56 +1,140 @@
 import numpy as np
 
-from sklearn.cluster import DBSCAN
-from sklearn.preprocessing import StandardScaler
+import instrumentation
 
-def dbscan(point_array=None, epsilon=250, min_points=2, visualize=True, vis_title='DBSCAN'):
-    ############################################################################
-    # Standardize points
-    scaler = StandardScaler()
-    X = scaler.fit_transform(point_array)
-    #print X
-    # Little 'dirty hack' to allow epsilon definition in native units. 
+# sklearn and scipy are imported where they are used, so that importing this
+# module stays cheap.
+
+################################################################################
+# Little 'dirty hack' to allow epsilon definition in native units: returns the
+# epsilon in the standardized space of the scaler.
+def scale_epsilon(scaler, epsilon):
     eps_pt = np.array([[0.0,0.0],[0.0,float(epsilon)]])
     scaled_eps_pt = scaler.transform(eps_pt)
-    epsi = scaled_eps_pt[1][1]-scaled_eps_pt[0][1]
+    return scaled_eps_pt[1][1]-scaled_eps_pt[0][1]
+
+################################################################################
+# Radius-neighbour graph of a point set for running DBSCAN with many epsilon and
+# min_points values. Points are standardized like in dbscan() and distances are
+# computed only once, up to max_epsilon. DBSCAN labels for any epsilon up to
+# max_epsilon and any min_points are then derived from the graph alone and are
+# the same as the ones of sklearn's DBSCAN.
+class NeighbourhoodGraph:
+
+    @instrumentation.timed('dbscan_graph')
+    def __init__(self, point_array, max_epsilon):
+        from scipy.spatial import cKDTree
+        from sklearn.preprocessing import StandardScaler
+        self.scaler = StandardScaler()
+        self.X = self.scaler.fit_transform(point_array)
+        self.max_epsilon = max_epsilon
+        pairs = cKDTree(self.X).query_pairs(scale_epsilon(self.scaler, max_epsilon),
+                                            output_type='ndarray')
+        pairs = pairs.reshape(-1, 2)
+        deltas = self.X[pairs[:,0]]-self.X[pairs[:,1]]
+        distances = np.sqrt((deltas**2).sum(axis=1))
+        # Edges sorted by distance, so that the graph of a smaller epsilon is a
+        # prefix of the edge list.
+        order = np.argsort(distances, kind='mergesort')
+        self.edges = pairs[order]
+        self.distances = distances[order]
+        instrumentation.count('dbscan_graph_edges', len(self.edges))
+
+    def __len__(self):
+        return len(self.X)
 
     ############################################################################
-    # Compute DBSCAN
-    db = DBSCAN(eps=epsi, min_samples=min_points).fit(X)
-    core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
-    core_samples_mask[db.core_sample_indices_] = True
-    labels = db.labels_
-    
-    # Number of clusters in labels, ignoring noise if present.
-    n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-    
+    # Returns the DBSCAN labels (-1 for noise) and the core sample mask.
+    def labels(self, epsilon, min_points):
+        if epsilon > self.max_epsilon:
+            raise ValueError('epsilon is larger than the graph\'s max_epsilon!')
+        n = len(self.X)
+        edge_count = np.searchsorted(self.distances, scale_epsilon(self.scaler, epsilon),
+                                     side='right')
+        sources = np.concatenate((self.edges[:edge_count,0], self.edges[:edge_count,1]))
+        targets = np.concatenate((self.edges[:edge_count,1], self.edges[:edge_count,0]))
+        # Neighbourhoods include the point itself.
+        core_samples_mask = np.bincount(sources, minlength=n)+1 >= min_points
+        labels = np.full(n, -1, dtype=np.intp)
+        core_indices = np.where(core_samples_mask)[0]
+        if len(core_indices) == 0:
+            return labels, core_samples_mask
+        ########################################################################
+        # Clusters are the connected components of the core points, numbered in
+        # the order sklearn finds them (by their lowest core point index).
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        core_edges = core_samples_mask[sources] & core_samples_mask[targets]
+        graph = coo_matrix((np.ones(core_edges.sum()),
+                            (sources[core_edges], targets[core_edges])), shape=(n, n))
+        component_count, components = connected_components(graph, directed=False)
+        first_core_index = np.full(component_count, n, dtype=np.intp)
+        np.minimum.at(first_core_index, components[core_indices], core_indices)
+        used_components = np.where(first_core_index < n)[0]
+        component_labels = np.full(component_count, -1, dtype=np.intp)
+        component_labels[used_components[np.argsort(first_core_index[used_components])]] = \
+                                                        np.arange(len(used_components))
+        labels[core_indices] = component_labels[components[core_indices]]
+        ########################################################################
+        # Border points join the first cluster that reaches them, i.e. the one
+        # with the lowest label among their core neighbours.
+        border_edges = ~core_samples_mask[sources] & core_samples_mask[targets]
+        border_labels = np.full(n, n, dtype=np.intp)
+        np.minimum.at(border_labels, sources[border_edges], labels[targets[border_edges]])
+        border_points = border_labels < n
+        labels[border_points] = border_labels[border_points]
+        return labels, core_samples_mask
+
+def dbscan(point_array=None, epsilon=250, min_points=2, visualize=True, vis_title='DBSCAN',
+           graph=None, plot_file=None, standardize=True):
+    with instrumentation.stage('dbscan'):
+        if graph is not None:
+            ####################################################################
+            # Derive DBSCAN from a precomputed neighbourhood graph
+            X = graph.X
+            labels, core_samples_mask = graph.labels(epsilon, min_points)
+        elif not standardize:
+            ####################################################################
+            # Cluster the points as they are, epsilon is a plain distance
+            from sklearn.cluster import DBSCAN
+            X = np.asarray(point_array, dtype=float)
+            db = DBSCAN(eps=epsilon, min_samples=min_points).fit(X)
+            core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
+            core_samples_mask[db.core_sample_indices_] = True
+            labels = db.labels_
+        else:
+            ####################################################################
+            # Standardize points
+            from sklearn.cluster import DBSCAN
+            from sklearn.preprocessing import StandardScaler
+            scaler = StandardScaler()
+            X = scaler.fit_transform(point_array)
+            #print X
+            epsi = scale_epsilon(scaler, epsilon)
+
+            ####################################################################
+            # Compute DBSCAN
+            db = DBSCAN(eps=epsi, min_samples=min_points).fit(X)
+            core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
+            core_samples_mask[db.core_sample_indices_] = True
+            labels = db.labels_
+    if instrumentation.recording():
+        instrumentation.count('dbscan_points', len(labels))
+        instrumentation.count('noise_points', int((labels == -1).sum()))
+
     ############################################################################
-    # Plot result
-    if visualize:
+    # Plot result. With a plot_file, the plot is rendered to that file in a 
+    # background process instead of being shown.
+    if visualize and plot_file is not None:
+        import rendering
+        rendering.render('render_dbscan_clusters', X, labels, core_samples_mask,
+                         epsilon, min_points, vis_title, plot_file)
+    elif visualize:
         import matplotlib.pyplot as plt
+        import charting
         figure = plt.figure(figsize=(20,10))
         figure.suptitle(vis_title, fontsize=20)
-        axes = figure.add_subplot(1, 1, 1)
-        # Black removed and is used for noise instead.
-        unique_labels = set(labels)
-        colors = plt.cm.Spectral(np.linspace(0, 1, len(unique_labels)))
-        for k, col in zip(unique_labels, colors):
-            if k == -1:
-                # Black used for noise.
-                col = 'k'
-        
-            class_member_mask = (labels == k)
-        
-            xy = X[class_member_mask & core_samples_mask]
-            axes.plot(xy[:, 0], xy[:, 1], 'o', markerfacecolor=col,
-                    markeredgecolor='k', markersize=14)
-        
-            xy = X[class_member_mask & ~core_samples_mask]
-            axes.plot(xy[:, 0], xy[:, 1], 'o', markerfacecolor=col,
-                    markeredgecolor='k', markersize=6)
-        
-        axes.set_title('Estimated number of clusters: '+str(n_clusters_)+
-                        '\nepsilon='+str(epsilon)+', min. points='+str(min_points))
+        charting.add_dbscan_clusters(X, labels, core_samples_mask, figure, epsilon, min_points)
         plt.show()
 
     ############################################################################
@@ -60,4 +144,5 @@ def dbscan(point_array=None, epsilon=250, min_points=2, visualize=True, vis_titl
         members = np.where(labels == k)[0]
         if k > -1:
             result[k] = members
+    instrumentation.count('clusters', len(result))
     return result
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+################################################################################
+# On-disk cache of preprocessed datasets. An entry is a directory named by a key
+# (see content_key) holding one .npy file per array and a meta.json with plain
+# values. Arrays are memory-mapped copy-on-write when loaded, so loading reads
+# no data up front and modifying a loaded array never changes the entry.
+# An entry derived from some input files is keyed by their content, so it is
+# never used again once an input changes. Content hashes are remembered by
+# size, modification time and a hash of the first and last SAMPLE_SIZE bytes
+# (see content_hash); only a rewrite within the same modification time that
+# keeps the size and changes neither end of the file goes unnoticed.
+
+# Part of every key; increase it when the layout of the entries changes.
+CACHE_VERSION = 3
+# Read size for hashing.
+CHUNK_SIZE = 1 << 20
+# Bytes at either end of a file that are hashed to check a remembered hash.
+SAMPLE_SIZE = 1 << 16
+
+################################################################################
+# Returns the SHA-1 of a file's content. Hashes are remembered in cache_dir by
+# path, size, modification time and a hash of both ends of the file (see
+# sample_hash), so unchanged files are not read again.
+def content_hash(filename, cache_dir):
+    stat = os.stat(filename)
+    memo_file = os.path.join(cache_dir, 'hashes.json')
+    memo = {}
+    if os.path.exists(memo_file):
+        with open(memo_file) as saved:
+            memo = json.load(saved)
+    path = os.path.abspath(filename)
+    sample = sample_hash(filename, stat.st_size)
+    if path in memo and memo[path][:3] == [stat.st_size, stat.st_mtime, sample]:
+        return memo[path][3]
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as content:
+        for chunk in iter(lambda: content.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+    memo[path] = [stat.st_size, stat.st_mtime, sample, digest.hexdigest()]
+    _write_json(memo_file, memo)
+    return digest.hexdigest()
+
+################################################################################
+# Returns the SHA-1 of the first and last SAMPLE_SIZE bytes of a file of the
+# given size.
+def sample_hash(filename, size):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as content:
+        digest.update(content.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE:
+            content.seek(max(SAMPLE_SIZE, size-SAMPLE_SIZE))
+            digest.update(content.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+################################################################################
+# Returns the key of an entry derived from the given input files and options
+# (plain values).
+def content_key(filenames, cache_dir, options=None):
+    digest = hashlib.sha1(str(CACHE_VERSION))
+    for filename in filenames:
+        digest.update(content_hash(filename, cache_dir))
+    digest.update(json.dumps(options, sort_keys=True))
+    return digest.hexdigest()
+
+################################################################################
+# Returns the arrays (a dict of memory-maps) and the meta data of an entry, or
+# None if there is no such entry.
+def load(key, cache_dir):
+    directory = os.path.join(cache_dir, key)
+    meta_file = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as saved:
+        meta = json.load(saved)
+    arrays = {}
+    for name in meta['arrays']:
+        arrays[name] = np.load(os.path.join(directory, name+'.npy'), mmap_mode='c')
+    return arrays, meta['meta']
+
+################################################################################
+# Saves an entry of arrays (a dict of NumPy arrays) and meta data (a dict of
+# plain values). Older entries with the same sources (e.g. input file names) are
+# removed.
+def save(key, cache_dir, arrays, meta, sources=None):
+    directory = os.path.join(cache_dir, key)
+    # Write to a temporary directory first so that readers never see partial
+    # entries.
+    temporary_directory = directory+'.'+str(os.getpid())+'.tmp'
+    if os.path.isdir(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+    for (name, array) in arrays.items():
+        np.save(os.path.join(temporary_directory, name+'.npy'), np.ascontiguousarray(array))
+    _write_json(os.path.join(temporary_directory, 'meta.json'),
+                {'arrays': sorted(arrays), 'meta': meta, 'sources': sources})
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.rename(temporary_directory, directory)
+    if sources is not None:
+        for other_key in os.listdir(cache_dir):
+            other_meta_file = os.path.join(cache_dir, other_key, 'meta.json')
+            if other_key == key or not os.path.exists(other_meta_file):
+                continue
+            with open(other_meta_file) as saved:
+                if json.load(saved).get('sources') == sources:
+                    shutil.rmtree(os.path.join(cache_dir, other_key))
+
+def _write_json(filename, value):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary_filename = filename+'.'+str(os.getpid())+'.tmp'
+    with open(temporary_filename, 'w') as out:
+        json.dump(value, out)
+    os.rename(temporary_filename, filename)
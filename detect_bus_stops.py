@@ -3,52 +3,164 @@
 # Script to extract bus stops based on activity points and routes.
 ################################################################################
 
-import copy
+import argparse
 from collections import OrderedDict
 from sets import Set
-import pygeoj
-import utm
-import overpass
+import json
+import multiprocessing
+import os
 from  shapely.geometry import Point,LineString,MultiPolygon,MultiLineString,MultiPoint
 from numpy import interp
-from scipy import signal
 import numpy as np
-import charting
 import clustering
+import dataset_cache
+import evaluation
+import geojson_stream
+import instrumentation
+import overpass_cache
+import peaks
+import precompression
+import projection
+import rendering
+import score_raster
+import spatial_index
+import tile_index
+
+# pygeoj is imported where GeoJSON is loaded or written with it, and scipy by
+# the modules that use it when they use it (see clustering, evaluation, peaks
+# and spatial_index), so that importing this module stays cheap. shapely is
+# imported eagerly: routes and bus stops are shapely geometries from the start.
 
 ################################################################################
 # Relative path where the data is located.
 DATA_PATH = 'data/'
 
+################################################################################
+# Stands in for missing text properties of activity points. The byte 0xFF never
+# occurs in UTF-8 encoded text.
+MISSING_TEXT = '\xff'
+
+################################################################################
+# Overpass API settings. Responses are cached on disk per query and reused until
+# they are older than OVERPASS_CACHE_TTL seconds. In offline mode, only cached 
+# responses are used and the network is never touched.
+OVERPASS_ENDPOINT = overpass_cache.DEFAULT_ENDPOINT
+OVERPASS_CACHE_DIR = DATA_PATH+'overpass_cache/'
+OVERPASS_CACHE_TTL = overpass_cache.DEFAULT_TTL
+OVERPASS_OFFLINE = False
+
+################################################################################
+# Chart settings. In headless mode, the detection never imports matplotlib:
+# requested charts (profiling, DBSCAN diagnostics) are rendered to image files in
+# PLOT_PATH by a background process instead of being shown.
+HEADLESS = False
+PLOT_PATH = DATA_PATH+'plots/'
+
+################################################################################
+# Clustering approach settings: minimum similarity of a cluster pattern to a 
+# known bus stop pattern, and maximum distance of a cluster centroid to the 
+# route it is projected on.
+SIMILARITY_THRESHOLD = 0.75
+MAX_PROJECTION_DISTANCE = 500
+
+################################################################################
+# Parameters of the detection approaches that callers like the detection service
+# and the sharded pipeline let users set, with their defaults.
+APPROACH_PARAMETERS = {
+                        'clustering': OrderedDict([('pattern_radius', 150),
+                                                   ('dbscan_eps', 300.0),
+                                                   ('dbscan_min_points', 2)]),
+                        'traversing': OrderedDict([('activity_radius', 200),
+                                                   ('step_length', 50),
+                                                   ('dbscan_eps', 400.0),
+                                                   ('peak_engine', 'cwt')])
+                      }
+
+################################################################################
+# Result server settings: written layers get compressed copies (see 
+# precompression.py) and a spatial index for the tile endpoint (see 
+# tile_index.py) next to them, so the server does not have to build them.
+PRECOMPRESS_LAYERS = True
+INDEX_LAYERS = True
+
+################################################################################
+# Preprocessed datasets (projected activity points and routes, see load_dataset)
+# are cached in DATASET_CACHE_DIR, keyed by the content of the input files.
+DATASET_CACHE_DIR = DATA_PATH+'cache/'
+
+################################################################################
+# Number of features the streaming loaders (see load_activity_points) parse and
+# project at a time.
+READ_CHUNK_SIZE = geojson_stream.CHUNK_SIZE
+
+################################################################################
+# Helpers to expose a column of an ActivityPointStore as an attribute of an
+# ActivityPoint view. Missing numbers are stored as NaN, activities as codes and
+# missing texts as MISSING_TEXT. Numbers of columns loaded with only integers
+# are returned as integers, like they were loaded.
+def _number_property(column):
+    def getter(self):
+        value = getattr(self.store, column)[self.row]
+        if np.isnan(value):
+            return None
+        if column in self.store.integer_columns:
+            return int(value)
+        return float(value)
+    def setter(self, value):
+        getattr(self.store, column)[self.row] = np.nan if value is None else value
+    return property(getter, setter)
+
+def _activity_property(column):
+    def getter(self):
+        return self.store.activity_labels[getattr(self.store, column)[self.row]]
+    def setter(self, value):
+        getattr(self.store, column)[self.row] = self.store.encode_activity(value)
+    return property(getter, setter)
+
+def _text_property(column):
+    def getter(self):
+        value = getattr(self.store, column)[self.row]
+        if value == MISSING_TEXT:
+            return None
+        return value.decode('utf-8')
+    return property(getter)
+
 ################################################################################
 # This class represents an activity point with GeoJSON properties as attributes.
-# Additionally, the original geometry and an UTM projected geometry is stored.
-class ActivityPoint:
-    
-    def __init__(self, feature):
-        self.id = feature.properties['id']
-        self.timestamp = feature.properties['timestamp']
-        self.created_at = feature.properties['created_at']
-        self.previous_dominating_activity = feature.properties[
-                                                'previous_dominating_activity']                                                
-        self.previous_dominating_activity_confidence = feature.properties[
-                                        'previous_dominating_activity_confidence']
-        self.current_dominating_activity = feature.properties[
-                                        'current_dominating_activity']
-        self.current_dominating_activity_confidence = feature.properties[
-                                        'current_dominating_activity_confidence']
-        self.activity_combination = (self.previous_dominating_activity,
-                                     self.current_dominating_activity)
-        self.bearing = feature.properties['bearing']
-        self.altitude = feature.properties['altitude']
-        self.speed = feature.properties['speed']
-        self.accuracy = feature.properties['accuracy']
-        self.feature = feature.properties['feature']
-        self.geojson_geometry = feature.geometry
-        # Project coordinates to UTM for more accurate calculations.
-        utm_coordinates = utm.from_latlon(feature.geometry.coordinates[1], 
-                                          feature.geometry.coordinates[0])
-        self.geometry = Point(utm_coordinates[0], utm_coordinates[1])
+# It is a lightweight view on one row of an ActivityPointStore: attributes are
+# read from and written to the store's columns. The UTM projected geometry is
+# created on access.
+class ActivityPoint(object):
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    id = property(lambda self: int(self.store.ids[self.row]))
+    timestamp = _text_property('timestamp')
+    created_at = _text_property('created_at')
+    feature = _text_property('feature')
+    previous_dominating_activity = _activity_property('previous_dominating_activity')
+    previous_dominating_activity_confidence = _number_property(
+                                        'previous_dominating_activity_confidence')
+    current_dominating_activity = _activity_property('current_dominating_activity')
+    current_dominating_activity_confidence = _number_property(
+                                        'current_dominating_activity_confidence')
+    bearing = _number_property('bearing')
+    altitude = _number_property('altitude')
+    speed = _number_property('speed')
+    accuracy = _number_property('accuracy')
+
+    # The activity combination as loaded, i.e. before any enhancement.
+    @property
+    def activity_combination(self):
+        return (self.store.activity_labels[self.store.original_previous_activity[self.row]],
+                self.store.activity_labels[self.store.original_current_activity[self.row]])
+
+    @property
+    def geometry(self):
+        return Point(self.store.x[self.row], self.store.y[self.row])
 
     def to_geojson_feature(self):
         properties = {
@@ -70,87 +182,411 @@ class ActivityPoint:
                         'feature': self.feature
                      }
         geometry = {
-                    'type': self.geojson_geometry.type, 
-                    'coordinates': self.geojson_geometry.coordinates
+                    'type': 'Point', 
+                    'coordinates': [float(self.store.longitude[self.row]),
+                                    float(self.store.latitude[self.row])]
                    }
+        import pygeoj
         return pygeoj.Feature(obj=None, properties=properties, geometry=geometry)
 
 ################################################################################
-# This class represents a route with route_id and an UTM projected LineString 
-# as attributes.
+# This class represents a route with route_id, an UTM projected LineString and
+# its UTM zone as attributes. Routes with the same vertices are equal; their
+# key is the raw bytes of the projected vertex coordinates. Already projected
+# coordinates (in utm_zone) can be passed in instead of a feature, see 
+# load_dataset.
 class Route:
     
-    def __init__(self, feature):
-        self.route_id = feature.properties['route_id']
-        utm_coordinates = []
-        for c in feature.geometry.coordinates:
-            utm_coordinates.append(utm.from_latlon(c[1],c[0])[:2])  # cut off UTM zone
-        self.geometry = LineString(utm_coordinates)
+    def __init__(self, feature, utm_zone=None, route_id=None, utm_coordinates=None):
+        if utm_coordinates is None:
+            route_id = feature.properties['route_id']
+            coordinates = np.array(feature.geometry.coordinates, dtype=np.float64)
+            x, y, utm_zone = projection.to_utm(coordinates[:,0], coordinates[:,1],
+                                               utm_zone)
+            utm_coordinates = np.column_stack((x, y))
+        self.route_id = route_id
+        self.utm_zone = utm_zone
+        coordinates = np.ascontiguousarray(utm_coordinates, dtype=np.float64)
+        self.geometry = LineString(coordinates)
+        self.key = coordinates.tobytes()
+
+    ############################################################################
+    # Returns the coordinates of route.geometry.interpolate(i*step_length) for 
+    # all steps i at once, as an array with one (x, y) row per step.
+    def step_coordinates(self, step_length):
+        steps = int(self.geometry.length/step_length)
+        return interpolate_line(np.array(self.geometry.coords),
+                                np.arange(steps)*float(step_length))
 
     def __eq__(self, other): 
-        return self.geometry.equals(other.geometry)
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
 
     def __hash__(self):
-        return hash(self.geometry.wkt)
+        return hash(self.key)
+
+################################################################################
+# Returns the points at the given distances along a line given by its vertex
+# coordinates, computed like shapely's LineString.interpolate.
+def interpolate_line(coordinates, positions):
+    deltas = coordinates[1:]-coordinates[:-1]
+    segment_lengths = np.sqrt(deltas[:,0]*deltas[:,0]+deltas[:,1]*deltas[:,1])
+    cumulative_lengths = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+    segments = np.searchsorted(cumulative_lengths[1:], positions, side='right')
+    segments = np.minimum(segments, len(segment_lengths)-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fractions = (positions-cumulative_lengths[segments])/segment_lengths[segments]
+    fractions = np.clip(np.nan_to_num(fractions), 0.0, 1.0)[:,np.newaxis]
+    return coordinates[segments]+fractions*deltas[segments]
 
 ################################################################################
 # This class represents a bus stop and stores an UTM projected point geometry.
+# Already projected coordinates can be passed in, see create_bus_stops.
 class BusStop:
-    def __init__(self, coordinates):
-        utm_coordinates = utm.from_latlon(coordinates[1], coordinates[0])
+    def __init__(self, coordinates, utm_coordinates=None, utm_zone=None):
+        if utm_coordinates is None:
+            x, y, utm_zone = projection.to_utm([coordinates[0]], [coordinates[1]],
+                                               utm_zone)
+            utm_coordinates = (x[0], y[0])
         self.geometry = Point(utm_coordinates[0], utm_coordinates[1])
 
 ################################################################################
-# This class represents an activity pattern. It inherits from dict and has 
-# default values (0) for every previous/current activity combination.    
-class ActivityPattern(dict):
+# This class represents an activity pattern. It stores a value for every 
+# previous/current activity combination in a 5x5 matrix (rows: previous, 
+# columns: current activity, both in the order of activities) with default 
+# values (0) and can be indexed like a dict with (previous, current) tuples.
+class ActivityPattern(object):
     activities = [None, 'still', 'on_foot', 'on_bicycle', 'in_vehicle']
 
-    def __init__(self):
-        dict.__init__(self)
-        for prev_act in self.activities:
-            for curr_act in self.activities:
-                self[(prev_act,curr_act)] = 0
+    def __init__(self, matrix=None):
+        if matrix is None:
+            matrix = np.zeros((len(self.activities), len(self.activities)))
+        self.matrix = np.array(matrix, dtype=np.float64)
+
+    ############################################################################
+    # Returns the pattern of activity combination counts of the given activity
+    # codes (indices into activities).
+    @classmethod
+    def from_codes(cls, previous_codes, current_codes):
+        n = len(cls.activities)
+        previous_codes = np.asarray(previous_codes, dtype=np.intp)
+        current_codes = np.asarray(current_codes, dtype=np.intp)
+        if len(previous_codes) > 0 and max(previous_codes.max(), current_codes.max()) >= n:
+            raise KeyError('Unknown activity in activity combinations!')
+        return cls(np.bincount(previous_codes*n+current_codes, 
+                               minlength=n*n).reshape(n, n))
+
+    def _cell(self, combination):
+        try:
+            return (self.activities.index(combination[0]), 
+                    self.activities.index(combination[1]))
+        except ValueError:
+            raise KeyError(combination)
+
+    def __getitem__(self, combination):
+        return self.matrix[self._cell(combination)]
+
+    def __setitem__(self, combination, value):
+        self.matrix[self._cell(combination)] = value
+
+    def __contains__(self, combination):
+        return (len(combination) == 2 and combination[0] in self.activities and
+                combination[1] in self.activities)
+
+    def __len__(self):
+        return self.matrix.size
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [(prev_act,curr_act) for prev_act in self.activities 
+                                    for curr_act in self.activities]
+
+    def values(self):
+        return self.matrix.ravel().tolist()
+
+    def items(self):
+        return zip(self.keys(), self.values())
 
     def normalize(self):
-        value_sum = 0.0
-        for prev_act in self.activities:
-            for curr_act in self.activities:
-                value_sum += self[(prev_act,curr_act)]        
-        for prev_act in self.activities:
-            for curr_act in self.activities:
-               self[(prev_act,curr_act)] = self[(prev_act,curr_act)] / value_sum
+        self.matrix /= float(self.matrix.sum())
 
     def has_N_combinations_set(self, n):
-        combination_count = 0
-        for prev_act in self.activities:
-            for curr_act in self.activities:
-                if self[(prev_act,curr_act)] > 0:
-                    combination_count += 1
-        return combination_count >= n
+        return np.count_nonzero(self.matrix > 0) >= n
 
     def get_similarity(self, other):
-        distance = 0
-        divisor = 0
-        for prev_act in self.activities:
-            for curr_act in self.activities:
-                if self[(prev_act,curr_act)] != other[(prev_act,curr_act)]:
-                    divisor += 1
-                    distance += abs(self[(prev_act,curr_act)]-other[(prev_act,curr_act)])
-        if divisor > 0:
-            distance /= divisor
-        else: 
-            distance = 0
-        return 1-distance 
+        return get_similarity_matrix([self], [other])[0,0]
 
     def get_overall_similarity(self, other):
-        distance = 0
-        for prev_act in self.activities:
-            for curr_act in self.activities:
-                distance += abs(self[(prev_act,curr_act)]-other[(prev_act,curr_act)])
+        distance = np.add.accumulate(np.abs(self.matrix-other.matrix).ravel())[-1]
         distance /= len(self.activities)**2
         return 1-distance        
 
+################################################################################
+# Returns the matrix of similarities (see ActivityPattern.get_similarity) 
+# between each of the patterns (rows) and each of the other_patterns (columns).
+# The distance of two patterns is averaged over the combinations in which they
+# differ only.
+def get_similarity_matrix(patterns, other_patterns, chunk_size=100000):
+    cells = len(ActivityPattern.activities)**2
+    values = np.array([p.matrix.ravel() for p in patterns]).reshape(-1, cells)
+    other_values = np.array([p.matrix.ravel() for p in other_patterns]).reshape(-1, cells)
+    similarities = np.zeros((len(values), len(other_values)))
+    if len(other_values) == 0:
+        return similarities
+    # Compare chunks of rows to bound the size of the pairwise difference array.
+    rows_per_chunk = max(1, chunk_size//len(other_values))
+    for start in xrange(0, len(values), rows_per_chunk):
+        differences = np.abs(values[start:start+rows_per_chunk,np.newaxis,:]-
+                             other_values[np.newaxis,:,:])
+        divisors = np.count_nonzero(differences, axis=2)
+        # Accumulating sums the cells one after another, like a plain loop.
+        distances = np.add.accumulate(differences, axis=2)[:,:,-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.where(divisors > 0, distances/divisors, 0.0)
+        similarities[start:start+rows_per_chunk] = 1-distances
+    return similarities
+
+################################################################################
+# This class stores activity points column-wise: one NumPy array per property
+# instead of one Python object per point. Rows are sorted by id. Activities are
+# stored as small-int codes indexing activity_labels, which starts with the
+# ActivityPattern activities (code 0 is None). Besides that, the store behaves 
+# like the former dict of ActivityPoint objects keyed by id, with the points 
+# being ActivityPoint views. Columns that are already sorted by id (is_sorted)
+# are used as they are, without copying.
+class ActivityPointStore(object):
+    property_columns = ['bearing', 'altitude', 'speed', 'accuracy',
+                        'previous_dominating_activity_confidence',
+                        'current_dominating_activity_confidence']
+    number_columns = ['x', 'y', 'longitude', 'latitude'] + property_columns
+    activity_columns = ['previous_dominating_activity', 'current_dominating_activity',
+                        'original_previous_activity', 'original_current_activity']
+    text_columns = ['timestamp', 'created_at', 'feature']
+    # Columns changed by enhance_activity_points.
+    enhanced_columns = ['previous_dominating_activity', 'current_dominating_activity',
+                        'previous_dominating_activity_confidence',
+                        'current_dominating_activity_confidence']
+
+    def __init__(self, ids, columns, activity_labels=None, utm_zone=None, is_sorted=False,
+                 integer_columns=()):
+        order = slice(None) if is_sorted else np.argsort(ids, kind='mergesort')
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        for name in self.number_columns:
+            setattr(self, name, np.asarray(columns[name], dtype=np.float64)[order])
+        for name in self.activity_columns:
+            setattr(self, name, np.asarray(columns[name], dtype=np.int8)[order])
+        for name in self.text_columns:
+            setattr(self, name, np.asarray(columns[name], dtype=np.str_)[order])
+        if activity_labels is None:
+            activity_labels = list(ActivityPattern.activities)
+        self.activity_labels = activity_labels
+        self.utm_zone = utm_zone
+        # Property columns whose loaded values were all integers.
+        self.integer_columns = list(integer_columns)
+
+    ############################################################################
+    # Builds the store from GeoJSON features (e.g. as loaded by load_geojson).
+    # All coordinates are projected to UTM at once, in utm_zone if given and 
+    # otherwise in the zone of the first feature.
+    @classmethod
+    def from_features(cls, features, utm_zone=None):
+        return cls.from_feature_chunks([features], utm_zone)
+
+    ############################################################################
+    # Builds the store from chunks (lists) of GeoJSON features, e.g. from 
+    # geojson_stream.iter_feature_chunks. Every chunk is turned into columns and
+    # projected to UTM on its own, so the features of one chunk at a time are
+    # held in memory. All chunks are projected to the zone of the first chunk.
+    @classmethod
+    def from_feature_chunks(cls, chunks, utm_zone=None):
+        chunk_columns = []
+        activity_labels = list(ActivityPattern.activities)
+        float_columns = set()
+        for features in chunks:
+            columns = cls._feature_columns(features, activity_labels, float_columns)
+            # Project coordinates to UTM for more accurate calculations.
+            columns['x'], columns['y'], utm_zone = projection.to_utm(columns['longitude'],
+                                                                     columns['latitude'],
+                                                                     utm_zone)
+            chunk_columns.append(columns)
+        ids = np.concatenate([np.zeros(0, dtype=np.int64)]+
+                             [columns['ids'] for columns in chunk_columns])
+        # Ids are unique within every chunk, see _feature_columns.
+        if len(chunk_columns) > 1 and len(np.unique(ids)) < len(ids):
+            raise GeoJSONError('Duplicate feature id detected!')
+        columns = {}
+        for name in cls.number_columns+cls.activity_columns+cls.text_columns:
+            columns[name] = np.concatenate([np.zeros(0, dtype=np.float64)
+                                                if name in cls.number_columns else
+                                            np.zeros(0, dtype=np.int8)
+                                                if name in cls.activity_columns else
+                                            np.zeros(0, dtype=np.str_)]+
+                                           [chunk[name] for chunk in chunk_columns])
+        return cls(ids, columns, activity_labels, utm_zone,
+                   integer_columns=[name for name in cls.property_columns
+                                    if name not in float_columns])
+
+    ############################################################################
+    # Returns the columns of a list of features as arrays, adding activities
+    # that are not in activity_labels yet and the property columns with values
+    # that are no integers to float_columns.
+    @classmethod
+    def _feature_columns(cls, features, activity_labels, float_columns):
+        ids = []
+        seen_ids = Set([])
+        columns = dict((name, []) for name in (cls.number_columns+
+                                               cls.activity_columns+
+                                               cls.text_columns))
+        for feature in features:
+            properties = feature.properties
+            if properties['id'] is None:
+                raise GeoJSONError('Feature has no id property!')
+            elif properties['id'] in seen_ids:
+                raise GeoJSONError('Duplicate feature id detected!')
+            seen_ids.add(properties['id'])
+            ids.append(properties['id'])
+            longitude, latitude = feature.geometry.coordinates[:2]
+            columns['longitude'].append(longitude)
+            columns['latitude'].append(latitude)
+            for name in cls.property_columns:
+                value = properties[name]
+                if value is not None and not isinstance(value, (int, long)):
+                    float_columns.add(name)
+                columns[name].append(np.nan if value is None else value)
+            for (name, original) in (('previous_dominating_activity', 'original_previous_activity'),
+                                     ('current_dominating_activity', 'original_current_activity')):
+                activity = properties[name]
+                if activity not in activity_labels:
+                    activity_labels.append(activity)
+                columns[name].append(activity_labels.index(activity))
+                columns[original].append(activity_labels.index(activity))
+            for name in cls.text_columns:
+                text = properties[name]
+                columns[name].append(MISSING_TEXT if text is None else text.encode('utf-8'))
+        arrays = {'ids': np.array(ids, dtype=np.int64)}
+        for name in cls.number_columns:
+            if name not in ('x', 'y'):
+                arrays[name] = np.array(columns[name], dtype=np.float64)
+        for name in cls.activity_columns:
+            arrays[name] = np.array(columns[name], dtype=np.int8)
+        for name in cls.text_columns:
+            arrays[name] = np.array(columns[name], dtype=np.str_)
+        return arrays
+
+    ############################################################################
+    # Returns a copy of the store with copies of all columns.
+    def copy(self):
+        return self.take(slice(None))
+
+    ############################################################################
+    # Returns a store of copies of the given rows (in the order of the rows, 
+    # which have to be sorted).
+    def take(self, rows):
+        columns = dict((name, getattr(self, name)[rows].copy()) for name in (self.number_columns+
+                                                                            self.activity_columns+
+                                                                            self.text_columns))
+        return ActivityPointStore(self.ids[rows].copy(), columns, list(self.activity_labels),
+                                  self.utm_zone, is_sorted=True,
+                                  integer_columns=self.integer_columns)
+
+    ############################################################################
+    # Returns the rows of all pairs of points with consecutive ids (id, id+1).
+    def consecutive_rows(self):
+        rows = np.where(self.ids[1:] == self.ids[:-1]+1)[0]
+        return rows, rows+1
+
+    ############################################################################
+    # Returns whether the activities of points with consecutive ids agree: the
+    # current activity of a point is the previous activity of the next point,
+    # unless one of them is missing.
+    def is_consistent(self):
+        (rows, next_rows) = self.consecutive_rows()
+        current = self.current_dominating_activity[rows]
+        following = self.previous_dominating_activity[next_rows]
+        missing = self.encode_activity(None)
+        return not np.any((current != missing) & (following != missing) & (current != following))
+
+    ############################################################################
+    # Fills missing previous activities (and their confidences) from the current
+    # activity of the point with the preceding id and missing current 
+    # activities from the previous activity of the point with the next id.
+    # Returns the numbers of filled previous and current activities.
+    # A label filled in one direction is never the source of a fill in the
+    # other, so both directions are filled from the labels as they were.
+    def fill_activity_gaps(self):
+        (rows, next_rows) = self.consecutive_rows()
+        previous = self.previous_dominating_activity
+        current = self.current_dominating_activity
+        missing = self.encode_activity(None)
+        fill_previous = (previous[next_rows] == missing) & (current[rows] != missing)
+        fill_current = (current[rows] == missing) & (previous[next_rows] != missing)
+        (targets, sources) = (next_rows[fill_previous], rows[fill_previous])
+        previous[targets] = current[sources]
+        self.previous_dominating_activity_confidence[targets] = \
+                                        self.current_dominating_activity_confidence[sources]
+        (targets, sources) = (rows[fill_current], next_rows[fill_current])
+        current[targets] = previous[sources]
+        self.current_dominating_activity_confidence[targets] = \
+                                        self.previous_dominating_activity_confidence[sources]
+        return int(fill_previous.sum()), int(fill_current.sum())
+
+    def encode_activity(self, activity):
+        if activity not in self.activity_labels:
+            self.activity_labels.append(activity)
+        return self.activity_labels.index(activity)
+
+    ############################################################################
+    # Returns the ActivityPattern of activity combination counts of the given
+    # rows.
+    def activity_pattern(self, rows):
+        return ActivityPattern.from_codes(self.previous_dominating_activity[rows],
+                                          self.current_dominating_activity[rows])
+
+    ############################################################################
+    # Returns the (previous, current) activity combination of each given row.
+    def activity_combinations(self, rows):
+        labels = self.activity_labels
+        return [(labels[previous], labels[current]) for (previous, current) in 
+                    zip(self.previous_dominating_activity[rows], 
+                        self.current_dominating_activity[rows])]
+
+    def coordinates(self, rows=slice(None)):
+        return np.column_stack((self.x[rows], self.y[rows]))
+
+    def row_of(self, id):
+        row = np.searchsorted(self.ids, id)
+        if row < len(self.ids) and self.ids[row] == id:
+            return int(row)
+        return None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return self.row_of(id) is not None
+
+    def __getitem__(self, id):
+        row = self.row_of(id)
+        if row is None:
+            raise KeyError(id)
+        return ActivityPoint(self, row)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def values(self):
+        return [ActivityPoint(self, row) for row in xrange(len(self))]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
 ################################################################################
 # Simple custom GeoJSON related exception.                                          
 class GeoJSONError(Exception):
@@ -158,72 +594,189 @@ class GeoJSONError(Exception):
 
 ################################################################################
 # Loads a GeoJSON file.
+@instrumentation.timed('loading')
 def load_geojson(filename):
+    import pygeoj
     geojson = pygeoj.load(filepath=DATA_PATH+filename)
     return geojson
       
         
 ################################################################################
-# Returns a dictionary from GeoJSON features with ids as keys and ActivityPoint
-# objects as values.
-def create_activity_points(features):
-    activity_points = {}
-    for feature in features:
-        if feature.properties['id'] is None:
-            raise GeoJSONError('Feature has no id property!')
-        elif feature.properties['id'] in activity_points:
-            raise GeoJSONError('Duplicate feature id detected!')
-        else:
-            activity_points[feature.properties['id']] = ActivityPoint(feature)
-    return activity_points
+# Returns an ActivityPointStore from GeoJSON features. It can be used like a 
+# dictionary with ids as keys and ActivityPoint objects as values.
+@instrumentation.timed('projection')
+def create_activity_points(features, utm_zone=None):
+    return ActivityPointStore.from_features(features, utm_zone)
 
 ################################################################################
-# Returns a list of Route objects.
-def create_routes(features):
+# Reads the activity points of a GeoJSON or newline-delimited GeoJSON file in
+# DATA_PATH chunk by chunk (see geojson_stream.py) into an ActivityPointStore.
+# Unlike create_activity_points(load_geojson(filename)), the file is never held
+# in memory: besides the store, only chunk_size features are.
+@instrumentation.timed('streaming')
+def load_activity_points(filename, utm_zone=None, chunk_size=None):
+    chunks = geojson_stream.iter_feature_chunks(DATA_PATH+filename,
+                                                chunk_size or READ_CHUNK_SIZE)
+    return ActivityPointStore.from_feature_chunks(chunks, utm_zone)
+
+################################################################################
+# Reads the routes of a GeoJSON or newline-delimited GeoJSON file in DATA_PATH
+# one feature at a time, see create_routes.
+@instrumentation.timed('streaming')
+def load_routes(filename, utm_zone=None):
+    return create_routes(geojson_stream.iter_features(DATA_PATH+filename), utm_zone)
+
+################################################################################
+# Returns a list of Route objects. All routes are projected to the same UTM zone,
+# utm_zone if given and otherwise the zone of the first route.
+@instrumentation.timed('projection')
+def create_routes(features, utm_zone=None):
     routes = []
     for feature in features:
-        routes.append(Route(feature))
+        route = Route(feature, utm_zone)
+        utm_zone = route.utm_zone
+        routes.append(route)
     return routes
+
+################################################################################
+# Returns the activity points (see create_activity_points) and routes (see 
+# create_routes) of the given GeoJSON files in DATA_PATH, preprocessed only once
+# per content of the files: the projected columns of the activity points, the 
+# activity labels filled by enhance_activity_points and the projected route
+# vertices are cached in DATASET_CACHE_DIR (see dataset_cache.py). The routes
+# are projected to the UTM zone of the activity points, so that both are in the
+# same coordinate system even if the data spans several zones. With enhance,
+# the activity points come with filled activity labels.
+def load_dataset(activity_points_file, routes_file, enhance=False):
+    filenames = [DATA_PATH+activity_points_file, DATA_PATH+routes_file]
+    key = dataset_cache.content_key(filenames, DATASET_CACHE_DIR)
+    cached = dataset_cache.load(key, DATASET_CACHE_DIR)
+    if cached is None:
+        activity_points = load_activity_points(activity_points_file)
+        routes = load_routes(routes_file, activity_points.utm_zone)
+        arrays = dict((name, getattr(activity_points, name))
+                        for name in (['ids']+ActivityPointStore.number_columns+
+                                     ActivityPointStore.activity_columns+
+                                     ActivityPointStore.text_columns))
+        enhanced_points = activity_points.copy()
+        enhance_activity_points(enhanced_points)
+        for name in ActivityPointStore.enhanced_columns:
+            arrays['enhanced_'+name] = getattr(enhanced_points, name)
+        arrays['route_vertices'] = np.concatenate([np.array(route.geometry.coords)
+                                                    for route in routes]).reshape(-1, 2)
+        arrays['route_offsets'] = np.cumsum([0]+[len(route.geometry.coords) 
+                                                  for route in routes])
+        meta = {
+                    'activity_labels': enhanced_points.activity_labels,
+                    'integer_columns': activity_points.integer_columns,
+                    'utm_zone': activity_points.utm_zone,
+                    'route_ids': [route.route_id for route in routes],
+                    'route_utm_zone': routes[0].utm_zone if routes else None
+               }
+        dataset_cache.save(key, DATASET_CACHE_DIR, arrays, meta, sources=filenames)
+        cached = dataset_cache.load(key, DATASET_CACHE_DIR)
+    (arrays, meta) = cached
+    with instrumentation.stage('dataset_cache'):
+        columns = dict((name, arrays[name]) for name in (ActivityPointStore.number_columns+
+                                                         ActivityPointStore.activity_columns+
+                                                         ActivityPointStore.text_columns))
+        if enhance:
+            for name in ActivityPointStore.enhanced_columns:
+                columns[name] = arrays['enhanced_'+name]
+        activity_points = ActivityPointStore(arrays['ids'], columns, meta['activity_labels'],
+                                             _utm_zone(meta['utm_zone']), is_sorted=True,
+                                             integer_columns=meta['integer_columns'])
+        offsets = arrays['route_offsets']
+        routes = [Route(None, _utm_zone(meta['route_utm_zone']), route_id, 
+                        arrays['route_vertices'][offsets[i]:offsets[i+1]])
+                  for (i, route_id) in enumerate(meta['route_ids'])]
+    return activity_points, routes
+
+# UTM zones are saved as JSON lists.
+def _utm_zone(saved_zone):
+    if saved_zone is None:
+        return None
+    return (int(saved_zone[0]), str(saved_zone[1]))
+
+################################################################################
+# Returns a list of BusStop objects from (longitude, latitude) coordinates, 
+# projected to UTM at once.
+def create_bus_stops(coordinates, utm_zone=None):
+    coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+    x, y, utm_zone = projection.to_utm(coordinates[:,0], coordinates[:,1], utm_zone)
+    return [BusStop(c, utm_coordinates=(x[i], y[i])) for (i,c) in enumerate(coordinates)]
     
+################################################################################
+# Returns the file (in DATA_PATH) of the performance report of a detection run
+# writing to out_file (see instrumentation.py), None if there is no out_file.
+def report_file(out_file):
+    if out_file is None:
+        return None
+    return DATA_PATH+os.path.splitext(out_file)[0]+'.report.json'
+
+################################################################################
+# Prepares a layer in DATA_PATH for the result server: writes its compressed
+# copies (if PRECOMPRESS_LAYERS) and its tile index (if INDEX_LAYERS), unless
+# they are up to date.
+@instrumentation.timed('publishing')
+def publish_layer(filename):
+    if PRECOMPRESS_LAYERS and not all(precompression.is_fresh(DATA_PATH+filename, encoding)
+                                      for encoding in precompression.available_encodings()):
+        precompression.precompress(DATA_PATH+filename)
+    if INDEX_LAYERS and not tile_index.is_fresh(DATA_PATH+filename):
+        tile_index.build(DATA_PATH+filename)
+
+################################################################################
+# Returns a spatial index over the projected activity point geometries. It only
+# depends on the geometries, so it can be built once per dataset and shared by
+# all detection runs.
+@instrumentation.timed('index')
+def create_activity_point_index(activity_points):
+    return spatial_index.PointIndex(activity_points.coordinates())
+
+################################################################################
+# Returns a spatial index over the segments of all routes for snapping points to
+# their nearest route (see snap_to_routes).
+@instrumentation.timed('route_index')
+def create_route_index(routes):
+    return spatial_index.SegmentIndex([route.geometry.coords for route in routes])
+
+################################################################################
+# Snaps projected points to the nearest point on any route, if it is at most 
+# max_distance away. Returns a list with a shapely Point per point (None if not
+# snapped), the route_id of the route snapped to and the distances.
+@instrumentation.timed('snapping')
+def snap_to_routes(points, routes, route_index=None, max_distance=MAX_PROJECTION_DISTANCE):
+    if route_index is None:
+        route_index = create_route_index(routes)
+    snapped, route_indices, distances = route_index.snap(points, max_distance)
+    snapped_points = []
+    route_ids = []
+    for (coordinates, route_index) in zip(snapped, route_indices):
+        if route_index < 0:
+            snapped_points.append(None)
+            route_ids.append(None)
+        else:
+            snapped_points.append(Point(coordinates))
+            route_ids.append(routes[route_index].route_id)
+    return snapped_points, route_ids, distances
+
 ################################################################################
 # Checks whether previous and current activities are consistent with the ids.
 def check_activity_consistency(activity_points):
-    for (id,point) in activity_points.items():
-        if (point.previous_dominating_activity is not None and
-                id-1 in activity_points and 
-                activity_points[id-1].current_dominating_activity is not None):
-            if (point.previous_dominating_activity != 
-                            activity_points[id-1].current_dominating_activity):
-                return False
-        if (point.current_dominating_activity is not None and 
-                id+1 in activity_points and 
-                activity_points[id+1].previous_dominating_activity is not None):
-            if (point.current_dominating_activity != 
-                            activity_points[id+1].previous_dominating_activity):
-                return False
-    return True
-
-################################################################################
-# Function to fill missing previous and current activities (where possible)   
-def enhance_activity_points(activity_points):
-    if check_activity_consistency(activity_points):
+    return activity_points.is_consistent()
+
+################################################################################
+# Function to fill missing previous and current activities (where possible). 
+# The consistency check can be skipped by passing its result.
+@instrumentation.timed('enhancement')
+def enhance_activity_points(activity_points, consistent=None):
+    if consistent is None:
+        consistent = check_activity_consistency(activity_points)
+    if consistent:
         print 'Trying to fill missing activity labels:'
-        enhanced_previous_dominating_activities = 0
-        enhanced_current_dominating_activities = 0
-    
-        for point in activity_points.values():
-            if point.previous_dominating_activity is None:
-                if (point.id-1 in activity_points and
-                    activity_points[point.id-1].current_dominating_activity is not None):
-                        point.previous_dominating_activity = activity_points[point.id-1].current_dominating_activity
-                        point.previous_dominating_activity_confidence = activity_points[point.id-1].current_dominating_activity_confidence
-                        enhanced_previous_dominating_activities += 1
-            if point.current_dominating_activity is None:
-                if (point.id+1 in activity_points and
-                    activity_points[point.id+1].previous_dominating_activity is not None):
-                        point.current_dominating_activity = activity_points[point.id+1].previous_dominating_activity
-                        point.current_dominating_activity_confidence = activity_points[point.id+1].previous_dominating_activity_confidence
-                        enhanced_current_dominating_activities += 1
+        (enhanced_previous_dominating_activities,
+         enhanced_current_dominating_activities) = activity_points.fill_activity_gaps()
         print 'Added '+str(enhanced_previous_dominating_activities)+' previous_dominating_activities.'
         print 'Added '+str(enhanced_current_dominating_activities)+' current_dominating_activities.'
     else:
@@ -232,107 +785,124 @@ def enhance_activity_points(activity_points):
 
 ################################################################################
 # Creates charts to visually analyze various properties of the given activity
-# points.
+# points. Enhances the activity points if possible.
 def profile_activity_points(activity_points):
     if check_activity_consistency(activity_points):
-        original_points = copy.deepcopy(activity_points.values())
-        enhanced_points = enhance_activity_points(activity_points).values()
-    
-        figure1 = charting.new_figure(title='Activity combinations', size=(20,10))
-        charting.add_activity_combination_matrix(original_points, figure1, rows=1, columns=2, position=1, title='Original data')
-        charting.add_activity_combination_matrix(enhanced_points, figure1, rows=1, columns=2, position=2, title='Enhanced data')
-        
-        figure2 = charting.new_figure(title='Properties profile\n(Original data)', size=(20,10))
-        charting.add_barchart(original_points, figure2, 'previous_dominating_activity', rows=2, columns=3, position=1)   
-        charting.add_barchart(original_points, figure2, 'current_dominating_activity', rows=2, columns=3, position=2)   
-        charting.add_histogram(original_points, figure2, 'speed', num_bins=20, rows=2, columns=3, position=3)   
-        charting.add_histogram(original_points, figure2, 'previous_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=4)   
-        charting.add_histogram(original_points, figure2, 'current_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=5)   
-        charting.add_histogram(original_points, figure2, 'accuracy', num_bins=20, rows=2, columns=3, position=6)   
-    
-        figure3 = charting.new_figure(title='Properties profile\n(Enhanced data)', size=(20,10))
-        charting.add_barchart(enhanced_points, figure3, 'previous_dominating_activity', rows=2, columns=3, position=1)   
-        charting.add_barchart(enhanced_points, figure3, 'current_dominating_activity', rows=2, columns=3, position=2)   
-        charting.add_histogram(enhanced_points, figure3, 'speed', num_bins=20, rows=2, columns=3, position=3)   
-        charting.add_histogram(enhanced_points, figure3, 'previous_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=4)   
-        charting.add_histogram(enhanced_points, figure3, 'current_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=5)   
-        charting.add_histogram(enhanced_points, figure3, 'accuracy', num_bins=20, rows=2, columns=3, position=6)
+        original_points = activity_points.copy().values()
+        enhanced_points = enhance_activity_points(activity_points, consistent=True).values()
+        titles = ['Activity combinations', 'Properties profile (Original data)',
+                  'Properties profile (Enhanced data)']
     else:
-        figure1 = charting.new_figure(title='Activity combinations', size=(20,10))
-        charting.add_activity_combination_matrix(activity_points.values(), figure1, rows=1, columns=1, position=1, title='Original data')
+        original_points = activity_points.values()
+        enhanced_points = None
+        titles = ['Activity combinations', 'Properties profile (Original data)']
 
-        figure2 = charting.new_figure(title='Properties profile\n(Original data)', size=(20,10))
-        charting.add_barchart(activity_points.values(), figure2, 'previous_dominating_activity', rows=2, columns=3, position=1)   
-        charting.add_barchart(activity_points.values(), figure2, 'current_dominating_activity', rows=2, columns=3, position=2)   
-        charting.add_histogram(activity_points.values(), figure2, 'speed', num_bins=20, rows=2, columns=3, position=3)   
-        charting.add_histogram(activity_points.values(), figure2, 'previous_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=4)   
-        charting.add_histogram(activity_points.values(), figure2, 'current_dominating_activity_confidence', num_bins=20, rows=2, columns=3, position=5)   
-        charting.add_histogram(activity_points.values(), figure2, 'accuracy', num_bins=20, rows=2, columns=3, position=6)  
+    if HEADLESS:
+        rendering.render('render_activity_profile', original_points, enhanced_points,
+                         [rendering.image_file(PLOT_PATH, title) for title in titles])
+    else:
+        import charting
+        charting.add_activity_profile(original_points, enhanced_points)
+        charting.show_charts()
 
-    charting.show_charts()
+################################################################################
+# Returns the image file for a DBSCAN diagnostic chart in headless mode (None 
+# otherwise, i.e. the chart is shown). The file is named after the output file
+# of the run, or after all its parameters if it has none, so that runs with 
+# different parameters do not overwrite each other's charts.
+def dbscan_plot_file(title, out_file, **parameters):
+    if not HEADLESS:
+        return None
+    if out_file is not None:
+        return rendering.image_file(PLOT_PATH, title+' '+os.path.splitext(out_file)[0])
+    return rendering.image_file(PLOT_PATH, title+''.join(' '+name+' '+str(value) for (name, value)
+                                                         in sorted(parameters.items())))
 
 ################################################################################
-# Retrieves bus stops from OSM via the Overpass API
-def get_osm_bus_stops(routes):
+# Retrieves bus stops from OSM via the Overpass API (or its cache, see 
+# OVERPASS_* settings above).
+@instrumentation.timed('osm_bus_stops')
+def get_osm_bus_stops(routes, endpoint=None, offline=None):
     ############################################################################
     # Calculate the bounding box around all routes
     lines = []    
     for route in routes:
         lines.append(route.geometry.buffer(100))
     routes_bounds = MultiPolygon(lines).bounds
-    south_west = utm.to_latlon(routes_bounds[0], routes_bounds[1], 37, 'M')
-    north_east = utm.to_latlon(routes_bounds[2], routes_bounds[3], 37, 'M')
-    bounding_box = (south_west[0],south_west[1],north_east[0],north_east[1])
+    longitudes, latitudes = projection.to_lonlat(routes_bounds[0::2], routes_bounds[1::2],
+                                                 routes[0].utm_zone)
+    bounding_box = (float(latitudes[0]),float(longitudes[0]),
+                    float(latitudes[1]),float(longitudes[1]))
+    response, fetched = query_osm_bus_stops(bounding_box, endpoint, offline)
+    ############################################################################
+    # Write bus stops to file (only if they differ from the ones on disk, which
+    # may be of another bounding box even if the response was cached).
+    filename = DATA_PATH+'osm_bus_stops.geojson'
+    written = None
+    if os.path.exists(filename):
+        with open(filename) as layer:
+            try:
+                written = json.load(layer)
+            except ValueError:
+                pass
+    if written != response:
+        with open(filename, 'w') as out:
+            json.dump(response, out)
+    publish_layer('osm_bus_stops.geojson')
+    ############################################################################
+    # Return list of BusStop objects.
+    coordinates = [feature['geometry']['coordinates'] for feature in response['features']]
+    return create_bus_stops(coordinates, routes[0].utm_zone)
+
+################################################################################
+# Returns the OSM bus stops in a bounding box (min latitude, min longitude, max
+# latitude, max longitude) as GeoJSON, and whether the response was fetched
+# from the network (and not from the cache).
+def query_osm_bus_stops(bounding_box, endpoint=None, offline=None):
     ############################################################################
     # Get relevant OSM "nodes". For the sake of simplicity, "ways" are not 
     # considered here. Manual inspection showed that all "ways" in the area also
     # contained at least one "node". Except Ubungo International Bus Terminal,
     # however there is no activity point nearby.
-    osm = overpass.API(endpoint='http://overpass.osm.rambler.ru/cgi/interpreter',
-                       timeout=60)
-    response = osm.Get('(node[amenity=bus_station]'+str(bounding_box)+';'+
-                        'node[highway=bus_stop]'+str(bounding_box)+';);')
-    ############################################################################
-    # Write bus stops to file.
-    with open(DATA_PATH+'osm_bus_stops.geojson', 'w') as out:   
-        out.write(str(response))
-    ############################################################################
-    # Return list of BusStop objects.
-    osm_bus_stops = []
-    for feature in response['features']:
-        osm_bus_stops.append(BusStop(feature['geometry']['coordinates']))
-    return osm_bus_stops
+    if endpoint is None:
+        endpoint = OVERPASS_ENDPOINT
+    if offline is None:
+        offline = OVERPASS_OFFLINE
+    return overpass_cache.get('(node[amenity=bus_station]'+str(bounding_box)+';'+
+                              'node[highway=bus_stop]'+str(bounding_box)+';);',
+                              OVERPASS_CACHE_DIR, endpoint=endpoint, 
+                              ttl=OVERPASS_CACHE_TTL, offline=offline)
 
 ################################################################################
 # Extracts previous/current activity combinations around bus stops.
+@instrumentation.timed('pattern_extraction')
 def extract_activity_combinations_around_bus_stops(bus_stops, activity_points, 
-                                                                    radius=150):
+                                                                    radius=150, index=None):
+    if index is None:
+        index = create_activity_point_index(activity_points)
     activity_combination_counts = {}
     for bus_stop in bus_stops:
-        buffered_bus_stop = bus_stop.geometry.buffer(radius)
-        for point in activity_points.values():
-            if buffered_bus_stop.intersects(point.geometry):
-                activity_tuple = (point.previous_dominating_activity, 
-                                  point.current_dominating_activity)
-                if activity_tuple in activity_combination_counts:
-                    activity_combination_counts[activity_tuple] += 1
-                else:
-                    activity_combination_counts[activity_tuple] = 1
+        rows = index.query_radius(bus_stop.geometry.x, bus_stop.geometry.y, radius)
+        for activity_tuple in activity_points.activity_combinations(rows):
+            if activity_tuple in activity_combination_counts:
+                activity_combination_counts[activity_tuple] += 1
+            else:
+                activity_combination_counts[activity_tuple] = 1
     return OrderedDict(sorted(activity_combination_counts.items(),
                                 key=lambda t: t[1], reverse=True))
 
 ################################################################################
 # Extracts previous/current activity patterns around bus stops.
+@instrumentation.timed('pattern_extraction')
 def extract_activity_pattern_around_bus_stops(bus_stops, activity_points, 
-                                                radius=150, min_combinations=1):
+                                                radius=150, min_combinations=1,
+                                                index=None):
+    if index is None:
+        index = create_activity_point_index(activity_points)
     patterns = []
     for bus_stop in bus_stops:
-        pattern = ActivityPattern()
-        buffered_bus_stop = bus_stop.geometry.buffer(radius)
-        for point in activity_points.values():
-            if buffered_bus_stop.intersects(point.geometry):
-                pattern[(point.previous_dominating_activity, 
-                            point.current_dominating_activity)] += 1
+        rows = index.query_radius(bus_stop.geometry.x, bus_stop.geometry.y, radius)
+        pattern = activity_points.activity_pattern(rows)
         if pattern.has_N_combinations_set(min_combinations):
             pattern.normalize()
             patterns.append(pattern)
@@ -340,20 +910,141 @@ def extract_activity_pattern_around_bus_stops(bus_stops, activity_points,
                     
 
 ################################################################################
-# Bus stop detection algorithm based on route traversing, data-driven activity
-# combinations, common sense activity combinations and local maxima detection.                
-def detect_bus_stops_traversing_approach(activity_points, routes, activity_radius=200, 
-                                            step_length=50, dbscan_eps=400, out_file=None):
-    ############################################################################
-    # Get bus stop locations from OSM
-    osm_bus_stops = get_osm_bus_stops(routes)
-    ############################################################################
-    # Extract activity combinations around bus stops
-    data_driven_activity_combinations = extract_activity_combinations_around_bus_stops(osm_bus_stops, 
-                                                                                       activity_points, 
-                                                                                       radius=activity_radius)
-    ############################################################################
-    # Give each combination a score
+# Writes detected bus stops (projected shapely points in utm_zone) with the
+# given properties to a GeoJSON file in DATA_PATH and publishes it (see
+# publish_layer) unless publish is False.
+def write_bus_stops(points, properties, utm_zone, out_file, publish=True):
+    import pygeoj
+    with instrumentation.stage('writing'):
+        geojson = pygeoj.new()
+        geojson.define_crs(type='name', name='urn:ogc:def:crs:OGC:1.3:CRS84')
+        longitudes, latitudes = projection.to_lonlat([point.x for point in points],
+                                                     [point.y for point in points],
+                                                     utm_zone)
+        for (i,point) in enumerate(points):
+            feature = pygeoj.Feature(obj=None, properties=properties[i], 
+                                     geometry={'type': point.type,
+                                               'coordinates': (longitudes[i],latitudes[i])})
+            if feature.validate():
+                geojson.add_feature(feature)
+            else:
+                raise GeoJSONError('Feature not valid!')  
+        geojson.save(DATA_PATH+out_file)
+    if publish:
+        publish_layer(out_file)
+    instrumentation.count('bus_stops', len(points))
+
+################################################################################
+# Returns the traversal score of every step in step_coordinates. Each activity
+# point within activity_radius of a step adds its weight (see 
+# detect_bus_stops_traversing_approach), scaled by a distance ramp from 1.2 at
+# the step to 0.8 at activity_radius. All steps are scored at once.
+def score_steps(step_coordinates, index, weights, activity_radius):
+    step_coordinates = np.asarray(step_coordinates, dtype=float).reshape(-1, 2)
+    neighbours = index.query_radius_many(step_coordinates, activity_radius)
+    if len(neighbours) == 0:
+        return np.zeros(0)
+    step_ids = np.repeat(np.arange(len(neighbours)), [len(n) for n in neighbours])
+    point_ids = np.concatenate(neighbours).astype(int)
+    relevant = weights[point_ids] > 0
+    step_ids = step_ids[relevant]
+    point_ids = point_ids[relevant]
+    deltas = step_coordinates[step_ids]-index.coordinates[point_ids]
+    distances = np.sqrt(deltas[:,0]*deltas[:,0]+deltas[:,1]*deltas[:,1])
+    point_scores = weights[point_ids]*interp(distances, [0,activity_radius], [1.2,0.8])
+    # bincount accumulates in point order, like the step-by-step loop does.
+    return np.bincount(step_ids, weights=point_scores, minlength=len(step_coordinates))
+
+################################################################################
+# Splits routes into corridors: maximal runs of consecutive route segments that
+# are shared by the same set of routes (in either direction). Returns a dict of
+# corridor coordinates by corridor key and, for every route, the list of
+# (corridor key, reversed) it runs along. Corridors are stored in a canonical
+# direction, so routes running along the same stretch of road share its key.
+def split_routes_into_corridors(routes):
+    route_coordinates = [np.array(route.geometry.coords) for route in routes]
+    route_segments = []
+    segment_routes = {}
+    for (i, coordinates) in enumerate(route_coordinates):
+        vertices = [vertex.tobytes() for vertex in coordinates]
+        segments = [(a, b) if a <= b else (b, a) for (a, b) in zip(vertices[:-1], vertices[1:])]
+        for segment in segments:
+            segment_routes.setdefault(segment, Set([])).add(i)
+        route_segments.append(segments)
+    corridors = {}
+    route_corridors = []
+    for (coordinates, segments) in zip(route_coordinates, route_segments):
+        run_starts = [j for j in xrange(len(segments))
+                        if j == 0 or segment_routes[segments[j]] != segment_routes[segments[j-1]]]
+        route_corridors.append([])
+        for (start, end) in zip(run_starts, run_starts[1:]+[len(segments)]):
+            corridor = coordinates[start:end+1]
+            (forward, backward) = (corridor.tobytes(), corridor[::-1].tobytes())
+            if forward <= backward:
+                corridors.setdefault(forward, corridor)
+                route_corridors[-1].append((forward, False))
+            else:
+                corridors.setdefault(backward, np.ascontiguousarray(corridor[::-1]))
+                route_corridors[-1].append((backward, True))
+    return corridors, route_corridors
+
+################################################################################
+# Scores steps of step_length along every corridor of the routes only once (see
+# split_routes_into_corridors) with score_function, which maps an array of step
+# coordinates to their scores (e.g. score_steps), and returns the step coordinates
+# and scores of each route, pieced together from its corridors.
+def score_route_corridors(routes, step_length, score_function):
+    corridors, route_corridors = split_routes_into_corridors(routes)
+    keys = corridors.keys()
+    corridor_steps = []
+    for key in keys:
+        coordinates = corridors[key]
+        deltas = coordinates[1:]-coordinates[:-1]
+        length = np.sqrt(deltas[:,0]*deltas[:,0]+deltas[:,1]*deltas[:,1]).sum()
+        steps = int(np.ceil(length/step_length))
+        corridor_steps.append(interpolate_line(coordinates, np.arange(steps)*float(step_length)))
+    step_counts = [len(steps) for steps in corridor_steps]
+    all_scores = score_function(np.concatenate(corridor_steps+[np.zeros((0, 2))]))
+    offsets = np.concatenate(([0], np.cumsum(step_counts)))
+    scored = {}
+    for (i, key) in enumerate(keys):
+        scored[key] = (corridor_steps[i], all_scores[offsets[i]:offsets[i+1]])
+    results = []
+    for corridor_list in route_corridors:
+        step_parts = [np.zeros((0, 2))]
+        score_parts = [np.zeros(0)]
+        for (key, reverse) in corridor_list:
+            (steps, scores) = scored[key]
+            step_parts.append(steps[::-1] if reverse else steps)
+            score_parts.append(scores[::-1] if reverse else scores)
+        results.append((np.concatenate(step_parts), np.concatenate(score_parts)))
+    return results
+
+################################################################################
+# Returns a ScoreRaster (see score_raster.py) of the traversal scores around the
+# routes. If filename is given and holds a raster of the same activity points,
+# weights, activity radius and cell size, that raster is reused; otherwise the
+# new raster is saved there.
+@instrumentation.timed('score_raster')
+def create_score_raster(routes, index, weights, activity_radius, cell_size=10.0,
+                        filename=None):
+    def score_function(step_coordinates):
+        return score_steps(step_coordinates, index, weights, activity_radius)
+    raster = score_raster.ScoreRaster(score_function,
+                                      score_raster.fingerprint(index.coordinates, weights,
+                                                               activity_radius),
+                                      cell_size)
+    if filename is None or not raster.load(filename):
+        raster.cover_lines([route.geometry.coords for route in routes])
+        if filename is not None:
+            raster.save(filename)
+    return raster
+
+################################################################################
+# Returns the scores of the common sense activity combinations and of the given
+# data-driven activity combinations (see 
+# extract_activity_combinations_around_bus_stops) as two dicts.
+def activity_combination_scores(data_driven_activity_combinations):
     data_driven_activity_combinations_scores = {}
     for (combination,count) in data_driven_activity_combinations.items():
         score = 1.0
@@ -368,47 +1059,187 @@ def detect_bus_stops_traversing_approach(activity_points, routes, activity_radiu
                                                 ('on_foot','in_vehicle'): 1,
                                                 ('on_bicycle','in_vehicle'): 1                                          
                                                }
+    return interesting_activity_combinations_scores, data_driven_activity_combinations_scores
+
+################################################################################
+# Returns the score weight of every activity point by its (previous, current)
+# activity combination, see activity_combination_scores.
+def activity_point_weights(activity_points, interesting_activity_combinations_scores,
+                           data_driven_activity_combinations_scores):
+    # Score of each (previous, current) activity code pair, looked up for all
+    # points at once.
+    labels = activity_points.activity_labels
+    weight_table = np.zeros((len(labels), len(labels)))
+    for (i,previous) in enumerate(labels):
+        for (j,current) in enumerate(labels):
+            if (previous,current) in interesting_activity_combinations_scores:
+                weight_table[i,j] = interesting_activity_combinations_scores[(previous,current)]
+            elif (previous,current) in data_driven_activity_combinations_scores:
+                weight_table[i,j] = data_driven_activity_combinations_scores[(previous,current)]
+    return weight_table[activity_points.original_previous_activity,
+                        activity_points.original_current_activity]
+
+################################################################################
+# Traverses the unique routes in steps of step_length and scores each step by
+# the activity points around it (see detect_bus_stops_traversing_approach for
+# the options). Returns a (step coordinates, scores) tuple of arrays per unique
+# route.
+@instrumentation.timed('traversal_scoring')
+def score_route_steps(activity_points, routes, activity_radius=200, step_length=50,
+                      index=None, batched_scoring=True, osm_bus_stops=None,
+                      shared_corridors=False, raster_cell_size=None, raster_file=None,
+                      bus_stop_combinations=None):
+    if osm_bus_stops is None and bus_stop_combinations is None:
+        osm_bus_stops = get_osm_bus_stops(routes)
+    if index is None:
+        index = create_activity_point_index(activity_points)
+    ############################################################################
+    # Extract activity combinations around bus stops
+    data_driven_activity_combinations = bus_stop_combinations
+    if data_driven_activity_combinations is None:
+        data_driven_activity_combinations = extract_activity_combinations_around_bus_stops(osm_bus_stops, 
+                                                                                           activity_points, 
+                                                                                           radius=activity_radius,
+                                                                                           index=index)
+    ############################################################################
+    # Give each combination a score
+    (interesting_activity_combinations_scores,
+     data_driven_activity_combinations_scores) = activity_combination_scores(
+                                                    data_driven_activity_combinations)
+    use_raster = raster_cell_size is not None
+    if batched_scoring or shared_corridors or use_raster:
+        point_weights = activity_point_weights(activity_points,
+                                               interesting_activity_combinations_scores,
+                                               data_driven_activity_combinations_scores)
+    ############################################################################
+    # Steps are scored by neighbour searches or, with a raster_cell_size, by
+    # sampling a score raster, which is reused from and saved to raster_file
+    # (relative to DATA_PATH) if given.
+    if use_raster:
+        raster = create_score_raster(routes, index, point_weights, activity_radius,
+                                     raster_cell_size,
+                                     None if raster_file is None else DATA_PATH+raster_file)
+        score_function = raster.sample
+    else:
+        score_function = lambda step_coordinates: score_steps(step_coordinates, index,
+                                                              point_weights, activity_radius)
     ############################################################################
-    # Generate step points for each unique route and calculated a score for each step
+    # Generate step points for each unique route and calculated a score for each step.
+    # With shared_corridors, stretches of road that several routes run along 
+    # are stepped and scored only once for all of them.
     unique_routes = Set([])
     for route in routes:
         unique_routes.add(route)
+    if shared_corridors:
+        unique_routes = list(unique_routes)
+        corridor_scores = score_route_corridors(unique_routes, step_length, score_function)
+
+    sequences = []
+    for (r, route) in enumerate(unique_routes):
+        if shared_corridors:
+            (step_sequence, score_sequence) = corridor_scores[r]
+        elif batched_scoring or use_raster:
+            step_sequence = route.step_coordinates(step_length)
+            score_sequence = score_function(step_sequence)
+        else:
+            score_sequence = []
+            step_sequence = []
+            steps = int(route.geometry.length/step_length)
+            for i in xrange(0,steps):
+                step = route.geometry.interpolate(i*step_length)
+                buffered_step = step.buffer(activity_radius)
+                instrumentation.count('intersection_tests', len(activity_points))
+                score = 0
+                for activity_point in activity_points.values():
+                    if buffered_step.intersects(activity_point.geometry):
+                        distance = step.distance(activity_point.geometry)
+                        if activity_point.activity_combination in interesting_activity_combinations_scores:
+                            score += interesting_activity_combinations_scores[activity_point.activity_combination]*interp(distance, [0,activity_radius], [1.2,0.8])
+                        elif activity_point.activity_combination in data_driven_activity_combinations_scores:
+                            score += data_driven_activity_combinations_scores[activity_point.activity_combination]*interp(distance, [0,activity_radius], [1.2,0.8])
+                score_sequence.append(score)
+                step_sequence.append((step.x, step.y))
+        sequences.append((np.asarray(step_sequence, dtype=float).reshape(-1, 2),
+                          np.asarray(score_sequence, dtype=float)))
+        instrumentation.count('steps', len(score_sequence))
+    # Keep nodes computed on demand for the next run.
+    if use_raster and raster_file is not None and raster.modified:
+        raster.save(DATA_PATH+raster_file)
+    return sequences
+
+################################################################################
+# Bus stop detection algorithm based on route traversing, data-driven activity
+# combinations, common sense activity combinations and local maxima detection.
+# Local maxima are found by peak_engine with peak_options (see peaks.py). The
+# activity combinations around the OSM bus stops can be passed in as
+# bus_stop_combinations (see extract_activity_combinations_around_bus_stops).
+# Returns the detected bus stops as (centroid, average score) tuples.
+@instrumentation.instrumented('traversing_approach',
+                              report_file=lambda arguments: report_file(arguments['out_file']))
+def detect_bus_stops_traversing_approach(activity_points, routes, activity_radius=200, 
+                                            step_length=50, dbscan_eps=400, out_file=None,
+                                            index=None, batched_scoring=True, 
+                                            osm_bus_stops=None, visualize=True,
+                                            shared_corridors=False, raster_cell_size=None,
+                                            raster_file=None, peak_engine='cwt',
+                                            peak_options=None, bus_stop_combinations=None):
+    ############################################################################
+    # Get bus stop locations from OSM
+    if osm_bus_stops is None and bus_stop_combinations is None:
+        osm_bus_stops = get_osm_bus_stops(routes)
+    ############################################################################
+    # Score the steps along all routes.
+    sequences = score_route_steps(activity_points, routes, activity_radius, step_length,
+                                  index, batched_scoring, osm_bus_stops, shared_corridors,
+                                  raster_cell_size, raster_file, bus_stop_combinations)
+    ############################################################################
+    # Find local score peaks in the sequences of steps of all routes.
+    with instrumentation.stage('peak_finding'):
+        route_peaks = peaks.find_peaks([scores for (steps, scores) in sequences], peak_engine,
+                                       **(peak_options or {}))
+    instrumentation.count('peaks', sum(len(peak_indices) for peak_indices in route_peaks)
+                                    if instrumentation.recording() else 0)
+    ############################################################################
+    # Cluster the peaks to bus stops.
+    bus_stops = cluster_peaks(sequences, route_peaks, dbscan_eps, visualize,
+                              dbscan_plot_file('DBSCAN for traversing-based algorithm',
+                                               out_file, activity_radius=activity_radius,
+                                               step_length=step_length,
+                                               eps=dbscan_eps, min_points=1))
 
+    ############################################################################
+    # Write result to geojson file.
+    if out_file is not None:
+        write_bus_stops([centroid for (centroid, score) in bus_stops],
+                        [{'score': score} for (centroid, score) in bus_stops],
+                        routes[0].utm_zone, out_file)
+
+    return bus_stops
+
+################################################################################
+# Clusters the score peaks of the step sequences of the traversing approach 
+# (given as (step coordinates, scores) tuples and peak indices per sequence).
+# Returns the (centroid, average score) tuple of each cluster.
+def cluster_peaks(sequences, route_peaks, dbscan_eps=400, visualize=True, plot_file=None):
+    ############################################################################
+    # Prepare stop candidates for clustering
     filtered_peak_points = []
     filtered_scores = []
-    for route in unique_routes:
-        score_sequence = []
-        step_sequence = []
-        steps = int(route.geometry.length/step_length)
-        for i in xrange(0,steps):
-            step = route.geometry.interpolate(i*step_length)
-            buffered_step = step.buffer(activity_radius)
-            score = 0
-            for activity_point in activity_points.values():
-                if buffered_step.intersects(activity_point.geometry):
-                    distance = step.distance(activity_point.geometry)
-                    if activity_point.activity_combination in interesting_activity_combinations_scores:
-                        score += interesting_activity_combinations_scores[activity_point.activity_combination]*interp(distance, [0,activity_radius], [1.2,0.8])
-                    elif activity_point.activity_combination in data_driven_activity_combinations_scores:
-                        score += data_driven_activity_combinations_scores[activity_point.activity_combination]*interp(distance, [0,activity_radius], [1.2,0.8])
-            score_sequence.append(score)
-            step_sequence.append(step)
-        ############################################################################
-        # Find local score peaks in the sequence of steps.
-        score_array = np.array(score_sequence)
-        peaks = signal.find_peaks_cwt(score_array, np.arange(1,20))
-        ############################################################################
-        # Prepare stop candidates for clustering
-        for i in peaks:
+    for ((step_sequence, score_sequence), peak_indices) in zip(sequences, route_peaks):
+        for i in peak_indices:
             point = step_sequence[i]
-            score = score_sequence[i]
+            score = float(score_sequence[i])
             if score > 0.0:
-                filtered_peak_points.append([point.x, point.y])
+                filtered_peak_points.append([point[0], point[1]])
                 filtered_scores.append(score)
 
+    instrumentation.count('candidates', len(filtered_peak_points))
     point_array = np.array(filtered_peak_points)
-    clusters = clustering.dbscan(point_array, epsilon=dbscan_eps, min_points=1,
-                                    visualize=True, vis_title='DBSCAN for traversing-based algorithm')
+    clusters = {}
+    if len(point_array) > 0:
+        clusters = clustering.dbscan(point_array, epsilon=dbscan_eps, min_points=1,
+                                     visualize=visualize, vis_title='DBSCAN for traversing-based algorithm',
+                                     plot_file=plot_file)
     clusters_info = {}
     for cluster_id,members in clusters.items():
         cluster_multipoint_coords = []
@@ -421,172 +1252,279 @@ def detect_bus_stops_traversing_approach(activity_points, routes, activity_radiu
                                             'centroid': MultiPoint(cluster_multipoint_coords).centroid,
                                             'score': avg_score/len(cluster_multipoint_coords)
                                          }
-
-    geojson = pygeoj.new()
-    geojson.define_crs(type='name', name='urn:ogc:def:crs:OGC:1.3:CRS84')
-    for (cluster_id,info) in clusters_info.items():
-        
-        latlon = utm.to_latlon(info['centroid'].x, info['centroid'].y, 37, 'M')
-        feature = pygeoj.Feature(obj=None, properties={'score': info['score']}, 
-                                geometry={'type': info['centroid'].type, 'coordinates':
-                                                         (latlon[1],latlon[0])})
-        if feature.validate():
-            geojson.add_feature(feature)
-        else:
-            raise GeoJSONError('Feature not valid!')  
-    geojson.save(DATA_PATH+out_file)  
-         
+    return [(info['centroid'], info['score']) for info in clusters_info.values()]
             
+################################################################################
+# Returns the DBSCAN neighbourhood graph of the points clustered by the 
+# clustering approach, for all dbscan_eps up to max_epsilon.
+def create_clustering_graph(activity_points, max_epsilon):
+    clustered_rows = np.arange(0,len(activity_points)-1)
+    return clustering.NeighbourhoodGraph(activity_points.coordinates(clustered_rows),
+                                         max_epsilon)
+
 ################################################################################
 # Bus stop detection algorithm based on data-driven activity patterns and 
 # spatial clustering.  
+@instrumentation.instrumented('clustering_approach',
+                              report_file=lambda arguments: report_file(arguments['out_file']))
 def detect_bus_stops_clustering_approach(activity_points, routes, pattern_radius=150,
-                                          dbscan_eps = 300, dbscan_min_points=2, out_file=None):
+                                          dbscan_eps = 300, dbscan_min_points=2, out_file=None,
+                                          index=None, osm_bus_stops=None, 
+                                          bus_stop_patterns=None, visualize=True,
+                                          dbscan_graph=None, dbscan_standardize=True,
+                                          route_index=None, clustered_rows=None):
     ############################################################################
     # Try to enhance activity points.
     #enhance_activity_points(activity_points)
     ############################################################################
     # Get bus stop locations from OSM.
-    osm_bus_stops = get_osm_bus_stops(routes)
+    if osm_bus_stops is None and bus_stop_patterns is None:
+        osm_bus_stops = get_osm_bus_stops(routes)
     ############################################################################
     # Extract activity patterns around OSM bus stops.
-    bus_stop_patterns = extract_activity_pattern_around_bus_stops(osm_bus_stops,
-                                                                  activity_points,
-                                                                  pattern_radius, 
-                                                                  min_combinations=1)
-    ############################################################################
-    # Prepare activity points for clustering and perform DBSCAN.
-    point_list = []
-    clustered_points = {}
-    for i in xrange(0,len(activity_points.values())-1):
-        point = activity_points.values()[i]
-        point.clustering_id = i
-        point_list.append([point.geometry.x, point.geometry.y])
-        clustered_points[i] = point        
-    point_array = np.array(point_list)  
-    clusters = clustering.dbscan(point_array, epsilon=dbscan_eps, min_points=dbscan_min_points, 
-                                visualize=True, vis_title='DBSCAN for clustering-based algorithm')
+    if bus_stop_patterns is None:
+        bus_stop_patterns = extract_activity_pattern_around_bus_stops(osm_bus_stops,
+                                                                      activity_points,
+                                                                      pattern_radius, 
+                                                                      min_combinations=1,
+                                                                      index=index)
+    ############################################################################
+    # Prepare activity points for clustering and perform DBSCAN. A neighbourhood
+    # graph from create_clustering_graph can be passed in to reuse distances.
+    # Without standardization, dbscan_eps is a plain distance in meters, which
+    # is what the incremental detector (see incremental.py) clusters with. The
+    # rows to cluster can be passed in; by default, all but the last one.
+    if clustered_rows is None:
+        clustered_rows = np.arange(0,len(activity_points)-1)
+    point_array = activity_points.coordinates(clustered_rows)
+    clusters = {}
+    if len(point_array) > 0:
+        clusters = clustering.dbscan(point_array, epsilon=dbscan_eps, min_points=dbscan_min_points, 
+                                    visualize=visualize, vis_title='DBSCAN for clustering-based algorithm',
+                                    graph=dbscan_graph, standardize=dbscan_standardize,
+                                    plot_file=dbscan_plot_file('DBSCAN for clustering-based algorithm',
+                                                               out_file, pattern_radius=pattern_radius,
+                                                               eps=dbscan_eps,
+                                                               min_points=dbscan_min_points))
     ############################################################################
     # Calculate the activity combination pattern and the centroid for each cluster.    
     clusters_info = {}
     for cluster_id,members in clusters.items():
-        cluster_activity_pattern = ActivityPattern()
-        cluster_multipoint_coords = []
-        original_activity_point_ids = []
-        for id in np.nditer(members):
-            point_id = int(id)
-            activity_point = clustered_points[point_id]
-            point_activity_combination = (activity_point.previous_dominating_activity,
-                                          activity_point.current_dominating_activity)
-            cluster_activity_pattern[point_activity_combination] += 1
-            cluster_multipoint_coords.append((activity_point.geometry.coords[0]))
-            original_activity_point_ids.append(activity_point.id)
+        rows = clustered_rows[members]
+        cluster_activity_pattern = activity_points.activity_pattern(rows)
         cluster_activity_pattern.normalize()
         clusters_info[int(cluster_id)] = {
                                             'pattern': cluster_activity_pattern,
-                                            'centroid': MultiPoint(cluster_multipoint_coords).centroid,
-                                            'activity_points': original_activity_point_ids
+                                            'centroid': MultiPoint(activity_points.coordinates(rows)).centroid,
+                                            'activity_points': activity_points.ids[rows].tolist()
                                          }
     ############################################################################
     # Compare cluster patterns with known bus stop patterns. 
     # Project cluster centroid to the closest route.  
-    max_projection_distance = 500  
-    route_geometries = []
-    for route in routes:
-        route_geometries.append(route.geometry)
-    multi_route = MultiLineString(route_geometries)
-   
     potential_bus_stops = []
-    similarity_threshold = 0.75
-    for cluster_id, info in clusters_info.items():
-        #print cluster_id
-        similarities = []
-        for pattern in bus_stop_patterns:
-            similarity = info['pattern'].get_similarity(pattern)
-            similarities.append(similarity)
-       # print str(min(similarities))+' '+str(np.mean(similarities))+' '+str(max(similarities))
-        if max(similarities) > similarity_threshold:
-            point_on_route = multi_route.interpolate(multi_route.project(info['centroid']))
-            if point_on_route.distance(info['centroid']) <= max_projection_distance:
-                potential_bus_stops.append((point_on_route,info['activity_points']))
+    stop_route_ids = []
+    cluster_infos = clusters_info.values()
+    with instrumentation.stage('pattern_matching'):
+        similarities = get_similarity_matrix([info['pattern'] for info in cluster_infos],
+                                             bus_stop_patterns)
+        similar_infos = [info for (i, info) in enumerate(cluster_infos)
+                            if len(bus_stop_patterns) > 0 and 
+                               max(similarities[i]) > SIMILARITY_THRESHOLD]
+    instrumentation.count('candidates', len(similar_infos))
+    points_on_route, route_ids, _ = snap_to_routes([(info['centroid'].x, info['centroid'].y)
+                                                    for info in similar_infos],
+                                                   routes, route_index)
+    for (info, point_on_route, route_id) in zip(similar_infos, points_on_route, route_ids):
+        if point_on_route is not None:
+            potential_bus_stops.append((point_on_route,info['activity_points']))
+            stop_route_ids.append(route_id)
     ############################################################################
     # Write result to geojson file.
-    geojson = pygeoj.new()
-    geojson.define_crs(type='name', name='urn:ogc:def:crs:OGC:1.3:CRS84')
-    for stop in potential_bus_stops:
-        latlon = utm.to_latlon(stop[0].x, stop[0].y, 37, 'M')
-        feature = pygeoj.Feature(obj=None, properties={'activity_points': stop[1]}, 
-                                 geometry={'type': stop[0].type,
-                                           'coordinates': (latlon[1],latlon[0])})
-        geojson.add_feature(feature)
-   # filename = 'detected_bus_stops_pattern_radius_'+str(pattern_radius)+'.geojson'
-    geojson.save(DATA_PATH+out_file)
+    if out_file is not None:
+        write_bus_stops([stop[0] for stop in potential_bus_stops],
+                        [{'activity_points': stop[1], 'route_id': route_id}
+                            for (stop, route_id) in zip(potential_bus_stops, stop_route_ids)],
+                        routes[0].utm_zone, out_file)
+       # filename = 'detected_bus_stops_pattern_radius_'+str(pattern_radius)+'.geojson'
     
     return potential_bus_stops
 
 ################################################################################
 # Function to calculate the average distance between detected bus stops and 
-# bus stops from OSM.
+# bus stops from OSM (both shapely points), None without detected bus stops or
+# without OSM bus stops. For repeated evaluations against the same stops, use an
+# evaluation.GroundTruth instead.
 def avg_distance_to_ground_truth(detected_stops, osm_stops):
-    cumulative_distance = 0
-    for stop in detected_stops:
-        min_dist = 9999999999
-        for osm_stop in osm_stops:
-            distance = stop.distance(osm_stop)
-            if distance < min_dist:
-                min_dist = distance
-        cumulative_distance += min_dist
-    return cumulative_distance/len(detected_stops)
+    ground_truth = evaluation.GroundTruth([(stop.x, stop.y) for stop in osm_stops])
+    return ground_truth.mean_distance([(stop.x, stop.y) for stop in detected_stops])
+################################################################################
+# Shared state of the parameter sweep worker processes, see 
+# sweep_parameter_settings.
+_sweep_state = None
+
+def _init_sweep_worker(state):
+    global _sweep_state
+    _sweep_state = state
+
+def _run_sweep_setting(setting):
+    (pattern_radius, epsilon, min_pts) = setting
+    detected_stops = detect_bus_stops_clustering_approach(_sweep_state['activity_points'],
+                                                          _sweep_state['routes'],
+                                                          pattern_radius=pattern_radius,
+                                                          dbscan_eps = epsilon,
+                                                          dbscan_min_points=min_pts,
+                                                          index=_sweep_state['index'],
+                                                          bus_stop_patterns=_sweep_state['patterns'][pattern_radius],
+                                                          visualize=False,
+                                                          dbscan_graph=_sweep_state['graph'],
+                                                          route_index=_sweep_state['route_index'])
+    metrics = _sweep_state['ground_truth'].evaluate([(stop[0].x, stop[0].y)
+                                                     for stop in detected_stops],
+                                                    _sweep_state['match_radii'])
+    return (pattern_radius,epsilon,min_pts,len(detected_stops),metrics['mean_distance'],metrics)
+
+################################################################################
+# Runs the clustering approach for every combination of the given parameter
+# values on a process pool and yields the result tuples as they finish (see
+# evaluate_parameter_settings). The dataset-level work (spatial index, OSM bus
+# stops and their activity patterns per pattern radius, DBSCAN neighbourhood 
+# graph, route index, ground truth index) is done once up front and shared with
+# the worker processes. Each tuple ends with the evaluation of the detected bus
+# stops against the OSM bus stops (see evaluation.py).
+def sweep_parameter_settings(activity_points, routes, osm_stops, 
+                             pattern_radii=xrange(100,500,50), 
+                             epsilons=xrange(100,500,50),
+                             min_points=xrange(1,5), processes=None,
+                             match_radii=evaluation.MATCH_RADII):
+    index = create_activity_point_index(activity_points)
+    patterns = {}
+    for pattern_radius in pattern_radii:
+        patterns[pattern_radius] = extract_activity_pattern_around_bus_stops(osm_stops,
+                                                                             activity_points,
+                                                                             pattern_radius,
+                                                                             min_combinations=1,
+                                                                             index=index)
+    state = {
+                'activity_points': activity_points,
+                'routes': routes,
+                'index': index,
+                'patterns': patterns,
+                'graph': create_clustering_graph(activity_points, max(epsilons)),
+                'route_index': create_route_index(routes),
+                'ground_truth': evaluation.GroundTruth([(osm_stop.geometry.x, osm_stop.geometry.y)
+                                                        for osm_stop in osm_stops]),
+                'match_radii': match_radii
+            }
+    settings = [(pattern_radius, epsilon, min_pts) for pattern_radius in pattern_radii
+                                                   for epsilon in epsilons
+                                                   for min_pts in min_points]
+    # Worker processes are forked and inherit the state without copying it.
+    pool = multiprocessing.Pool(processes, initializer=_init_sweep_worker,
+                                initargs=(state,))
+    try:
+        for result in pool.imap_unordered(_run_sweep_setting, settings):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
 ################################################################################
 # Function to evaluate different parameter settings.
 # The prints have to following structure:
-# (pattern_radius, dbscan_eps, dbscan_min_points, #bus_stops, average distance)    
-def evaluate_parameter_settings(activity_points, routes, osm_stops):
-    results = []
-    for pattern_radius in xrange(100,500,50):
-        for epsilon in xrange(100,500,50):
-            for min_pts in xrange(1,5):
-                detected_stops = detect_bus_stops_clustering_approach(activity_points,
-                                                                      routes,
-                                                                      pattern_radius=pattern_radius,
-                                                                      dbscan_eps = epsilon,
-                                                                      dbscan_min_points=min_pts)
-                stop_list = []
-                for stop in detected_stops:
-                    stop_list.append(stop[0])
-                osm_stop_list = []
-                for osm_stop in osm_stops:
-                    osm_stop_list.append(osm_stop.geometry)
-                results.append((pattern_radius,epsilon,min_pts,len(stop_list),
-                                avg_distance_to_ground_truth(stop_list, osm_stop_list)))
-    for run in sorted(results, key=lambda x: x[4]):
-        print run
+# (pattern_radius, dbscan_eps, dbscan_min_points, #bus_stops, average distance,
+#  median distance, (F1 score per match radius))
+def evaluate_parameter_settings(activity_points, routes, osm_stops, processes=None,
+                                match_radii=evaluation.MATCH_RADII):
+    results = list(sweep_parameter_settings(activity_points, routes, osm_stops,
+                                            processes=processes, match_radii=match_radii))
+    # Settings without detected bus stops have no distance and come last.
+    for run in sorted(results, key=lambda x: (x[4] is None, x[4])):
+        metrics = run[5]
+        print run[:5]+(metrics['median_distance'],
+                       tuple(round(match['f1'], 3) for match in metrics['matches']))
+
+################################################################################
+# Function to compare a peak engine of the traversing approach with the cwt 
+# engine on the step scores of the routes (see peaks.compare). Prints and 
+# returns the comparison.
+def compare_peak_engines(activity_points, routes, activity_radius=200, step_length=50,
+                         engine='smoothed', peak_options=None, tolerance=2, index=None,
+                         osm_bus_stops=None):
+    sequences = score_route_steps(activity_points, routes, activity_radius, step_length,
+                                  index=index, osm_bus_stops=osm_bus_stops)
+    comparison = peaks.compare([scores for (steps, scores) in sequences], engine,
+                               tolerance=tolerance, options=peak_options)
+    for key in sorted(comparison):
+        print key+': '+str(comparison[key])
+    return comparison
                 
 ################################################################################
+# Command line entry point: runs the detection on the sample data. Importing
+# this module does no work; everything happens here.
+def main(argv=None):
+    global HEADLESS, OVERPASS_OFFLINE, OVERPASS_CACHE_DIR, OVERPASS_CACHE_TTL
+    parser = argparse.ArgumentParser(description='Detects bus stops based on activity '+
+                                                 'points and routes.')
+    parser.add_argument('--headless', action='store_true', 
+                        help='render charts to image files in '+PLOT_PATH+
+                             ' instead of showing them')
+    parser.add_argument('--no-charts', action='store_true', help='do not create any charts')
+    parser.add_argument('--report', action='store_true',
+                        help='write a performance report (stage times, peak memory, '+
+                             'counters) next to every result and for the whole run to '+
+                             DATA_PATH+'detection_report.json')
+    parser.add_argument('--profile', action='store_true',
+                        help='like --report and profile the whole run with cProfile')
+    parser.add_argument('--offline', action='store_true',
+                        help='use only cached Overpass responses and never the network')
+    parser.add_argument('--overpass-cache-dir', default=OVERPASS_CACHE_DIR,
+                        help='directory of the cached Overpass responses')
+    parser.add_argument('--overpass-cache-ttl', type=float, default=OVERPASS_CACHE_TTL,
+                        help='seconds after which cached Overpass responses are fetched again')
+    arguments = parser.parse_args(argv)
+    HEADLESS = arguments.headless
+    OVERPASS_OFFLINE = arguments.offline
+    OVERPASS_CACHE_DIR = arguments.overpass_cache_dir
+    OVERPASS_CACHE_TTL = arguments.overpass_cache_ttl
+    visualize = not arguments.no_charts
+    if arguments.report or arguments.profile:
+        instrumentation.enable(profiler='cprofile' if arguments.profile else None)
+    run = instrumentation.start_run('detection')
 
-      
-    
-activity_points = create_activity_points(load_geojson('activity_points.geojson'))
-routes = create_routes(load_geojson('routes.geojson'))
-
-profile_activity_points(activity_points)
-
-enhance_activity_points(activity_points)
+    # The charts profile the activity points as loaded; otherwise they come with
+    # the activity labels already filled.
+    activity_points, routes = load_dataset('activity_points.geojson', 'routes.geojson',
+                                           enhance=not visualize)
+    publish_layer('activity_points.geojson')
+    publish_layer('routes.geojson')
 
-detect_bus_stops_clustering_approach(activity_points, routes, pattern_radius=100,
-                                        dbscan_eps = 200, dbscan_min_points=2, 
-                                        out_file='detected_bus_stops_clustering_approach_params1.geojson')
-detect_bus_stops_clustering_approach(activity_points, routes, pattern_radius=150,
-                                        dbscan_eps = 300, dbscan_min_points=2,
-                                        out_file='detected_bus_stops_clustering_approach_params2.geojson')
-detect_bus_stops_traversing_approach(activity_points, routes, activity_radius=200,
-                                        step_length=50, dbscan_eps=400, 
-                                        out_file='detected_bus_stops_traversing_approach_params1.geojson')
-detect_bus_stops_traversing_approach(activity_points, routes, activity_radius=300,
-                                        step_length=50, dbscan_eps=400, 
-                                        out_file='detected_bus_stops_traversing_approach_params2.geojson')
+    if visualize:
+        profile_activity_points(activity_points)
+        enhance_activity_points(activity_points)
+    activity_point_index = create_activity_point_index(activity_points)
 
-#osm_bus_stops = get_osm_bus_stops(routes)
-#evaluate_parameter_settings(activity_points, routes, osm_bus_stops)
+    detect_bus_stops_clustering_approach(activity_points, routes, pattern_radius=100,
+                                            dbscan_eps = 200, dbscan_min_points=2, 
+                                            out_file='detected_bus_stops_clustering_approach_params1.geojson',
+                                            index=activity_point_index, visualize=visualize)
+    detect_bus_stops_clustering_approach(activity_points, routes, pattern_radius=150,
+                                            dbscan_eps = 300, dbscan_min_points=2,
+                                            out_file='detected_bus_stops_clustering_approach_params2.geojson',
+                                            index=activity_point_index, visualize=visualize)
+    detect_bus_stops_traversing_approach(activity_points, routes, activity_radius=200,
+                                            step_length=50, dbscan_eps=400, 
+                                            out_file='detected_bus_stops_traversing_approach_params1.geojson',
+                                            index=activity_point_index, visualize=visualize)
+    detect_bus_stops_traversing_approach(activity_points, routes, activity_radius=300,
+                                            step_length=50, dbscan_eps=400, 
+                                            out_file='detected_bus_stops_traversing_approach_params2.geojson',
+                                            index=activity_point_index, visualize=visualize)
+    instrumentation.finish_run(run, DATA_PATH+'detection_report.json')
 
+    #osm_bus_stops = get_osm_bus_stops(routes)
+    #evaluate_parameter_settings(activity_points, routes, osm_bus_stops)
+    #compare_peak_engines(activity_points, routes, osm_bus_stops=osm_bus_stops)
 
+if __name__ == '__main__':
+    main()
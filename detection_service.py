@@ -0,0 +1,366 @@
+################################################################################
+# Long-running detection service. The dataset is loaded (see load_dataset) and
+# indexed once at startup; afterwards bus stops are detected per request:
+#
+#   GET  /detect?bbox=<min lon>,<min lat>,<max lon>,<max lat>&algorithm=<name>
+#        &<parameter>=<value>...
+#   POST /detect with a JSON object {"bbox": [...], "algorithm": ...,
+#        "parameters": {...}}
+#   GET  /status
+#
+# algorithm is clustering or traversing, parameters are those of ALGORITHMS
+# (the defaults are used for missing ones). The response is a GeoJSON feature
+# collection of the bus stops inside the bbox with a "detection" member
+# describing the request. Requests are detected on a pool of worker processes
+# that inherit the warm dataset, and the responses of the last CACHE_SIZE
+# distinct requests are kept in an LRU cache.
+#
+# Only the activity points and routes around the bbox take part in a detection,
+# so results near the bbox border can differ from those of a detection over the
+# whole dataset. The clustering approach clusters without standardization, so
+# dbscan_eps is a distance in meters (as in incremental.py), and it compares
+# against the bus stop patterns of the whole dataset. Like over the whole
+# dataset, all points but the one with the highest id of the dataset are
+# clustered.
+################################################################################
+
+import argparse
+import BaseHTTPServer
+import json
+import multiprocessing
+import SocketServer
+import threading
+import time
+import urlparse
+from collections import OrderedDict
+
+import numpy as np
+
+import detect_bus_stops
+import geojson_stream
+import projection
+
+PORT = 8001
+# Number of worker processes (None for one per CPU, 0 to detect in the server
+# process).
+WORKERS = None
+# Number of responses kept in the LRU cache.
+CACHE_SIZE = 256
+# Detection parameters and their defaults per algorithm. Request values are
+# converted to the type of the default.
+ALGORITHMS = detect_bus_stops.APPROACH_PARAMETERS
+DEFAULT_ALGORITHM = 'clustering'
+
+################################################################################
+# Raised for requests that cannot be detected, answered with 400 Bad Request.
+class RequestError(Exception):
+    pass
+
+################################################################################
+# The dataset as loaded and indexed at startup. Worker processes are forked and
+# inherit it without copying it.
+class DetectionState:
+
+    def __init__(self, activity_points_file, routes_file, bus_stops_file=None):
+        (self.activity_points, self.routes) = detect_bus_stops.load_dataset(activity_points_file,
+                                                                            routes_file,
+                                                                            enhance=True)
+        self.utm_zone = self.routes[0].utm_zone
+        self.route_index = detect_bus_stops.create_route_index(self.routes)
+        self.route_bounds = np.array([route.geometry.bounds for route in self.routes])
+        self.index = detect_bus_stops.create_activity_point_index(self.activity_points)
+        # Like over the whole dataset, only the point with the highest id is
+        # not clustered.
+        self.last_id = int(self.activity_points.ids[-1]) if len(self.activity_points) else None
+        if bus_stops_file is None:
+            self.osm_bus_stops = detect_bus_stops.get_osm_bus_stops(self.routes)
+        else:
+            features = geojson_stream.iter_features(detect_bus_stops.DATA_PATH+bus_stops_file)
+            self.osm_bus_stops = detect_bus_stops.create_bus_stops(
+                                    [feature.geometry.coordinates for feature in features],
+                                    self.utm_zone)
+        self.osm_bus_stop_coordinates = np.array([(stop.geometry.x, stop.geometry.y)
+                                                  for stop in self.osm_bus_stops]).reshape(-1, 2)
+        # Bus stop patterns of the whole dataset by pattern radius, extracted
+        # on first use.
+        self.patterns = {}
+
+    def bus_stop_patterns(self, pattern_radius):
+        if pattern_radius not in self.patterns:
+            self.patterns[pattern_radius] = detect_bus_stops.extract_activity_pattern_around_bus_stops(
+                                                self.osm_bus_stops, self.activity_points,
+                                                pattern_radius, min_combinations=1,
+                                                index=self.index)
+        return self.patterns[pattern_radius]
+
+    ############################################################################
+    # Returns the projected bounds (min x, min y, max x, max y) of a bbox in
+    # longitude/latitude.
+    def project_bbox(self, bbox):
+        (x, y, _) = projection.to_utm([bbox[0], bbox[2], bbox[0], bbox[2]],
+                                      [bbox[1], bbox[1], bbox[3], bbox[3]], self.utm_zone)
+        return (x.min(), y.min(), x.max(), y.max())
+
+    ############################################################################
+    # Detects the bus stops of a normalized request (see normalize_request).
+    # Returns the features of the bus stops inside its bbox.
+    def detect(self, request):
+        bbox = request['bbox']
+        parameters = request['parameters']
+        if request['algorithm'] == 'clustering':
+            margin = parameters['dbscan_eps']
+        else:
+            margin = parameters['activity_radius']+parameters['dbscan_eps']
+        (min_x, min_y, max_x, max_y) = self.project_bbox(bbox)
+        (min_x, min_y, max_x, max_y) = (min_x-margin, min_y-margin, max_x+margin, max_y+margin)
+        ########################################################################
+        # Activity points, routes and OSM bus stops around the bbox.
+        points = self.activity_points
+        rows = np.where((points.x >= min_x) & (points.x <= max_x) &
+                        (points.y >= min_y) & (points.y <= max_y))[0]
+        if len(rows) == 0:
+            return []
+        activity_points = points.take(rows)
+        index = detect_bus_stops.create_activity_point_index(activity_points)
+        if request['algorithm'] == 'clustering':
+            detected = detect_bus_stops.detect_bus_stops_clustering_approach(
+                            activity_points, self.routes, visualize=False, index=index,
+                            bus_stop_patterns=self.bus_stop_patterns(parameters['pattern_radius']),
+                            dbscan_standardize=False, route_index=self.route_index,
+                            clustered_rows=np.where(activity_points.ids != self.last_id)[0],
+                            **parameters)
+            properties = [{'activity_points': ids} for (point, ids) in detected]
+        else:
+            bounds = self.route_bounds
+            routes = [self.routes[i] for i in np.where((bounds[:,0] <= max_x) &
+                                                       (bounds[:,2] >= min_x) &
+                                                       (bounds[:,1] <= max_y) &
+                                                       (bounds[:,3] >= min_y))[0]]
+            stops = self.osm_bus_stop_coordinates
+            osm_bus_stops = [self.osm_bus_stops[i] for i in np.where((stops[:,0] >= min_x) &
+                                                                     (stops[:,0] <= max_x) &
+                                                                     (stops[:,1] >= min_y) &
+                                                                     (stops[:,1] <= max_y))[0]]
+            if len(routes) == 0:
+                detected = []
+            else:
+                detected = detect_bus_stops.detect_bus_stops_traversing_approach(
+                                activity_points, routes, visualize=False, index=index,
+                                osm_bus_stops=osm_bus_stops, **parameters)
+            properties = [{'score': score} for (point, score) in detected]
+        ########################################################################
+        # Features of the bus stops inside the bbox.
+        (longitudes, latitudes) = projection.to_lonlat([point.x for (point, _) in detected],
+                                                       [point.y for (point, _) in detected],
+                                                       self.utm_zone)
+        features = []
+        for (longitude, latitude, stop_properties) in zip(longitudes, latitudes, properties):
+            if bbox[0] <= longitude <= bbox[2] and bbox[1] <= latitude <= bbox[3]:
+                features.append({'type': 'Feature', 'properties': stop_properties,
+                                 'geometry': {'type': 'Point',
+                                              'coordinates': [float(longitude), float(latitude)]}})
+        return features
+
+################################################################################
+# Returns the normalized request (bbox, algorithm and all parameters) of the
+# request values, raising RequestError for invalid ones. Equal requests have
+# equal normalized requests.
+def normalize_request(bbox, algorithm=None, parameters=None):
+    if algorithm is None:
+        algorithm = DEFAULT_ALGORITHM
+    if algorithm not in ALGORITHMS:
+        raise RequestError('Unknown algorithm '+str(algorithm)+'!')
+    try:
+        if isinstance(bbox, basestring):
+            bbox = bbox.split(',')
+        bbox = [float(value) for value in bbox]
+    except (TypeError, ValueError):
+        raise RequestError('Invalid bbox!')
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise RequestError('A bbox is min lon, min lat, max lon, max lat!')
+    parameters = dict(parameters or {})
+    unknown = [name for name in parameters if name not in ALGORITHMS[algorithm]]
+    if unknown:
+        raise RequestError('Unknown parameters for '+algorithm+': '+', '.join(sorted(unknown))+'!')
+    normalized = OrderedDict()
+    for (name, default) in ALGORITHMS[algorithm].items():
+        try:
+            normalized[name] = type(default)(parameters.get(name, default))
+        except (TypeError, ValueError):
+            raise RequestError('Invalid value for '+name+'!')
+    if 'peak_engine' in normalized and normalized['peak_engine'] not in detect_bus_stops.peaks.ENGINES:
+        raise RequestError('Unknown peak engine '+normalized['peak_engine']+'!')
+    if any(value <= 0 for value in normalized.values() if not isinstance(value, basestring)):
+        raise RequestError('Parameters have to be positive!')
+    return OrderedDict([('bbox', bbox), ('algorithm', algorithm), ('parameters', normalized)])
+
+################################################################################
+# State of the worker processes, see DetectionService.
+_worker_state = None
+
+def _init_worker(state):
+    global _worker_state
+    _worker_state = state
+
+def _detect(request):
+    return _worker_state.detect(request)
+
+################################################################################
+# Answers normalized requests from an LRU cache or by detecting them on the
+# worker pool. Used by the request handler threads concurrently.
+class DetectionService:
+
+    def __init__(self, state, workers=WORKERS, cache_size=CACHE_SIZE):
+        self.state = state
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if workers == 0:
+            self.pool = None
+            # Detections in the server process run one at a time.
+            self.detect_lock = threading.Lock()
+        else:
+            self.pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                             initargs=(state,))
+
+    ############################################################################
+    # Returns the bus stop features of a normalized request and whether they
+    # came from the cache.
+    def features(self, request):
+        key = json.dumps(request)
+        with self.cache_lock:
+            features = self.cache.pop(key, None)
+            if features is not None:
+                self.cache[key] = features
+                self.hits += 1
+                return features, True
+            self.misses += 1
+        if self.pool is None:
+            with self.detect_lock:
+                features = self.state.detect(request)
+        else:
+            features = self.pool.apply(_detect, (request,))
+        with self.cache_lock:
+            self.cache[key] = features
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return features, False
+
+    def status(self):
+        with self.cache_lock:
+            return {
+                        'activity_points': len(self.state.activity_points),
+                        'routes': len(self.state.routes),
+                        'osm_bus_stops': len(self.state.osm_bus_stops),
+                        'workers': self.pool._processes if self.pool is not None else 0,
+                        'cache_entries': len(self.cache),
+                        'cache_size': self.cache_size,
+                        'cache_hits': self.hits,
+                        'cache_misses': self.misses,
+                        'algorithms': ALGORITHMS
+                   }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+################################################################################
+# Answers /detect and /status requests with JSON.
+class DetectionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/status':
+            self.send_json(200, self.server.service.status())
+        elif url.path == '/detect':
+            parameters = dict((name, values[-1])
+                                for (name, values) in urlparse.parse_qs(url.query).items())
+            if 'bbox' not in parameters:
+                self.send_json(400, {'error': 'A bbox is required!'})
+                return
+            bbox = parameters.pop('bbox')
+            algorithm = parameters.pop('algorithm', None)
+            self.detect(bbox, algorithm, parameters)
+        else:
+            self.send_json(404, {'error': 'Not found!'})
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/detect':
+            self.send_json(404, {'error': 'Not found!'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(body, dict) or 'bbox' not in body:
+                raise ValueError('No bbox!')
+        except ValueError:
+            self.send_json(400, {'error': 'The body has to be a JSON object with a bbox!'})
+            return
+        self.detect(body['bbox'], body.get('algorithm'), body.get('parameters'))
+
+    def detect(self, bbox, algorithm, parameters):
+        start = time.time()
+        try:
+            request = normalize_request(bbox, algorithm, parameters)
+        except RequestError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        try:
+            (features, cached) = self.server.service.features(request)
+        except Exception as error:
+            self.send_json(500, {'error': 'Detection failed: '+str(error)})
+            raise
+        detection = OrderedDict(request)
+        detection['cached'] = cached
+        detection['elapsed'] = time.time()-start
+        self.send_json(200, OrderedDict([('type', 'FeatureCollection'),
+                                         ('detection', detection),
+                                         ('features', features)]))
+
+    def send_json(self, code, value):
+        data = json.dumps(value)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+################################################################################
+# Serves every request in its own thread; detections run on the service's pool.
+class DetectionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DetectionRequestHandler)
+        self.service = service
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves bus stop detections over HTTP.')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of worker processes (default: one per CPU, 0 to detect '+
+                             'in the server process)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help='number of responses kept in the cache')
+    parser.add_argument('--activity-points', default='activity_points.geojson',
+                        help='activity points file in '+detect_bus_stops.DATA_PATH)
+    parser.add_argument('--routes', default='routes.geojson',
+                        help='routes file in '+detect_bus_stops.DATA_PATH)
+    parser.add_argument('--bus-stops',
+                        help='GeoJSON file of known bus stops (in '+detect_bus_stops.DATA_PATH+
+                             ') to use instead of querying OSM')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use cached Overpass responses')
+    arguments = parser.parse_args()
+    detect_bus_stops.OVERPASS_OFFLINE = arguments.offline
+    state = DetectionState(arguments.activity_points, arguments.routes, arguments.bus_stops)
+    service = DetectionService(state, arguments.workers, arguments.cache_size)
+    httpd = DetectionServer(("", arguments.port), service)
+    print "serving detections at port", arguments.port
+    try:
+        httpd.serve_forever()
+    finally:
+        service.close()
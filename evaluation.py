@@ -0,0 +1,140 @@
+import argparse
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+import geojson_stream
+import projection
+
+# scipy is imported where the KD-trees are built, so that importing this module
+# stays cheap.
+
+################################################################################
+# Evaluation of detected bus stops against ground truth stops (e.g. the bus
+# stops from OSM or the planted stops of a benchmark city). The ground truth is
+# indexed once in a KD-tree, so evaluating the detections of many parameter
+# settings only costs a few vectorized nearest neighbour queries each.
+#
+# Reported are the mean and median distance of the detected stops to their
+# nearest ground truth stop, and per match radius the number of detected stops
+# matched to a ground truth stop at most that far away, with the precision,
+# recall and F1 score of the matches. Matches are one-to-one, closest pairs
+# first, so several detections of one stop count only once. Without detected
+# stops or without ground truth stops, the distances are None.
+
+# Match radii in meters.
+MATCH_RADII = [25, 50, 100, 200]
+
+################################################################################
+# Ground truth stops, given as projected coordinates.
+class GroundTruth:
+
+    def __init__(self, coordinates):
+        from scipy.spatial import cKDTree
+        self.coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        # cKDTree cannot be built over no points.
+        self.tree = cKDTree(self.coordinates) if len(self.coordinates) > 0 else None
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    ############################################################################
+    # Returns the distance of every point to its nearest ground truth stop
+    # (inf without ground truth stops, an empty array without points).
+    def nearest_distances(self, coordinates):
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        if len(coordinates) == 0 or len(self) == 0:
+            return np.full(len(coordinates), np.inf)
+        (distances, _) = self.tree.query(coordinates)
+        return distances
+
+    ############################################################################
+    # Returns the mean distance of the points to their nearest ground truth
+    # stop, None without points or without ground truth stops.
+    def mean_distance(self, coordinates):
+        distances = self.nearest_distances(coordinates)
+        if len(distances) == 0 or len(self) == 0:
+            return None
+        return float(distances.mean())
+
+    ############################################################################
+    # Returns the number of one-to-one matches of detected stops and ground
+    # truth stops at most radius apart, for each of the radii.
+    def match_counts(self, coordinates, radii):
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        if len(coordinates) == 0 or len(self) == 0 or len(radii) == 0:
+            return [0]*len(radii)
+        from scipy.spatial import cKDTree
+        pairs = cKDTree(coordinates).sparse_distance_matrix(self.tree, max(radii),
+                                                            output_type='ndarray')
+        order = np.argsort(pairs['v'], kind='mergesort')
+        (detected, truth, distances) = (pairs['i'][order], pairs['j'][order], pairs['v'][order])
+        counts = []
+        for radius in radii:
+            used_detected = set()
+            used_truth = set()
+            for k in xrange(np.searchsorted(distances, radius, side='right')):
+                if detected[k] not in used_detected and truth[k] not in used_truth:
+                    used_detected.add(detected[k])
+                    used_truth.add(truth[k])
+            counts.append(len(used_detected))
+        return counts
+
+    ############################################################################
+    # Evaluates detected stops (projected coordinates) and returns the metrics
+    # as a JSON serializable dict.
+    def evaluate(self, coordinates, match_radii=MATCH_RADII):
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        distances = self.nearest_distances(coordinates)
+        has_distances = len(distances) > 0 and len(self) > 0
+        metrics = OrderedDict([('detected', len(coordinates)),
+                               ('ground_truth', len(self)),
+                               ('mean_distance', float(distances.mean()) if has_distances
+                                                    else None),
+                               ('median_distance', float(np.median(distances)) if has_distances
+                                                      else None),
+                               ('matches', [])])
+        for (radius, matched) in zip(match_radii, self.match_counts(coordinates, match_radii)):
+            precision = matched/float(len(coordinates)) if len(coordinates) > 0 else 0.0
+            recall = matched/float(len(self)) if len(self) > 0 else 0.0
+            f1 = 2*precision*recall/(precision+recall) if matched > 0 else 0.0
+            metrics['matches'].append(OrderedDict([('radius', radius),
+                                                   ('matched', matched),
+                                                   ('precision', precision),
+                                                   ('recall', recall),
+                                                   ('f1', f1)]))
+        return metrics
+
+################################################################################
+# Returns the (longitude, latitude) coordinates of the point features of a
+# GeoJSON or newline-delimited GeoJSON file.
+def load_points(filename):
+    return np.array([feature.geometry.coordinates[:2]
+                     for feature in geojson_stream.iter_features(filename)
+                     if feature.geometry.type == 'Point'], dtype=float).reshape(-1, 2)
+
+################################################################################
+# Evaluates the stops of a GeoJSON file against the stops of a ground truth
+# file. Both are projected to the UTM zone of the first ground truth stop.
+def evaluate_files(detected_file, ground_truth_file, match_radii=MATCH_RADII):
+    truth = load_points(ground_truth_file)
+    detected = load_points(detected_file)
+    (x, y, zone) = projection.to_utm(truth[:,0], truth[:,1])
+    if zone is None and len(detected) > 0:
+        zone = projection.utm_zone(detected[0,0], detected[0,1])
+    (detected_x, detected_y, _) = projection.to_utm(detected[:,0], detected[:,1], zone)
+    return GroundTruth(np.column_stack((x, y))).evaluate(np.column_stack((detected_x, detected_y)),
+                                                         match_radii)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates detected bus stops against '+
+                                                 'ground truth stops.')
+    parser.add_argument('detected', help='GeoJSON file of the detected bus stops')
+    parser.add_argument('ground_truth', help='GeoJSON file of the ground truth stops, e.g. '+
+                                             'data/osm_bus_stops.geojson')
+    parser.add_argument('--radii', nargs='+', type=float, default=MATCH_RADII,
+                        help='match radii in meters')
+    arguments = parser.parse_args()
+    print json.dumps(evaluate_files(arguments.detected, arguments.ground_truth, arguments.radii),
+                     indent=2)
@@ -0,0 +1,174 @@
+import itertools
+import json
+
+################################################################################
+# Streaming reader for GeoJSON feature collections and newline-delimited GeoJSON
+# (one feature per line). Features are parsed one at a time from blocks of the
+# file, so memory use depends on the block and chunk sizes, not on the file
+# size. Features are returned as Feature objects with the properties and
+# geometry attributes the detection uses from pygeoj features.
+
+# Bytes read from the file at a time.
+BLOCK_SIZE = 1 << 20
+# Features per chunk, see iter_feature_chunks.
+CHUNK_SIZE = 10000
+# Bytes read at a time to tell newline-delimited GeoJSON from a feature
+# collection.
+PEEK_SIZE = 4096
+
+################################################################################
+# Raised for files that are no feature collection or newline-delimited GeoJSON.
+class StreamError(Exception):
+    pass
+
+class Geometry(object):
+    __slots__ = ('type', 'coordinates')
+
+    def __init__(self, geometry):
+        self.type = geometry.get('type')
+        self.coordinates = geometry.get('coordinates')
+
+class Feature(object):
+    __slots__ = ('properties', 'geometry')
+
+    def __init__(self, feature):
+        self.properties = feature.get('properties') or {}
+        self.geometry = Geometry(feature.get('geometry') or {})
+
+################################################################################
+# Yields the features of a file one at a time.
+def iter_features(filename, block_size=BLOCK_SIZE):
+    with open(filename, 'rb') as stream:
+        if _is_newline_delimited(stream):
+            for (number, line) in enumerate(stream):
+                if line.strip():
+                    try:
+                        yield Feature(json.loads(line))
+                    except ValueError:
+                        raise StreamError('Invalid feature in line '+str(number+1)+'!')
+        else:
+            for feature in _Reader(stream, block_size).features():
+                yield Feature(feature)
+
+################################################################################
+# Yields the features of a file in lists of up to chunk_size features.
+def iter_feature_chunks(filename, chunk_size=CHUNK_SIZE, block_size=BLOCK_SIZE):
+    features = iter_features(filename, block_size)
+    while True:
+        chunk = list(itertools.islice(features, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+################################################################################
+# A file is newline-delimited if its first object is a feature. Only the members
+# of the first object up to its type are read, never the features of a feature
+# collection, which may well be all on the first line.
+def _is_newline_delimited(stream):
+    try:
+        return _Reader(stream, PEEK_SIZE).object_type() == 'Feature'
+    except StreamError:
+        return False
+    finally:
+        stream.seek(0)
+
+################################################################################
+# Incremental parser of a feature collection: the top-level members other than
+# features are skipped, the features array is decoded element by element with
+# json's raw_decode. An element cut off at the end of the buffered blocks fails
+# to decode and is decoded again once the next block is read.
+class _Reader:
+
+    def __init__(self, stream, block_size):
+        self.stream = stream
+        self.block_size = block_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.at_end = False
+
+    def features(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'features':
+                self._expect('[')
+                if self._peek() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._next_of(',]') == ']':
+                            break
+            else:
+                self._value()
+            if self._next_of(',}') == '}':
+                return
+
+    ############################################################################
+    # Returns the type member of the top-level object (FeatureCollection as soon
+    # as a features member comes first, None without type member).
+    def object_type(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return None
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'features':
+                return 'FeatureCollection'
+            value = self._value()
+            if key == 'type':
+                return value
+            if self._next_of(',}') == '}':
+                return None
+
+    def _read(self):
+        block = self.stream.read(self.block_size)
+        if not block:
+            self.at_end = True
+            return False
+        # Drop what has been consumed so the buffer stays about a block long.
+        self.buffer = self.buffer[self.position:]+block
+        self.position = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read():
+                raise StreamError('Unexpected end of file!')
+
+    def _expect(self, character):
+        if self._peek() != character:
+            raise StreamError('Expected '+character+' at byte '+str(self.position)+
+                              ' of the buffer!')
+        self.position += 1
+
+    def _next_of(self, characters):
+        character = self._peek()
+        if character not in characters:
+            raise StreamError('Expected one of '+characters+' but got '+character+'!')
+        self.position += 1
+        return character
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer might continue in the next
+                # block.
+                if end < len(self.buffer) or self.at_end:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.at_end:
+                    raise StreamError('Invalid JSON value in the file!')
+            self._read()
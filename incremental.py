@@ -0,0 +1,364 @@
+################################################################################
+# Incremental version of the clustering approach for activity points that arrive
+# in batches. Every batch updates the DBSCAN clusters it touches (grid-hashed
+# neighbour search, union-find of core points) and the activity patterns around
+# the OSM bus stops, and only the bus stops of changed clusters are emitted
+# again. Every cluster keeps its similarity to each bus stop pattern; when the
+# patterns of some OSM bus stops change, all clusters are compared against only
+# those patterns. After any sequence of batches, the bus stops are the ones
+# detect_bus_stops_clustering_approach finds for all points seen so far with
+# dbscan_standardize=False (standardizing depends on the whole dataset).
+################################################################################
+
+import math
+
+import numpy as np
+from shapely.geometry import MultiPoint
+
+import detect_bus_stops
+import spatial_index
+from detect_bus_stops import ActivityPattern, GeoJSONError
+
+class IncrementalClusteringDetector:
+
+    def __init__(self, routes, osm_bus_stops, pattern_radius=150, dbscan_eps=300,
+                 dbscan_min_points=2):
+        self.utm_zone = routes[0].utm_zone
+        self.routes = routes
+        self.route_index = detect_bus_stops.create_route_index(routes)
+        self.pattern_radius = pattern_radius
+        self.epsilon = float(dbscan_eps)
+        self.min_points = dbscan_min_points
+        ########################################################################
+        # Activity combination counts around the OSM bus stops.
+        self.stop_index = spatial_index.PointIndex([(stop.geometry.x, stop.geometry.y)
+                                                    for stop in osm_bus_stops])
+        n = len(ActivityPattern.activities)
+        self.stop_counts = np.zeros((len(osm_bus_stops), n, n))
+        # Normalized pattern per bus stop, None without activity combinations.
+        self.stop_patterns = [None]*len(osm_bus_stops)
+        ########################################################################
+        # Activity point columns, grown as batches arrive. Rows are in arrival
+        # order, clusters are keyed by the lowest id of their core points.
+        self.size = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.previous_codes = np.zeros(0, dtype=np.intp)
+        self.current_codes = np.zeros(0, dtype=np.intp)
+        self.neighbour_counts = np.zeros(0, dtype=np.intp)
+        self.core = np.zeros(0, dtype=bool)
+        self.parent = np.zeros(0, dtype=np.intp)
+        self.assigned = np.zeros(0, dtype=np.intp)
+        self.seen_ids = set()
+        self.grid = {}
+        # Like detect_bus_stops_clustering_approach, the point with the highest
+        # id is not clustered; it joins as soon as a higher id arrives.
+        self.held_back = None
+        ########################################################################
+        # Union-find roots: core member rows, border member rows, lowest core id.
+        self.core_members = {}
+        self.border_members = {}
+        self.first_id = {}
+        # Per cluster key: pattern, similarities to the bus stop patterns (-inf
+        # for bus stops without one), centroid, snapped point, ids and bus stop.
+        self.clusters = {}
+        self.root_keys = {}
+
+    def __len__(self):
+        return self.size
+
+    ############################################################################
+    # Adds a batch of activity points (an ActivityPointStore projected to the
+    # routes' UTM zone, see create_activity_points). Returns a dict mapping the
+    # key of every cluster whose bus stop changed to its new bus stop, a
+    # (point_on_route, activity point ids) tuple, or None if it has none now.
+    def ingest(self, batch):
+        if len(batch) == 0:
+            return {}
+        if batch.utm_zone is not None and batch.utm_zone != self.utm_zone:
+            raise ValueError('Batch is not projected to the UTM zone of the routes!')
+        rows = self._append(batch)
+        changed_stops = self._count_around_bus_stops(rows)
+        candidates = rows.tolist()
+        if self.held_back is not None:
+            candidates.append(self.held_back)
+        self.held_back = max(candidates, key=lambda row: self.ids[row])
+        dirty_roots, vanished_roots = self._cluster([row for row in candidates
+                                                     if row != self.held_back])
+        return self._update_bus_stops(dirty_roots, vanished_roots, changed_stops)
+
+    ############################################################################
+    # Returns the current bus stops as detect_bus_stops_clustering_approach does.
+    def bus_stops(self):
+        return [info['bus_stop'] for info in self.clusters.values()
+                    if info['bus_stop'] is not None]
+
+    def _append(self, batch):
+        for id in batch.ids.tolist():
+            if id in self.seen_ids:
+                raise GeoJSONError('Duplicate feature id detected!')
+            self.seen_ids.add(id)
+        try:
+            codes = np.array([ActivityPattern.activities.index(label)
+                              for label in batch.activity_labels], dtype=np.intp)
+        except ValueError:
+            raise KeyError('Unknown activity in activity combinations!')
+        count = len(batch)
+        if self.size+count > len(self.ids):
+            self._grow(max(self.size+count, 2*len(self.ids)))
+        rows = np.arange(self.size, self.size+count)
+        self.ids[rows] = batch.ids
+        self.x[rows] = batch.x
+        self.y[rows] = batch.y
+        self.previous_codes[rows] = codes[batch.previous_dominating_activity]
+        self.current_codes[rows] = codes[batch.current_dominating_activity]
+        self.assigned[rows] = -1
+        self.size += count
+        return rows
+
+    def _grow(self, capacity):
+        for name in ('ids', 'x', 'y', 'previous_codes', 'current_codes',
+                     'neighbour_counts', 'core', 'parent', 'assigned'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    ############################################################################
+    # Adds the activity combinations of new rows to the bus stops whose pattern
+    # radius they are in. Returns the indices of the bus stops whose pattern
+    # changed.
+    def _count_around_bus_stops(self, rows):
+        changed = set()
+        if len(self.stop_index) == 0:
+            return changed
+        for row in rows:
+            stops = self.stop_index.query_buffers_containing(self.x[row], self.y[row],
+                                                             self.pattern_radius)
+            if len(stops) > 0:
+                self.stop_counts[stops, self.previous_codes[row], self.current_codes[row]] += 1
+                changed.update(stops)
+        for stop in changed:
+            pattern = ActivityPattern(self.stop_counts[stop])
+            if pattern.has_N_combinations_set(1):
+                pattern.normalize()
+                self.stop_patterns[stop] = pattern
+            else:
+                self.stop_patterns[stop] = None
+        return changed
+
+    ############################################################################
+    # DBSCAN bookkeeping. Neighbourhoods include the point itself and are found
+    # in a grid with cells of size epsilon.
+    def _cell(self, row):
+        return (int(math.floor(self.x[row]/self.epsilon)),
+                int(math.floor(self.y[row]/self.epsilon)))
+
+    def _neighbours(self, row):
+        (cx, cy) = self._cell(row)
+        candidates = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                candidates.extend(self.grid.get((cx+dx, cy+dy), ()))
+        candidates = np.array(candidates, dtype=np.intp)
+        dx = self.x[candidates]-self.x[row]
+        dy = self.y[candidates]-self.y[row]
+        return candidates[dx*dx+dy*dy <= self.epsilon*self.epsilon]
+
+    def _find(self, row):
+        root = row
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[row] != root:
+            (self.parent[row], row) = (root, self.parent[row])
+        return root
+
+    def _union(self, a, b, vanished_roots):
+        (a, b) = (self._find(a), self._find(b))
+        if a == b:
+            return a
+        if len(self.core_members[a]) < len(self.core_members[b]):
+            (a, b) = (b, a)
+        self.parent[b] = a
+        self.core_members[a].extend(self.core_members.pop(b))
+        self.border_members[a] |= self.border_members.pop(b)
+        self.first_id[a] = min(self.first_id[a], self.first_id.pop(b))
+        vanished_roots.add(b)
+        return a
+
+    ############################################################################
+    # Border points join the cluster with the lowest first core id among their
+    # core neighbours, like in sklearn's DBSCAN over rows sorted by id.
+    def _assign_border(self, row, dirty_roots):
+        roots = [self._find(n) for n in self._neighbours(row) if self.core[n]]
+        previous = self._find(self.assigned[row]) if self.assigned[row] >= 0 else None
+        best = min(roots, key=lambda root: self.first_id[root]) if roots else None
+        if best == previous:
+            return
+        if previous is not None:
+            self.border_members[previous].discard(row)
+            dirty_roots.add(previous)
+        if best is not None:
+            self.border_members[best].add(row)
+            dirty_roots.add(best)
+            self.assigned[row] = best
+        else:
+            self.assigned[row] = -1
+
+    ############################################################################
+    # Inserts rows into the clustering. Returns the roots of changed clusters
+    # and the roots merged into other clusters.
+    def _cluster(self, rows):
+        dirty_roots = set()
+        vanished_roots = set()
+        if len(rows) == 0:
+            return dirty_roots, vanished_roots
+        for row in rows:
+            self.grid.setdefault(self._cell(row), []).append(row)
+        new_rows = set(rows)
+        touched = set()
+        for row in rows:
+            neighbours = self._neighbours(row)
+            self.neighbour_counts[row] = len(neighbours)
+            for n in neighbours:
+                if n not in new_rows:
+                    self.neighbour_counts[n] += 1
+                    touched.add(n)
+        newly_core = [row for row in list(rows)+list(touched)
+                      if not self.core[row] and self.neighbour_counts[row] >= self.min_points]
+        ########################################################################
+        # New core points start clusters of their own and are merged with all
+        # core neighbours.
+        for row in newly_core:
+            if self.assigned[row] >= 0:
+                root = self._find(self.assigned[row])
+                self.border_members[root].discard(row)
+                dirty_roots.add(root)
+                self.assigned[row] = -1
+            self.core[row] = True
+            self.parent[row] = row
+            self.core_members[row] = [row]
+            self.border_members[row] = set()
+            self.first_id[row] = self.ids[row]
+        border_candidates = set(row for row in rows if not self.core[row])
+        first_ids = {}
+        for row in newly_core:
+            for n in self._neighbours(row):
+                if self.core[n]:
+                    root = self._find(n)
+                    first_ids.setdefault(root, self.first_id[root])
+                    self._union(row, n, vanished_roots)
+                else:
+                    border_candidates.add(n)
+        dirty_roots.update(self._find(row) for row in newly_core)
+        ########################################################################
+        # Clusters whose first core id dropped may win border points of others.
+        for (root, first_id) in first_ids.items():
+            root = self._find(root)
+            if self.first_id[root] < first_id:
+                for member in self.core_members[root]:
+                    border_candidates.update(n for n in self._neighbours(member)
+                                             if not self.core[n])
+        for row in border_candidates:
+            self._assign_border(row, dirty_roots)
+        dirty_roots = set(self._find(root) for root in dirty_roots)
+        return dirty_roots, vanished_roots
+
+    ############################################################################
+    # Recomputes pattern, centroid and similarities of the dirty clusters and
+    # the similarities of all other clusters to the patterns of the changed bus
+    # stops. Returns the bus stops that differ from the ones emitted before.
+    def _update_bus_stops(self, dirty_roots, vanished_roots, changed_stops):
+        previous_stops = {}
+        for root in vanished_roots | dirty_roots:
+            key = self.root_keys.pop(root, None)
+            if key is not None:
+                previous_stops[key] = self.clusters.pop(key)['bus_stop']
+        ########################################################################
+        # Clusters that were not rebuilt are compared against the changed
+        # patterns only. Their decision is recomputed if it may have flipped.
+        updated = []
+        columns = sorted(changed_stops)
+        if len(columns) > 0 and len(self.clusters) > 0:
+            unchanged_keys = self.clusters.keys()
+            self._set_similarities(unchanged_keys, columns)
+            updated.extend(key for key in unchanged_keys
+                           if self.clusters[key]['similar'] != self._is_similar(key))
+        for root in dirty_roots:
+            rows = np.array(self.core_members[root]+list(self.border_members[root]),
+                            dtype=np.intp)
+            rows = rows[np.argsort(self.ids[rows], kind='mergesort')]
+            pattern = ActivityPattern.from_codes(self.previous_codes[rows],
+                                                 self.current_codes[rows])
+            pattern.normalize()
+            key = int(self.first_id[root])
+            self.root_keys[root] = key
+            previous_stops.setdefault(key, None)
+            self.clusters[key] = {'pattern': pattern,
+                                  'similarities': np.empty(len(self.stop_patterns)),
+                                  'similar': False,
+                                  'centroid': MultiPoint(np.column_stack((self.x[rows],
+                                                                          self.y[rows]))).centroid,
+                                  'activity_points': self.ids[rows].tolist(),
+                                  'snapped': False,
+                                  'point_on_route': None,
+                                  'bus_stop': None}
+            updated.append(key)
+        self._set_similarities([self.root_keys[root] for root in dirty_roots],
+                               range(len(self.stop_patterns)))
+        similar_keys = []
+        for key in updated:
+            info = self.clusters[key]
+            previous_stops.setdefault(key, info['bus_stop'])
+            info['bus_stop'] = None
+            info['similar'] = self._is_similar(key)
+            if info['similar']:
+                similar_keys.append(key)
+        ########################################################################
+        # The centroid of an unchanged cluster is snapped to the routes once.
+        unsnapped_keys = [key for key in similar_keys if not self.clusters[key]['snapped']]
+        points_on_route = detect_bus_stops.snap_to_routes(
+                                [(self.clusters[key]['centroid'].x, self.clusters[key]['centroid'].y)
+                                    for key in unsnapped_keys],
+                                self.routes, self.route_index)[0]
+        for (key, point_on_route) in zip(unsnapped_keys, points_on_route):
+            self.clusters[key]['snapped'] = True
+            self.clusters[key]['point_on_route'] = point_on_route
+        for key in similar_keys:
+            info = self.clusters[key]
+            if info['point_on_route'] is not None:
+                info['bus_stop'] = (info['point_on_route'], info['activity_points'])
+        changes = {}
+        for (key, previous) in previous_stops.items():
+            current = self.clusters[key]['bus_stop'] if key in self.clusters else None
+            if not _same_bus_stop(previous, current):
+                changes[key] = current
+        return changes
+
+    ############################################################################
+    # Compares the patterns of the given clusters against the patterns of the
+    # given bus stops in one batch.
+    def _set_similarities(self, keys, stops):
+        if len(keys) == 0 or len(stops) == 0:
+            return
+        stops = np.asarray(stops, dtype=np.intp)
+        with_pattern = np.array([self.stop_patterns[stop] is not None for stop in stops],
+                                dtype=bool)
+        similarities = detect_bus_stops.get_similarity_matrix(
+                                [self.clusters[key]['pattern'] for key in keys],
+                                [self.stop_patterns[stop] for stop in stops[with_pattern]])
+        for (i, key) in enumerate(keys):
+            row = self.clusters[key]['similarities']
+            row[stops[with_pattern]] = similarities[i]
+            row[stops[~with_pattern]] = -np.inf
+
+    def _is_similar(self, key):
+        similarities = self.clusters[key]['similarities']
+        return len(similarities) > 0 and \
+               similarities.max() > detect_bus_stops.SIMILARITY_THRESHOLD
+
+def _same_bus_stop(stop, other):
+    if stop is None or other is None:
+        return stop is other
+    return stop[1] == other[1] and stop[0].coords[0] == other[0].coords[0]
@@ -0,0 +1,238 @@
+import cProfile
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+################################################################################
+# Instrumentation of the detection pipeline: wall time and peak memory per
+# stage, event counters and an optional profiler, reported per run as JSON.
+# It is disabled by default; then stage() returns a shared no-op context and
+# count() returns right away, so instrumented code runs at full speed.
+#
+# Usage:
+#   instrumentation.enable(profiler='cprofile')
+#   run = instrumentation.start_run('pipeline')
+#   with instrumentation.stage('loading'):
+#       ...
+#   instrumentation.count('clusters', len(clusters))
+#   instrumentation.finish_run(run, 'report.json')
+#
+# Stages and counts are recorded in all runs in progress, so a run around the
+# whole pipeline also covers the runs of the single detections in it. Stages may
+# nest (e.g. traversal_scoring includes pattern_extraction); repeated stages add
+# up their calls and wall time.
+
+# Whether stages and counts are recorded, see enable.
+_enabled = False
+# Profiler factory of the outermost run, see enable.
+_profiler_factory = None
+# Runs in progress, outermost first.
+_active_runs = []
+
+################################################################################
+# Enables recording. The profiler is None, 'cprofile' or a factory returning an
+# object with the enable(), disable() and dump_stats(filename) methods of a
+# cProfile.Profile, e.g. a wrapper around a sampling profiler. The outermost
+# run is profiled and its stats are dumped next to its report.
+def enable(profiler=None):
+    global _enabled, _profiler_factory
+    if profiler == 'cprofile':
+        profiler = cProfile.Profile
+    elif profiler is not None and not callable(profiler):
+        raise ValueError('Unknown profiler '+str(profiler)+'!')
+    _enabled = True
+    _profiler_factory = profiler
+
+def disable():
+    global _enabled, _profiler_factory
+    _enabled = False
+    _profiler_factory = None
+
+def enabled():
+    return _enabled
+
+# Whether a run is in progress, i.e. stages and counts are recorded.
+def recording():
+    return len(_active_runs) > 0
+
+################################################################################
+# Returns the process' peak resident memory so far in bytes (None if unknown).
+def peak_memory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    return peak if sys.platform == 'darwin' else peak*1024
+
+################################################################################
+# Record of a single run.
+class Run:
+
+    def __init__(self, name, parameters=None):
+        self.name = name
+        self.parameters = parameters or {}
+        self.started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.start_time = time.time()
+        self.wall_time = None
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.profiler = None
+
+    def add_stage(self, name, wall_time, memory_before, memory_after):
+        if name not in self.stages:
+            self.stages[name] = OrderedDict([('calls', 0), ('wall_time', 0.0),
+                                             ('peak_memory', None),
+                                             ('memory_growth', None)])
+        stage = self.stages[name]
+        stage['calls'] += 1
+        stage['wall_time'] += wall_time
+        if memory_after is not None:
+            stage['peak_memory'] = max(stage['peak_memory'], memory_after)
+            stage['memory_growth'] = (stage['memory_growth'] or 0)+memory_after-memory_before
+
+    def add_count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0)+value
+
+    ############################################################################
+    # Returns the report as an ordered dict. Peak memory is the process' high
+    # water mark at the end of a stage, memory growth how much the stage
+    # raised it.
+    def report(self):
+        report = OrderedDict()
+        report['name'] = self.name
+        report['parameters'] = self.parameters
+        report['started_at'] = self.started_at
+        report['wall_time'] = self.wall_time
+        report['peak_memory'] = peak_memory()
+        report['stages'] = self.stages
+        report['counters'] = self.counters
+        queries = self.counters.get('neighbour_queries', 0)
+        report['neighbours_per_query'] = (float(self.counters.get('neighbours', 0))/queries
+                                          if queries > 0 else None)
+        return report
+
+    ############################################################################
+    # Writes the report to filename and, if the run was profiled, the profiler
+    # stats to the same file name with extension .prof.
+    def write(self, filename):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        report = self.report()
+        if self.profiler is not None:
+            report['profile'] = os.path.splitext(filename)[0]+'.prof'
+            self.profiler.dump_stats(report['profile'])
+        with open(filename, 'w') as out:
+            json.dump(report, out, indent=2)
+
+################################################################################
+# Starts a run if recording is enabled and returns it (None otherwise).
+def start_run(name, parameters=None):
+    if not _enabled:
+        return None
+    run = Run(name, parameters)
+    if len(_active_runs) == 0 and _profiler_factory is not None:
+        run.profiler = _profiler_factory()
+        run.profiler.enable()
+    _active_runs.append(run)
+    return run
+
+################################################################################
+# Finishes a run from start_run and writes its report to report_file if given.
+def finish_run(run, report_file=None):
+    if run is None:
+        return
+    if run in _active_runs:
+        _active_runs.remove(run)
+    if run.profiler is not None:
+        run.profiler.disable()
+    run.wall_time = time.time()-run.start_time
+    if report_file is not None:
+        run.write(report_file)
+
+################################################################################
+# Decorator running every call of a function as a run named name. The plain
+# (number, string, boolean or None) arguments of the call are recorded as run
+# parameters; report_file is called with all arguments by name and returns the
+# file to write the report to (or None).
+def instrumented(name, report_file=None):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            arguments = inspect.getcallargs(function, *args, **kwargs)
+            parameters = OrderedDict((key, arguments[key]) for key in sorted(arguments)
+                                        if isinstance(arguments[key],
+                                                      (int, long, float, basestring, type(None))))
+            run = start_run(name, parameters)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                finish_run(run, None if report_file is None else report_file(arguments))
+        return wrapper
+    return decorate
+
+################################################################################
+# Context manager timing a stage of all runs in progress.
+class _Stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.memory_before = peak_memory()
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.time()-self.start_time
+        memory_after = peak_memory()
+        for run in _active_runs:
+            run.add_stage(self.name, wall_time, self.memory_before, memory_after)
+        return False
+
+class _NoStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NO_STAGE = _NoStage()
+
+def stage(name):
+    if not _active_runs:
+        return _NO_STAGE
+    return _Stage(name)
+
+################################################################################
+# Decorator timing every call of a function as a stage named name.
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _active_runs:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+################################################################################
+# Adds value to the counter name of all runs in progress.
+def count(name, value=1):
+    if not _active_runs:
+        return
+    for run in _active_runs:
+        run.add_count(name, value)
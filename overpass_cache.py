@@ -0,0 +1,47 @@
+import hashlib
+import json
+import os
+import time
+
+# Overpass interpreter used when no other endpoint is given.
+DEFAULT_ENDPOINT = 'http://overpass.osm.rambler.ru/cgi/interpreter'
+# Cached responses older than this (in seconds) are fetched again.
+DEFAULT_TTL = 30*24*3600
+
+################################################################################
+# Raised in offline mode if a query has no cached response.
+class OverpassCacheError(Exception):
+    pass
+
+################################################################################
+# Returns the cache file of a query. The query string holds both the bounding
+# box and the tag filter, so it serves as the cache key.
+def cache_file(query, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha1(query).hexdigest()+'.geojson')
+
+################################################################################
+# Sends a query to the Overpass API unless a cached response younger than ttl
+# exists in cache_dir. In offline mode, only cached responses (of any age) are
+# used. Returns the GeoJSON response and whether it came from the network.
+def get(query, cache_dir, endpoint=DEFAULT_ENDPOINT, ttl=DEFAULT_TTL, offline=False,
+        timeout=60):
+    filename = cache_file(query, cache_dir)
+    if os.path.exists(filename):
+        if offline or time.time()-os.path.getmtime(filename) < ttl:
+            with open(filename) as cached:
+                return json.load(cached), False
+    if offline:
+        raise OverpassCacheError('No cached Overpass response for query '+query+
+                                 ' (offline mode)!')
+    # overpass (and requests) are only imported when the network is used.
+    import overpass
+    osm = overpass.API(endpoint=endpoint, timeout=timeout)
+    response = json.loads(json.dumps(osm.Get(query)))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first so that readers never see partial files.
+    temporary_filename = filename+'.'+str(os.getpid())+'.tmp'
+    with open(temporary_filename, 'w') as out:
+        json.dump(response, out)
+    os.rename(temporary_filename, filename)
+    return response, True
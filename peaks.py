@@ -0,0 +1,113 @@
+import time
+
+import numpy as np
+
+################################################################################
+# Peak engines of the traversing approach. An engine takes the step score 
+# sequences of all routes and returns the indices of the local score peaks of
+# each sequence. scipy.signal is imported by the engines when they run, not
+# with this module.
+
+# Wavelet widths of the cwt engine.
+CWT_WIDTHS = np.arange(1,20)
+
+################################################################################
+# Continuous wavelet transform and ridge line search of find_peaks_cwt, run on
+# each sequence separately. Empty sequences (routes shorter than a step) have
+# no peaks.
+def cwt_peaks(sequences, widths=CWT_WIDTHS):
+    from scipy import signal
+    return [np.asarray(signal.find_peaks_cwt(np.asarray(sequence, dtype=float), widths)
+                           if len(sequence) > 0 else [],
+                       dtype=np.intp) for sequence in sequences]
+
+################################################################################
+# Gaussian smoothing (sigma in steps, none if 0) followed by find_peaks with a
+# minimum prominence and a minimum distance in steps. All sequences are 
+# processed at once: they are laid out in one array, separated by runs of zeros
+# wide enough that neither the smoothing nor the distance criterion reaches
+# from one sequence into the next.
+def smoothed_peaks(sequences, sigma=2.0, prominence=0.5, distance=3):
+    from scipy import signal
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.intp)
+    if len(lengths) == 0:
+        return []
+    radius = int(np.ceil(4*sigma))
+    gap = 2*radius+int(distance)+1
+    starts = np.concatenate(([0], np.cumsum(lengths+gap)[:-1]))
+    combined = np.zeros(starts[-1]+lengths[-1]+gap)
+    for (start, sequence) in zip(starts, sequences):
+        combined[start:start+len(sequence)] = sequence
+    if sigma > 0:
+        kernel = np.exp(-0.5*(np.arange(-radius, radius+1)/float(sigma))**2)
+        combined = np.convolve(combined, kernel/kernel.sum(), mode='same')
+    (found, _) = signal.find_peaks(combined, prominence=prominence, distance=distance)
+    sequence_ids = np.searchsorted(starts, found, side='right')-1
+    positions = found-starts[sequence_ids]
+    inside = positions < lengths[sequence_ids]
+    (sequence_ids, positions) = (sequence_ids[inside], positions[inside])
+    bounds = np.searchsorted(sequence_ids, np.arange(len(lengths)+1))
+    return [positions[bounds[i]:bounds[i+1]] for i in xrange(len(lengths))]
+
+ENGINES = {
+            'cwt': cwt_peaks,
+            'smoothed': smoothed_peaks
+          }
+
+################################################################################
+# Returns the peaks of each sequence found by the named engine, called with the
+# given engine specific options.
+def find_peaks(sequences, engine='cwt', **options):
+    if engine not in ENGINES:
+        raise ValueError('Unknown peak engine '+str(engine)+'!')
+    return ENGINES[engine](sequences, **options)
+
+################################################################################
+# Compares the peaks of an engine with the ones of a reference engine. Like in
+# the traversing approach, only peaks with a score above min_score count. Peaks
+# match one-to-one if they are at most tolerance steps apart, closest pairs 
+# first. Returns a dict with peak and match counts, precision and recall of the
+# engine with respect to the reference, the mean offset of matched peaks in 
+# steps, and the run times of both engines in seconds.
+def compare(sequences, engine='smoothed', reference='cwt', tolerance=2, min_score=0.0,
+            options=None, reference_options=None):
+    start = time.time()
+    reference_peaks = find_peaks(sequences, reference, **(reference_options or {}))
+    reference_time = time.time()-start
+    start = time.time()
+    engine_peaks = find_peaks(sequences, engine, **(options or {}))
+    engine_time = time.time()-start
+    reference_count = 0
+    engine_count = 0
+    offsets = []
+    for (sequence, expected, found) in zip(sequences, reference_peaks, engine_peaks):
+        sequence = np.asarray(sequence, dtype=float)
+        expected = np.asarray(expected, dtype=np.intp)
+        found = np.asarray(found, dtype=np.intp)
+        expected = expected[sequence[expected] > min_score]
+        found = found[sequence[found] > min_score]
+        reference_count += len(expected)
+        engine_count += len(found)
+        distances = np.abs(expected[:,np.newaxis]-found[np.newaxis,:])
+        (pairs_expected, pairs_found) = np.where(distances <= tolerance)
+        order = np.argsort(distances[pairs_expected, pairs_found], kind='mergesort')
+        used_expected = set()
+        used_found = set()
+        for k in order:
+            (i, j) = (pairs_expected[k], pairs_found[k])
+            if i not in used_expected and j not in used_found:
+                used_expected.add(i)
+                used_found.add(j)
+                offsets.append(distances[i,j])
+    matched = len(offsets)
+    return {
+            'sequences': len(sequences),
+            'reference_peaks': reference_count,
+            'engine_peaks': engine_count,
+            'matched': matched,
+            'precision': matched/float(engine_count) if engine_count > 0 else 0.0,
+            'recall': matched/float(reference_count) if reference_count > 0 else 0.0,
+            'mean_offset': float(np.mean(offsets)) if matched > 0 else 0.0,
+            'reference_time': reference_time,
+            'engine_time': engine_time
+           }
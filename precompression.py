@@ -0,0 +1,65 @@
+import gzip
+import os
+from cStringIO import StringIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+################################################################################
+# Compressed copies of result files for the result server (start_webserver.py).
+# A file is stored next to the original with the extension of its encoding
+# appended (e.g. routes.geojson.gz); a copy is only used while it is at least as
+# new as the original. Brotli is used if the brotli package is installed.
+
+# File extension per content encoding, preferred encoding first.
+EXTENSIONS = [('br', '.br'), ('gzip', '.gz')]
+
+################################################################################
+# Returns the encodings this installation can produce, preferred first.
+def available_encodings():
+    return [encoding for (encoding, extension) in EXTENSIONS
+                if encoding != 'br' or brotli is not None]
+
+################################################################################
+# Returns data compressed with the given content encoding. The level is the
+# gzip level (1-9) or the brotli quality (0-11); gzip output does not depend on
+# the time, so equal data yields equal files.
+def compress(data, encoding, level=9):
+    if encoding == 'gzip':
+        buffer = StringIO()
+        compressed = gzip.GzipFile(filename='', mode='wb', compresslevel=level,
+                                   fileobj=buffer, mtime=0)
+        compressed.write(data)
+        compressed.close()
+        return buffer.getvalue()
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=min(level, 11))
+    raise ValueError('Unsupported content encoding '+str(encoding)+'!')
+
+################################################################################
+# Returns the compressed copy of filename in the given encoding.
+def compressed_file(filename, encoding):
+    return filename+dict(EXTENSIONS)[encoding]
+
+################################################################################
+# Returns whether the compressed copy of filename in the given encoding exists
+# and is up to date.
+def is_fresh(filename, encoding):
+    copy = compressed_file(filename, encoding)
+    return os.path.exists(copy) and os.path.getmtime(copy) >= os.path.getmtime(filename)
+
+################################################################################
+# Writes compressed copies of filename in all available encodings.
+def precompress(filename):
+    with open(filename, 'rb') as original:
+        data = original.read()
+    for encoding in available_encodings():
+        copy = compressed_file(filename, encoding)
+        # Write to a temporary file first so that the server never sees partial
+        # files.
+        temporary_filename = copy+'.'+str(os.getpid())+'.tmp'
+        with open(temporary_filename, 'wb') as out:
+            out.write(compress(data, encoding))
+        os.rename(temporary_filename, copy)
@@ -0,0 +1,55 @@
+import numpy as np
+import utm
+
+# Offset of northings in the southern hemisphere.
+FALSE_NORTHING = 10000000.0
+
+################################################################################
+# Returns the UTM zone (number, letter) of a WGS84 coordinate.
+def utm_zone(longitude, latitude):
+    return (utm.latlon_to_zone_number(latitude, longitude),
+            utm.latitude_to_zone_letter(latitude))
+
+################################################################################
+# Projects arrays of WGS84 coordinates to UTM in one vectorized call. All points
+# are projected into one zone, by default the zone of the first point, so that
+# the results form one metric coordinate system. Within that zone the results
+# are identical to projecting each point with utm.from_latlon.
+# Returns (eastings, northings, (zone_number, zone_letter)).
+def to_utm(longitudes, latitudes, zone=None):
+    longitudes = np.asarray(longitudes, dtype=np.float64).ravel()
+    latitudes = np.asarray(latitudes, dtype=np.float64).ravel()
+    eastings = np.zeros(len(longitudes))
+    northings = np.zeros(len(longitudes))
+    if len(longitudes) == 0:
+        return eastings, northings, zone
+    if zone is None:
+        zone = utm_zone(longitudes[0], latitudes[0])
+    # utm refuses arrays crossing the equator, so both hemispheres are projected
+    # separately and then shifted to the false northing of the target zone.
+    southern = latitudes < 0
+    for hemisphere in (southern, ~southern):
+        if not hemisphere.any():
+            continue
+        result = utm.from_latlon(latitudes[hemisphere], longitudes[hemisphere],
+                                 force_zone_number=zone[0])
+        eastings[hemisphere] = result[0]
+        northings[hemisphere] = result[1]
+    if zone[1] >= 'N':
+        northings[southern] -= FALSE_NORTHING
+    else:
+        northings[~southern] += FALSE_NORTHING
+    return eastings, northings, zone
+
+################################################################################
+# Transforms arrays of UTM coordinates of the given zone back to WGS84.
+# Returns (longitudes, latitudes).
+def to_lonlat(eastings, northings, zone):
+    # Copies, because utm shifts southern northings in place.
+    eastings = np.array(eastings, dtype=np.float64).ravel()
+    northings = np.array(northings, dtype=np.float64).ravel()
+    if len(eastings) == 0:
+        return np.zeros(0), np.zeros(0)
+    latitudes, longitudes = utm.to_latlon(eastings, northings, zone[0], zone[1],
+                                          strict=False)
+    return longitudes, latitudes
@@ -0,0 +1,62 @@
+import atexit
+import cPickle as pickle
+import multiprocessing
+import os
+import traceback
+
+################################################################################
+# Renders charts to image files in a background process, so that the process
+# submitting them neither imports matplotlib nor waits for the rendering. Jobs
+# name a render_* function of the charting module and its arguments, which have
+# to be picklable.
+class BackgroundRenderer:
+
+    def __init__(self):
+        self.jobs = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_render_jobs, args=(self.jobs,))
+        self.process.start()
+
+    def submit(self, function_name, *args):
+        # Pickle right away: the queue would do it later in a feeder thread,
+        # while the caller may already modify the arguments.
+        self.jobs.put(pickle.dumps((function_name, args), pickle.HIGHEST_PROTOCOL))
+
+    ############################################################################
+    # Waits until all submitted charts are rendered and stops the process.
+    def close(self):
+        if self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+
+def _render_jobs(jobs):
+    import matplotlib
+    matplotlib.use('Agg')
+    import charting
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        (function_name, args) = pickle.loads(job)
+        try:
+            getattr(charting, function_name)(*args)
+        except Exception:
+            traceback.print_exc()
+
+################################################################################
+# Shared renderer, started on first use and closed at exit.
+_renderer = None
+
+def render(function_name, *args):
+    global _renderer
+    if _renderer is None:
+        _renderer = BackgroundRenderer()
+        atexit.register(_renderer.close)
+    _renderer.submit(function_name, *args)
+
+################################################################################
+# Returns the path of an image file named after a chart title in directory.
+def image_file(directory, title):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = ''.join(c if c.isalnum() else '_' for c in title.lower()).strip('_')
+    return os.path.join(directory, name+'.png')
@@ -0,0 +1,130 @@
+import hashlib
+import os
+
+import numpy as np
+
+################################################################################
+# Raster of traversal scores (see detect_bus_stops.score_steps) on the nodes of
+# a square grid with cells of cell_size meters, anchored at the UTM origin.
+# Scores at arbitrary points are bilinear samples of the four surrounding nodes,
+# so a step costs a lookup instead of a neighbour search. Only nodes around the
+# routes are computed up front (cover_lines), other nodes are computed when
+# first needed; they are kept sparse, sorted by node key.
+# A raster depends on the activity points, their weights, the activity radius
+# and the cell size only, so it can be saved and reused for any step length and
+# DBSCAN epsilon.
+class ScoreRaster:
+
+    def __init__(self, score_function, fingerprint, cell_size=10.0):
+        self.score_function = score_function
+        self.fingerprint = fingerprint
+        self.cell_size = float(cell_size)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0)
+        self.modified = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    ############################################################################
+    # Computes the nodes of all cells the given lines (arrays of vertex
+    # coordinates) pass through.
+    def cover_lines(self, lines):
+        samples = [np.zeros((0, 2))]
+        for coordinates in lines:
+            coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+            deltas = coordinates[1:]-coordinates[:-1]
+            lengths = np.sqrt(deltas[:,0]*deltas[:,0]+deltas[:,1]*deltas[:,1])
+            counts = np.ceil(2*lengths/self.cell_size).astype(np.intp)+1
+            segments = np.repeat(np.arange(len(lengths)), counts)
+            fractions = (np.arange(len(segments))-np.repeat(np.cumsum(counts)-counts, counts))/ \
+                        np.maximum(counts-1, 1)[segments].astype(float)
+            samples.append(coordinates[segments]+fractions[:,np.newaxis]*deltas[segments])
+        self._corners(np.concatenate(samples))
+
+    ############################################################################
+    # Returns the bilinearly interpolated scores at the given points.
+    def sample(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(points) == 0:
+            return np.zeros(0)
+        (columns, rows, corner_values) = self._corners(points)
+        u = points[:,0]/self.cell_size-columns
+        v = points[:,1]/self.cell_size-rows
+        return (corner_values[:,0]*(1-u)*(1-v)+corner_values[:,1]*u*(1-v)+
+                corner_values[:,2]*(1-u)*v+corner_values[:,3]*u*v)
+
+    ############################################################################
+    # Returns the lower left node of the cell of every point and the values of
+    # the cell's four nodes, computing missing nodes first.
+    def _corners(self, points):
+        columns = np.floor(points[:,0]/self.cell_size).astype(np.int64)
+        rows = np.floor(points[:,1]/self.cell_size).astype(np.int64)
+        corner_columns = np.column_stack((columns, columns+1, columns, columns+1))
+        corner_rows = np.column_stack((rows, rows, rows+1, rows+1))
+        keys = _node_keys(corner_columns, corner_rows)
+        self._fill(np.unique(keys))
+        return columns, rows, self.values[np.searchsorted(self.keys, keys)]
+
+    def _fill(self, keys):
+        positions = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys)-1, 0))
+        if len(self.keys) > 0:
+            keys = keys[self.keys[positions] != keys]
+        if len(keys) == 0:
+            return
+        (columns, rows) = _node_indices(keys)
+        values = self.score_function(np.column_stack((columns*self.cell_size,
+                                                      rows*self.cell_size)))
+        all_keys = np.concatenate((self.keys, keys))
+        order = np.argsort(all_keys, kind='mergesort')
+        self.keys = all_keys[order]
+        self.values = np.concatenate((self.values, values))[order]
+        self.modified = True
+
+    ############################################################################
+    # Saves the computed nodes, see load.
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary_filename = filename+'.'+str(os.getpid())+'.tmp.npz'
+        np.savez(temporary_filename, keys=self.keys, values=self.values,
+                 cell_size=self.cell_size, fingerprint=np.array(self.fingerprint))
+        os.rename(temporary_filename, filename)
+        self.modified = False
+
+    ############################################################################
+    # Loads the nodes saved in filename into the raster if they were computed
+    # for the same fingerprint and cell size. Returns whether they were.
+    def load(self, filename):
+        if not os.path.exists(filename):
+            return False
+        saved = np.load(filename)
+        try:
+            if str(saved['fingerprint']) != self.fingerprint or \
+                    float(saved['cell_size']) != self.cell_size:
+                return False
+            self.keys = saved['keys']
+            self.values = saved['values']
+        finally:
+            saved.close()
+        self.modified = False
+        return True
+
+################################################################################
+# Returns the fingerprint of the inputs a raster depends on.
+def fingerprint(coordinates, weights, activity_radius):
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(coordinates, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(weights, dtype=np.float64).tobytes())
+    digest.update(repr(float(activity_radius)))
+    return digest.hexdigest()
+
+# Node keys pack the column into the high and the row into the low 32 bits.
+_ROW_OFFSET = 2**31
+
+def _node_keys(columns, rows):
+    return (columns << 32) | (rows+_ROW_OFFSET)
+
+def _node_indices(keys):
+    return keys >> 32, (keys & 0xffffffff)-_ROW_OFFSET
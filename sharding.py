@@ -0,0 +1,671 @@
+################################################################################
+# Sharded detection for datasets spanning several cities, UTM zones or whole
+# countries. The pipeline
+# 1. fills the activity gaps of the activity points if their activities are
+#    consistent with their ids, decided over the whole dataset (see
+#    ActivityGapFills), and partitions the activity points with the filled
+#    activities, routes and (optionally) known bus stops into square tiles of
+#    TILE_SIZE degrees. Every tile also gets the features within a halo
+#    around it, as wide as the largest search radius of the detection
+#    parameters or the distance centroids are snapped to routes from, so
+#    detections near the tile border see the same neighbourhood as inside.
+#    The features are written to one newline-delimited GeoJSON file per tile
+#    and layer (see geojson_stream.py), so the input is never held in memory
+#    as a whole; only the activities of all points and the steps of the
+#    traversing approach along the whole routes are,
+# 2. derives the references of the approaches from the known bus stops of the
+#    whole dataset: every tile extracts the activity patterns and combinations
+#    around the bus stops inside it, and these are collected for all tiles,
+# 3. runs the approaches on every tile on a process pool, projected to the UTM
+#    zone of the tile's median activity point and compared against the
+#    references of the whole dataset. The clustering approach keeps the bus
+#    stops whose cluster centroid lies inside the tile (without the halo); the
+#    traversing approach scores the steps inside the tile,
+# 4. merges bus stops of the clustering approach of neighbouring tiles that are
+#    less than merge_distance apart, so a stop at a tile border is reported
+#    once, and finds and clusters the score peaks of the traversing approach
+#    along the whole routes.
+#
+# The results are the ones of running the approaches over the whole dataset at
+# once, as long as it lies in one UTM zone and no DBSCAN cluster of the
+# clustering approach chains further than the halo beyond its tile; such a
+# cluster is split into the parts the tiles see.
+#
+# Without a bus stops file, the known bus stops of every tile are queried from
+# OSM (see detect_bus_stops.query_osm_bus_stops and the OVERPASS_* settings).
+# The clustering approach clusters without standardization (dbscan_eps in
+# meters), which, unlike standardized clustering, does not depend on the tile.
+# Activity point ids have to be unique within every tile.
+################################################################################
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+from shapely.geometry import LineString, box
+
+import detect_bus_stops
+import geojson_stream
+import peaks
+import projection
+from detect_bus_stops import ActivityPointStore
+
+# Edge length of a tile in degrees.
+TILE_SIZE = 0.25
+# Bus stops of different tiles closer than this (in meters) are merged.
+MERGE_DISTANCE = 50.0
+METERS_PER_DEGREE = 111320.0
+EARTH_RADIUS = 6371008.8
+# Number of feature lines buffered in memory before they are appended to the
+# tile files.
+BUFFERED_LINES = 100000
+# Number of routes whose score peaks are found in one task.
+PEAK_CHUNK_SIZE = 1000
+# Parameters that are search radii and thus determine the halo, besides the
+# distance of the routes cluster centroids are snapped to.
+RADIUS_PARAMETERS = ['pattern_radius', 'dbscan_eps', 'activity_radius']
+# Property of the activity points in the tile files with their enhanced
+# activities, see ActivityGapFills.
+FILLED_ACTIVITIES = 'filled_activities'
+
+################################################################################
+# Returns the (column, row) of the tile containing a coordinate.
+def tile_of(longitude, latitude, tile_size=TILE_SIZE):
+    return int(math.floor(longitude/tile_size)), int(math.floor(latitude/tile_size))
+
+################################################################################
+# Returns the bounds (min lon, min lat, max lon, max lat) of a tile.
+def tile_bounds(tile, tile_size=TILE_SIZE):
+    return (tile[0]*tile_size, tile[1]*tile_size, (tile[0]+1)*tile_size, (tile[1]+1)*tile_size)
+
+################################################################################
+# Returns the bounds extended by halo meters in every direction. A degree of
+# longitude is shortest at the latitude farthest from the equator, so the
+# longitude halo is measured there.
+def extend_bounds(bounds, halo):
+    (min_lon, min_lat, max_lon, max_lat) = bounds
+    halo_lat = halo/METERS_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(min(max(abs(min_lat), abs(max_lat))+halo_lat, 89.0))),
+                  0.01)
+    halo_lon = halo/(METERS_PER_DEGREE*cos_lat)
+    return (min_lon-halo_lon, min_lat-halo_lat, max_lon+halo_lon, max_lat+halo_lat)
+
+################################################################################
+# Returns the tiles whose halo of halo meters overlaps the bounds (min lon,
+# min lat, max lon, max lat).
+def tiles_around(bounds, halo, tile_size=TILE_SIZE):
+    (min_lon, min_lat, max_lon, max_lat) = extend_bounds(bounds, halo)
+    (first_column, first_row) = tile_of(min_lon, min_lat, tile_size)
+    (last_column, last_row) = tile_of(max_lon, max_lat, tile_size)
+    return [(column, row) for column in xrange(first_column, last_column+1)
+                          for row in xrange(first_row, last_row+1)]
+
+################################################################################
+# Returns the halo width for the given approach parameters (see
+# detect_bus_stops.APPROACH_PARAMETERS): the largest search radius, and at least
+# detect_bus_stops.MAX_PROJECTION_DISTANCE so that the routes a centroid inside
+# the tile can be snapped to are not clipped away. DBSCAN clusters are not
+# bounded by dbscan_eps; one chaining further than the halo is split.
+def halo_width(parameters):
+    return max([float(detect_bus_stops.MAX_PROJECTION_DISTANCE)]+
+               [float(values[name]) for values in parameters.values()
+                                    for name in RADIUS_PARAMETERS if name in values])
+
+################################################################################
+# Returns the parameters of each approach, the defaults updated with the given
+# ones.
+def approach_parameters(parameters=None):
+    merged = OrderedDict()
+    for (approach, defaults) in sorted(detect_bus_stops.APPROACH_PARAMETERS.items()):
+        merged[approach] = OrderedDict(defaults)
+        merged[approach].update((parameters or {}).get(approach, {}))
+    return merged
+
+################################################################################
+# Appends features to newline-delimited GeoJSON files per tile, buffered so
+# that only few files are open at a time.
+class TileWriter:
+
+    def __init__(self, directory, layer):
+        self.directory = directory
+        self.layer = layer
+        self.lines = {}
+        self.line_count = 0
+        self.tiles = set()
+
+    def filename(self, tile):
+        return tile_file(self.directory, tile, self.layer)
+
+    def add(self, tile, line):
+        self.lines.setdefault(tile, []).append(line)
+        self.tiles.add(tile)
+        self.line_count += 1
+        if self.line_count >= BUFFERED_LINES:
+            self.flush()
+
+    def flush(self):
+        for (tile, lines) in self.lines.items():
+            with open(self.filename(tile), 'ab') as out:
+                out.write('\n'.join(lines)+'\n')
+        self.lines = {}
+        self.line_count = 0
+
+def tile_file(directory, tile, layer):
+    return os.path.join(directory, '%d_%d_%s.ndjson' % (tile[0], tile[1], layer))
+
+def _feature_line(properties, geometry_type, coordinates):
+    return json.dumps({'type': 'Feature', 'properties': properties,
+                       'geometry': {'type': geometry_type, 'coordinates': coordinates}},
+                      separators=(',', ':'))
+
+################################################################################
+# Decides over the activity points of all given files whether their activities
+# are consistent with their ids and, if so, fills the activity gaps like
+# ActivityPointStore.fill_activity_gaps, so that every tile is enhanced like
+# the whole dataset. Only the ids, activities and activity confidences of all
+# points are held in memory while deciding, and only the filled points are kept.
+class ActivityGapFills:
+
+    activity_properties = ['previous_dominating_activity', 'current_dominating_activity']
+    confidence_properties = ['previous_dominating_activity_confidence',
+                             'current_dominating_activity_confidence']
+
+    def __init__(self, filenames):
+        self.labels = [None]
+        chunks = dict((name, []) for name in ['ids']+self.activity_properties+
+                                             self.confidence_properties)
+        for filename in filenames:
+            for features in geojson_stream.iter_feature_chunks(filename):
+                properties = [feature.properties for feature in features]
+                chunks['ids'].append(np.array([p['id'] for p in properties], dtype=np.int64))
+                for name in self.activity_properties:
+                    chunks[name].append(np.array([self._code(p[name]) for p in properties],
+                                                 dtype=np.int8))
+                for name in self.confidence_properties:
+                    chunks[name].append(np.array([np.nan if p[name] is None else p[name]
+                                                  for p in properties], dtype=np.float64))
+        columns = dict((name, np.concatenate([np.zeros(0, dtype=arrays[0].dtype if arrays
+                                                                   else np.float64)]+arrays))
+                       for (name, arrays) in chunks.items())
+        order = np.argsort(columns['ids'], kind='mergesort')
+        ids = columns['ids'][order].astype(np.int64)
+        (previous, current) = [columns[name][order].astype(np.int8)
+                               for name in self.activity_properties]
+        (previous_confidence, current_confidence) = [columns[name][order]
+                                                     for name in self.confidence_properties]
+        ########################################################################
+        # Same rules as ActivityPointStore.is_consistent and fill_activity_gaps.
+        rows = np.where(ids[1:] == ids[:-1]+1)[0]
+        next_rows = rows+1
+        self.consistent = not np.any((current[rows] != 0) & (previous[next_rows] != 0) &
+                                     (current[rows] != previous[next_rows]))
+        filled = np.zeros(len(ids), dtype=bool)
+        if self.consistent:
+            fill_previous = (previous[next_rows] == 0) & (current[rows] != 0)
+            fill_current = (current[rows] == 0) & (previous[next_rows] != 0)
+            (targets, sources) = (next_rows[fill_previous], rows[fill_previous])
+            previous[targets] = current[sources]
+            previous_confidence[targets] = current_confidence[sources]
+            filled[targets] = True
+            (targets, sources) = (rows[fill_current], next_rows[fill_current])
+            current[targets] = previous[sources]
+            current_confidence[targets] = previous_confidence[sources]
+            filled[targets] = True
+        self.ids = ids[filled]
+        self.activities = (previous[filled], current[filled])
+        self.confidences = (previous_confidence[filled], current_confidence[filled])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _code(self, activity):
+        if activity not in self.labels:
+            self.labels.append(activity)
+        return self.labels.index(activity)
+
+    ############################################################################
+    # Returns the enhanced activity properties of the point with the given id,
+    # or None if none of its activities were filled.
+    def properties(self, id):
+        if id is None or len(self.ids) == 0:
+            return None
+        row = np.searchsorted(self.ids, id)
+        if row == len(self.ids) or self.ids[row] != id:
+            return None
+        properties = {}
+        for (name, codes) in zip(self.activity_properties, self.activities):
+            properties[name] = self.labels[codes[row]]
+        for (name, confidences) in zip(self.confidence_properties, self.confidences):
+            properties[name] = None if np.isnan(confidences[row]) else float(confidences[row])
+        return properties
+
+################################################################################
+# Writes the features of the given files (GeoJSON or newline-delimited GeoJSON)
+# to the files of the tiles they reach with halo (see TileWriter). Points go to
+# the tiles around them, with the enhanced activities of gap_fills (see
+# ActivityGapFills) in their FILLED_ACTIVITIES property. Lines are clipped to
+# every tile with its halo, so that a tile only snaps to the parts of the
+# routes near it; a line leaving and entering a tile again becomes several
+# lines. Returns the tiles written to.
+def partition(filenames, directory, layer, halo, tile_size=TILE_SIZE, gap_fills=None):
+    writer = TileWriter(directory, layer)
+    for filename in filenames:
+        for feature in geojson_stream.iter_features(filename):
+            coordinates = np.asarray(feature.geometry.coordinates, dtype=float).reshape(-1, 2)
+            if len(coordinates) == 0:
+                continue
+            bounds = tuple(coordinates.min(axis=0))+tuple(coordinates.max(axis=0))
+            tiles = tiles_around(bounds, halo, tile_size)
+            if feature.geometry.type != 'LineString':
+                properties = feature.properties
+                filled = gap_fills.properties(properties.get('id')) if gap_fills else None
+                if filled is not None:
+                    properties = dict(properties)
+                    properties[FILLED_ACTIVITIES] = filled
+                line = _feature_line(properties, feature.geometry.type,
+                                     feature.geometry.coordinates)
+                for tile in tiles:
+                    writer.add(tile, line)
+                continue
+            geometry = LineString(coordinates)
+            for tile in tiles:
+                clipped = geometry.intersection(box(*extend_bounds(tile_bounds(tile, tile_size),
+                                                                   halo)))
+                pieces = getattr(clipped, 'geoms', [clipped])
+                for piece in pieces:
+                    if piece.geom_type == 'LineString' and not piece.is_empty:
+                        writer.add(tile, _feature_line(feature.properties, 'LineString',
+                                                       [list(c) for c in piece.coords]))
+    writer.flush()
+    return writer.tiles
+
+################################################################################
+# Returns the activity points of a tile and its halo, projected to the UTM zone
+# of the median activity point, with the activities filled over the whole
+# dataset (see partition).
+def _load_tile_points(directory, tile):
+    filled = []
+    def chunks():
+        for features in geojson_stream.iter_feature_chunks(tile_file(directory, tile, 'points')):
+            filled.extend((feature.properties['id'], feature.properties[FILLED_ACTIVITIES])
+                          for feature in features if FILLED_ACTIVITIES in feature.properties)
+            yield features
+    activity_points = ActivityPointStore.from_feature_chunks(chunks())
+    utm_zone = projection.utm_zone(np.median(activity_points.longitude),
+                                   np.median(activity_points.latitude))
+    if utm_zone != activity_points.utm_zone:
+        (activity_points.x, activity_points.y, activity_points.utm_zone) = \
+                projection.to_utm(activity_points.longitude, activity_points.latitude, utm_zone)
+    if len(filled) > 0:
+        rows = np.searchsorted(activity_points.ids, [id for (id, properties) in filled])
+        for name in ActivityGapFills.activity_properties:
+            getattr(activity_points, name)[rows] = [
+                    activity_points.encode_activity(properties[name])
+                    for (id, properties) in filled]
+        for name in ActivityGapFills.confidence_properties:
+            getattr(activity_points, name)[rows] = [np.nan if properties[name] is None
+                                                        else properties[name]
+                                                    for (id, properties) in filled]
+    return activity_points
+
+################################################################################
+# Returns the (longitude, latitude) coordinates of the known bus stops of a tile
+# and its halo, from the bus stops files or from OSM.
+def _load_tile_stops(directory, tile, tile_size, parameters, has_bus_stops):
+    if has_bus_stops:
+        stops_file = tile_file(directory, tile, 'stops')
+        if not os.path.exists(stops_file):
+            return []
+        return [feature.geometry.coordinates[:2]
+                for feature in geojson_stream.iter_features(stops_file)]
+    (min_lon, min_lat, max_lon, max_lat) = extend_bounds(tile_bounds(tile, tile_size),
+                                                         halo_width(parameters))
+    (response, _) = detect_bus_stops.query_osm_bus_stops((min_lat, min_lon, max_lat, max_lon))
+    return [feature['geometry']['coordinates'][:2] for feature in response['features']]
+
+################################################################################
+# Extracts the references of the approaches around the known bus stops inside a
+# tile: the activity patterns of the clustering approach and the activity
+# combination counts of the traversing approach, along with the highest
+# activity point id of the tile. Runs in the worker processes, see
+# detect_sharded.
+def _tile_references(task):
+    (tile, directory, tile_size, parameters, has_bus_stops) = task
+    coordinates = [(longitude, latitude) for (longitude, latitude)
+                   in _load_tile_stops(directory, tile, tile_size, parameters, has_bus_stops)
+                   if tile_of(longitude, latitude, tile_size) == tile]
+    activity_points = _load_tile_points(directory, tile)
+    last_id = int(activity_points.ids[-1])
+    if len(coordinates) == 0:
+        return [], {}, last_id
+    osm_bus_stops = detect_bus_stops.create_bus_stops(coordinates, activity_points.utm_zone)
+    index = detect_bus_stops.create_activity_point_index(activity_points)
+    patterns = []
+    combinations = {}
+    if 'clustering' in parameters:
+        patterns = detect_bus_stops.extract_activity_pattern_around_bus_stops(
+                        osm_bus_stops, activity_points, parameters['clustering']['pattern_radius'],
+                        min_combinations=1, index=index)
+    if 'traversing' in parameters:
+        combinations = detect_bus_stops.extract_activity_combinations_around_bus_stops(
+                            osm_bus_stops, activity_points,
+                            radius=parameters['traversing']['activity_radius'], index=index)
+    return patterns, dict(combinations), last_id
+
+################################################################################
+# Detects the bus stops of the clustering approach in a tile and scores the
+# steps of the traversing approach inside it, compared against the references
+# of the whole dataset (see _tile_references). Runs in the worker processes,
+# see detect_sharded. Returns the bus stops whose cluster centroid is inside the
+# tile as (longitude, latitude, properties, weight) tuples, where the weight
+# decides which of two merged stops is kept, and the scores of the steps.
+def _detect_tile(task):
+    (tile, directory, tile_size, parameters,
+     (bus_stop_patterns, bus_stop_combinations, last_id), step_coordinates) = task
+    routes_file = tile_file(directory, tile, 'routes')
+    run_clustering = 'clustering' in parameters and os.path.exists(routes_file)
+    if not run_clustering and len(step_coordinates) == 0:
+        return tile, None, [], np.zeros(0)
+    ############################################################################
+    # Load and prepare the data of the tile and its halo.
+    activity_points = _load_tile_points(directory, tile)
+    utm_zone = activity_points.utm_zone
+    index = detect_bus_stops.create_activity_point_index(activity_points)
+    ############################################################################
+    # Run the clustering approach and keep the bus stops of the clusters inside
+    # the tile. Like over the whole dataset, only the point with the highest id
+    # of all is not clustered.
+    stops = []
+    if run_clustering:
+        routes = detect_bus_stops.create_routes(geojson_stream.iter_features(routes_file),
+                                                utm_zone)
+        detected = detect_bus_stops.detect_bus_stops_clustering_approach(
+                        activity_points, routes, index=index,
+                        bus_stop_patterns=bus_stop_patterns, visualize=False,
+                        dbscan_standardize=False,
+                        route_index=detect_bus_stops.create_route_index(routes),
+                        clustered_rows=np.where(activity_points.ids != last_id)[0],
+                        **parameters['clustering'])
+        centroids = []
+        for (point, ids) in detected:
+            rows = np.searchsorted(activity_points.ids, ids)
+            centroids.append((activity_points.x[rows].mean(), activity_points.y[rows].mean()))
+        (centroid_longitudes, centroid_latitudes) = projection.to_lonlat(
+                                                        [centroid[0] for centroid in centroids],
+                                                        [centroid[1] for centroid in centroids],
+                                                        utm_zone)
+        (longitudes, latitudes) = projection.to_lonlat([point.x for (point, ids) in detected],
+                                                       [point.y for (point, ids) in detected],
+                                                       utm_zone)
+        for (i, (point, ids)) in enumerate(detected):
+            if tile_of(centroid_longitudes[i], centroid_latitudes[i], tile_size) == tile:
+                stops.append((float(longitudes[i]), float(latitudes[i]),
+                              {'activity_points': ids}, len(ids)))
+    ############################################################################
+    # Score the steps of the traversing approach inside the tile.
+    scores = np.zeros(0)
+    if len(step_coordinates) > 0:
+        (x, y, _) = projection.to_utm(step_coordinates[:,0], step_coordinates[:,1], utm_zone)
+        weights = detect_bus_stops.activity_point_weights(
+                        activity_points,
+                        *detect_bus_stops.activity_combination_scores(bus_stop_combinations))
+        scores = detect_bus_stops.score_steps(np.column_stack((x, y)), index, weights,
+                                              parameters['traversing']['activity_radius'])
+    return tile, utm_zone, stops, scores
+
+################################################################################
+# Returns the steps of the traversing approach along the unique routes of the
+# given files as an array of (longitude, latitude) rows per route. Every route
+# is stepped in the UTM zone of its first vertex.
+def route_steps(filenames, step_length):
+    keys = set()
+    steps = []
+    for filename in filenames:
+        for feature in geojson_stream.iter_features(filename):
+            coordinates = np.asarray(feature.geometry.coordinates, dtype=float).reshape(-1, 2)
+            key = hashlib.sha1(coordinates.tobytes()).digest()
+            if len(coordinates) < 2 or key in keys:
+                continue
+            keys.add(key)
+            (x, y, utm_zone) = projection.to_utm(coordinates[:,0], coordinates[:,1])
+            route = detect_bus_stops.Route(None, utm_zone, None, np.column_stack((x, y)))
+            step_coordinates = route.step_coordinates(step_length)
+            (longitudes, latitudes) = projection.to_lonlat(step_coordinates[:,0],
+                                                           step_coordinates[:,1], utm_zone)
+            steps.append(np.column_stack((longitudes, latitudes)).reshape(-1, 2))
+    return steps
+
+################################################################################
+# Returns the indices of the given (longitude, latitude) rows by tile.
+def _group_by_tile(coordinates, tile_size):
+    tiles = np.floor(coordinates/tile_size).astype(int).reshape(-1, 2)
+    order = np.lexsort((tiles[:,1], tiles[:,0]))
+    tiles = tiles[order]
+    starts = np.concatenate(([0], np.where(np.any(tiles[1:] != tiles[:-1], axis=1))[0]+1))
+    ends = np.append(starts[1:], len(order))
+    return dict(((int(tiles[start,0]), int(tiles[start,1])), order[start:end])
+                for (start, end) in zip(starts, ends) if end > start)
+
+def _find_peaks(task):
+    (sequences, peak_engine, peak_options) = task
+    return peaks.find_peaks(sequences, peak_engine, **(peak_options or {}))
+
+################################################################################
+# Finds the score peaks along all routes on the pool and clusters them to the
+# bus stops of the traversing approach, in the UTM zone of the median step.
+# Returns the bus stops as (longitude, latitude, properties) tuples.
+def _cluster_route_peaks(pool, steps, scores, parameters):
+    if len(steps) == 0:
+        return []
+    lengths = [len(route) for route in steps]
+    sequences = np.split(scores, np.cumsum(lengths)[:-1])
+    tasks = [(sequences[start:start+PEAK_CHUNK_SIZE], parameters.get('peak_engine', 'cwt'),
+              parameters.get('peak_options')) for start in xrange(0, len(sequences),
+                                                                 PEAK_CHUNK_SIZE)]
+    route_peaks = [peak_indices for chunk in pool.map(_find_peaks, tasks)
+                                for peak_indices in chunk]
+    coordinates = np.concatenate(steps)
+    utm_zone = projection.utm_zone(np.median(coordinates[:,0]), np.median(coordinates[:,1]))
+    (x, y, _) = projection.to_utm(coordinates[:,0], coordinates[:,1], utm_zone)
+    stops = detect_bus_stops.cluster_peaks(zip(np.split(np.column_stack((x, y)),
+                                                        np.cumsum(lengths)[:-1]),
+                                               sequences),
+                                           route_peaks, parameters['dbscan_eps'],
+                                           visualize=False)
+    (longitudes, latitudes) = projection.to_lonlat([centroid.x for (centroid, score) in stops],
+                                                   [centroid.y for (centroid, score) in stops],
+                                                   utm_zone)
+    return [(float(longitude), float(latitude), {'score': score})
+            for (longitude, latitude, (centroid, score)) in zip(longitudes, latitudes, stops)]
+
+################################################################################
+# Returns the references of all tiles combined (see _tile_references).
+def _combine_references(references):
+    bus_stop_patterns = []
+    combination_counts = {}
+    for (patterns, combinations, _) in references:
+        bus_stop_patterns.extend(patterns)
+        for (combination, count) in combinations.items():
+            combination_counts[combination] = combination_counts.get(combination, 0)+count
+    return (bus_stop_patterns,
+            OrderedDict(sorted(combination_counts.items(), key=lambda t: t[1], reverse=True)),
+            max([last_id for (_, _, last_id) in references] or [None]))
+
+################################################################################
+# Merges the bus stops (tuples of tile, longitude, latitude, properties and
+# weight) of different tiles that are less than merge_distance apart: of every
+# group, the stop with the highest weight is kept. Returns the kept stops.
+def merge_stops(stops, merge_distance=MERGE_DISTANCE):
+    if len(stops) == 0:
+        return []
+    ############################################################################
+    # Distances on the sphere are approximated by chords between points on a
+    # sphere of EARTH_RADIUS, which works across UTM zones.
+    longitudes = np.radians([stop[1] for stop in stops])
+    latitudes = np.radians([stop[2] for stop in stops])
+    points = EARTH_RADIUS*np.column_stack((np.cos(latitudes)*np.cos(longitudes),
+                                           np.cos(latitudes)*np.sin(longitudes),
+                                           np.sin(latitudes)))
+    pairs = cKDTree(points).query_pairs(merge_distance, output_type='ndarray').reshape(-1, 2)
+    pairs = pairs[[stops[i][0] != stops[j][0] for (i, j) in pairs]].reshape(-1, 2)
+    neighbours = dict((i, []) for i in np.unique(pairs))
+    for (i, j) in pairs:
+        neighbours[i].append(j)
+        neighbours[j].append(i)
+    order = sorted(xrange(len(stops)), key=lambda i: (-stops[i][4], stops[i][0], i))
+    removed = set()
+    kept = []
+    for i in order:
+        if i in removed:
+            continue
+        kept.append(stops[i])
+        removed.update(neighbours.get(i, []))
+    return kept
+
+################################################################################
+# Runs the sharded detection (see the top of this file). Returns a dict with
+# the bus stops of each approach as GeoJSON features and some counts.
+# parameters updates the defaults of the approaches per approach name, e.g.
+# {'clustering': {'dbscan_eps': 200}}; approaches limits the approaches run.
+def detect_sharded(activity_points_files, routes_files, bus_stops_files=None,
+                   parameters=None, approaches=('clustering', 'traversing'),
+                   tile_size=TILE_SIZE, merge_distance=MERGE_DISTANCE, processes=None,
+                   work_dir=None):
+    parameters = approach_parameters(parameters)
+    for approach in parameters.keys():
+        if approach not in approaches:
+            del parameters[approach]
+    halo = halo_width(parameters)
+    directory = tempfile.mkdtemp(prefix='shards_', dir=work_dir)
+    try:
+        start = time.time()
+        gap_fills = ActivityGapFills(activity_points_files)
+        tiles = partition(activity_points_files, directory, 'points', halo, tile_size, gap_fills)
+        if 'clustering' in parameters:
+            partition(routes_files, directory, 'routes', halo, tile_size)
+        if bus_stops_files:
+            partition(bus_stops_files, directory, 'stops', halo, tile_size)
+        ########################################################################
+        # Steps of the traversing approach and the tile each is scored in.
+        steps = []
+        if 'traversing' in parameters:
+            steps = route_steps(routes_files, parameters['traversing']['step_length'])
+        step_coordinates = np.concatenate(steps) if steps else np.zeros((0, 2))
+        tile_steps = _group_by_tile(step_coordinates, tile_size)
+        partition_time = time.time()-start
+        ########################################################################
+        # Collect the references of all tiles, then detect on every tile with
+        # activity points.
+        start = time.time()
+        clustering_stops = []
+        scores = np.zeros(len(step_coordinates))
+        zones = set()
+        pool = multiprocessing.Pool(processes)
+        try:
+            references = _combine_references(pool.map(_tile_references,
+                                                       [(tile, directory, tile_size, parameters,
+                                                         bool(bus_stops_files))
+                                                        for tile in sorted(tiles)]))
+            no_steps = np.zeros(0, dtype=np.intp)
+            tasks = [(tile, directory, tile_size, parameters, references,
+                      step_coordinates[tile_steps.get(tile, no_steps)]) for tile in sorted(tiles)]
+            for (tile, utm_zone, stops, tile_scores) in pool.imap_unordered(_detect_tile, tasks):
+                if utm_zone is not None:
+                    zones.add(utm_zone)
+                for (longitude, latitude, properties, weight) in stops:
+                    properties = dict(properties, tile=list(tile))
+                    clustering_stops.append((tile, longitude, latitude, properties, weight))
+                if len(tile_scores) > 0:
+                    scores[tile_steps[tile]] = tile_scores
+            ####################################################################
+            # The traversing approach finds the peaks along the whole routes.
+            traversing_stops = []
+            if 'traversing' in parameters:
+                traversing_stops = _cluster_route_peaks(pool, steps, scores,
+                                                        parameters['traversing'])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        detection_time = time.time()-start
+    finally:
+        if work_dir is None:
+            shutil.rmtree(directory)
+    ############################################################################
+    # Merge the bus stops of the clustering approach across tile borders.
+    results = OrderedDict([('tiles', len(tiles)),
+                           ('utm_zones', sorted('%d%s' % zone for zone in zones)),
+                           ('halo', halo),
+                           ('partition_time', partition_time),
+                           ('detection_time', detection_time),
+                           ('bus_stops', OrderedDict())])
+    detected = {}
+    if 'clustering' in parameters:
+        detected['clustering'] = [stop[1:4] for stop in merge_stops(clustering_stops,
+                                                                    merge_distance)]
+    if 'traversing' in parameters:
+        detected['traversing'] = traversing_stops
+    for (approach, stops) in sorted(detected.items()):
+        results['bus_stops'][approach] = [{'type': 'Feature', 'properties': properties,
+                                           'geometry': {'type': 'Point',
+                                                        'coordinates': [longitude, latitude]}}
+                                          for (longitude, latitude, properties) in stops]
+    return results
+
+################################################################################
+# Writes GeoJSON features to a feature collection file.
+def write_features(filename, features):
+    temporary_filename = filename+'.'+str(os.getpid())+'.tmp'
+    with open(temporary_filename, 'w') as out:
+        json.dump({'type': 'FeatureCollection',
+                   'crs': {'type': 'name',
+                           'properties': {'name': 'urn:ogc:def:crs:OGC:1.3:CRS84'}},
+                   'features': features}, out)
+    os.rename(temporary_filename, filename)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Detects bus stops tile by tile on a '+
+                                                 'process pool.')
+    parser.add_argument('--activity-points', nargs='+', required=True,
+                        help='GeoJSON or newline-delimited GeoJSON files of activity points')
+    parser.add_argument('--routes', nargs='+', required=True, help='files of routes')
+    parser.add_argument('--bus-stops', nargs='+',
+                        help='files of known bus stops (default: query OSM per tile)')
+    parser.add_argument('--approaches', nargs='+', default=['clustering', 'traversing'],
+                        choices=sorted(detect_bus_stops.APPROACH_PARAMETERS),
+                        help='approaches to run')
+    parser.add_argument('--parameters', type=json.loads, default=None,
+                        help='approach parameters as JSON, e.g. '+
+                             '\'{"clustering": {"dbscan_eps": 200}}\'')
+    parser.add_argument('--tile-size', type=float, default=TILE_SIZE,
+                        help='tile edge length in degrees')
+    parser.add_argument('--merge-distance', type=float, default=MERGE_DISTANCE,
+                        help='distance in meters below which bus stops of neighbouring '+
+                             'tiles are merged')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--work-dir', default=None,
+                        help='keep the tile files in this directory')
+    parser.add_argument('--output-dir', default=detect_bus_stops.DATA_PATH,
+                        help='directory to write detected_bus_stops_<approach>_sharded.geojson to')
+    arguments = parser.parse_args()
+    results = detect_sharded(arguments.activity_points, arguments.routes, arguments.bus_stops,
+                             arguments.parameters, arguments.approaches, arguments.tile_size,
+                             arguments.merge_distance, arguments.processes, arguments.work_dir)
+    for (approach, features) in results['bus_stops'].items():
+        filename = os.path.join(arguments.output_dir,
+                                'detected_bus_stops_'+approach+'_sharded.geojson')
+        write_features(filename, features)
+        print approach+': '+str(len(features))+' bus stops written to '+filename
+    print str(results['tiles'])+' tiles in UTM zones '+', '.join(results['utm_zones'])+ \
+          (', partitioning %.1fs, detection %.1fs' % (results['partition_time'],
+                                                      results['detection_time']))
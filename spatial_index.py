@@ -0,0 +1,175 @@
+import math
+
+import numpy as np
+from shapely.geometry import Point
+
+import instrumentation
+
+# scipy is imported where the KD-trees are built, so that importing this module
+# stays cheap.
+
+# Number of segments per quarter circle shapely uses for Point.buffer().
+BUFFER_RESOLUTION = 16
+
+################################################################################
+# KD-tree over projected point coordinates. Radius queries return the same
+# points as intersecting a shapely buffer of that radius with every point: the
+# buffer is a polygon inscribed in the circle, so only candidates between its
+# apothem and the radius need an exact shapely check.
+class PointIndex:
+
+    def __init__(self, coordinates, items=None):
+        from scipy.spatial import cKDTree
+        self.coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        self.items = items
+        self.tree = cKDTree(self.coordinates)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def query_radius(self, x, y, radius):
+        candidates = np.array(self.tree.query_ball_point((x, y), radius),
+                              dtype=int)
+        neighbours = self._filter_buffer(x, y, radius, np.sort(candidates))
+        instrumentation.count('neighbour_queries')
+        instrumentation.count('neighbours', len(neighbours))
+        return neighbours
+
+    def query_radius_many(self, centers, radius):
+        centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        if len(centers) == 0:
+            return []
+        results = []
+        for (center, candidates) in zip(centers,
+                                        self.tree.query_ball_point(centers, radius)):
+            candidates = np.sort(np.array(candidates, dtype=int))
+            results.append(self._filter_buffer(center[0], center[1], radius,
+                                               candidates))
+        instrumentation.count('neighbour_queries', len(results))
+        instrumentation.count('neighbours', sum(len(result) for result in results)
+                                            if instrumentation.recording() else 0)
+        return results
+
+    def items_in_radius(self, x, y, radius):
+        return [self.items[i] for i in self.query_radius(x, y, radius)]
+
+    ############################################################################
+    # Reverse query: returns the indices of the points whose buffer of the given
+    # radius intersects the point (x, y).
+    def query_buffers_containing(self, x, y, radius):
+        candidates = np.sort(np.array(self.tree.query_ball_point((x, y), radius),
+                                      dtype=int))
+        if len(candidates) == 0:
+            return candidates
+        offsets = self.coordinates[candidates] - (x, y)
+        distances = np.sqrt((offsets**2).sum(axis=1))
+        apothem = radius*math.cos(math.pi/(4*BUFFER_RESOLUTION))*(1-1e-9)
+        uncertain = np.where(distances > apothem)[0]
+        instrumentation.count('intersection_tests', len(uncertain))
+        keep = np.ones(len(candidates), dtype=bool)
+        point = Point(x, y)
+        for i in uncertain:
+            buffered = Point(self.coordinates[candidates[i]]).buffer(radius, BUFFER_RESOLUTION)
+            keep[i] = buffered.intersects(point)
+        return candidates[keep]
+
+    def _filter_buffer(self, x, y, radius, candidates):
+        if len(candidates) == 0:
+            return candidates
+        offsets = self.coordinates[candidates] - (x, y)
+        distances = np.sqrt((offsets**2).sum(axis=1))
+        apothem = radius*math.cos(math.pi/(4*BUFFER_RESOLUTION))*(1-1e-9)
+        uncertain = np.where(distances > apothem)[0]
+        if len(uncertain) == 0:
+            return candidates
+        buffered = Point(x, y).buffer(radius, BUFFER_RESOLUTION)
+        instrumentation.count('intersection_tests', len(uncertain))
+        keep = np.ones(len(candidates), dtype=bool)
+        for i in uncertain:
+            keep[i] = buffered.intersects(Point(self.coordinates[candidates[i]]))
+        return candidates[keep]
+
+################################################################################
+# Index of the segments of a set of lines (e.g. routes) for snapping points to
+# their nearest line. Segments are cut into pieces of at most piece_length and
+# the piece midpoints are kept in a KD-tree: a segment within distance d of a 
+# point has a piece midpoint within d plus half a piece length, so only a few 
+# segments close to each point are measured. Of equally close segments, the
+# first one wins, like with shapely's project on a MultiLineString.
+class SegmentIndex:
+
+    def __init__(self, lines, piece_length=50.0):
+        starts = [np.zeros((0, 2))]
+        ends = [np.zeros((0, 2))]
+        line_indices = [np.zeros(0, dtype=np.intp)]
+        for (i, line) in enumerate(lines):
+            coordinates = np.asarray(line, dtype=float).reshape(-1, 2)
+            starts.append(coordinates[:-1])
+            ends.append(coordinates[1:])
+            line_indices.append(np.full(max(len(coordinates)-1, 0), i, dtype=np.intp))
+        self.starts = np.concatenate(starts)
+        self.ends = np.concatenate(ends)
+        self.line_indices = np.concatenate(line_indices)
+        lengths = np.sqrt(((self.ends-self.starts)**2).sum(axis=1))
+        pieces = np.maximum(1, np.ceil(lengths/piece_length)).astype(np.intp)
+        self.piece_segments = np.repeat(np.arange(len(lengths)), pieces)
+        piece_numbers = np.arange(len(self.piece_segments))-np.repeat(np.cumsum(pieces)-pieces,
+                                                                      pieces)
+        fractions = (piece_numbers+0.5)/pieces[self.piece_segments]
+        midpoints = self.starts[self.piece_segments]+fractions[:,np.newaxis]*\
+                    (self.ends-self.starts)[self.piece_segments]
+        self.half_piece_length = (lengths/pieces).max()/2 if len(lengths) > 0 else 0.0
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(midpoints) if len(midpoints) > 0 else None
+
+    def __len__(self):
+        return len(self.starts)
+
+    ############################################################################
+    # Snaps each point to the nearest point on any line, if that is at most 
+    # max_distance away. Returns the snapped points (NaN if not snapped), the
+    # indices of their lines (-1 if not snapped) and the distances (inf if not
+    # snapped).
+    def snap(self, points, max_distance=np.inf):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        snapped = np.full((len(points), 2), np.nan)
+        line_indices = np.full(len(points), -1, dtype=np.intp)
+        distances = np.full(len(points), np.inf)
+        if len(points) == 0 or self.tree is None:
+            return snapped, line_indices, distances
+        ########################################################################
+        # The segment of the nearest midpoint bounds the search radius.
+        (_, nearest) = self.tree.query(points)
+        bounds = self._project(points, self.piece_segments[nearest])[1]
+        radii = np.minimum(bounds, max_distance)+self.half_piece_length*(1+1e-9)+1e-9
+        candidates = [np.unique(self.piece_segments[self.tree.query_ball_point(point, radius)])
+                        for (point, radius) in zip(points, radii)]
+        point_ids = np.repeat(np.arange(len(points)), [len(c) for c in candidates])
+        segments = np.concatenate(candidates).astype(np.intp)
+        if len(segments) == 0:
+            return snapped, line_indices, distances
+        (projected, candidate_distances) = self._project(points[point_ids], segments)
+        ########################################################################
+        # Pick the closest candidate of each point, the first segment on ties.
+        order = np.lexsort((segments, candidate_distances, point_ids))
+        first = order[np.r_[True, point_ids[order][1:] != point_ids[order][:-1]]]
+        first = first[candidate_distances[first] <= max_distance]
+        snapped[point_ids[first]] = projected[first]
+        line_indices[point_ids[first]] = self.line_indices[segments[first]]
+        distances[point_ids[first]] = candidate_distances[first]
+        return snapped, line_indices, distances
+
+    ############################################################################
+    # Returns the closest points on the given segments and their distances.
+    def _project(self, points, segments):
+        starts = self.starts[segments]
+        ends = self.ends[segments]
+        directions = ends-starts
+        squared_lengths = (directions**2).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factors = ((points-starts)*directions).sum(axis=1)/squared_lengths
+        factors = np.clip(np.where(squared_lengths > 0, factors, 0.0), 0.0, 1.0)
+        projected = np.where((factors >= 1)[:,np.newaxis], ends,
+                             starts+factors[:,np.newaxis]*directions)
+        distances = np.sqrt(((points-projected)**2).sum(axis=1))
+        return projected, distances
@@ -1,8 +1,193 @@
+import argparse
+import email.utils
+import hashlib
+import os
+import threading
+import urlparse
 import SimpleHTTPServer
 import SocketServer
+from cStringIO import StringIO
+
+import precompression
+import tile_index
 
 PORT = 8000
-handler = SimpleHTTPServer.SimpleHTTPRequestHandler
-httpd = SocketServer.TCPServer(("", PORT), handler)
-print "serving at port", PORT
-httpd.serve_forever()
\ No newline at end of file
+# Files with these extensions (the data layers) are served compressed to
+# clients that accept it; all other files are served as they are.
+COMPRESSED_EXTENSIONS = ('.geojson', '.json')
+# gzip level for layers without an up to date precompressed copy.
+COMPRESSION_LEVEL = 6
+# Tile endpoint: /tiles/<layer>.geojson?bbox=<min lon>,<min lat>,<max lon>,
+# <max lat>&zoom=<zoom> returns the features of data/<layer>.geojson inside the
+# bounding box, simplified for the zoom level (see tile_index.py).
+TILE_PATH = '/tiles/'
+DATA_DIRECTORY = 'data'
+
+################################################################################
+# Serves the files below the working directory like SimpleHTTPRequestHandler,
+# plus:
+# - data layers are sent brotli or gzip compressed if the client accepts it,
+#   from the copies written by precompression.precompress or else compressed
+#   once in memory,
+# - every file has an ETag and a Last-Modified date, and conditional requests
+#   for unchanged files are answered with 304 Not Modified,
+# - the features of a layer inside a bounding box are served by the tile
+#   endpoint (see TILE_PATH).
+class ResultRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    # In-memory compressed layers by (path, encoding), with the size and mtime
+    # of the file they were compressed from.
+    compressed_layers = {}
+    compressed_layers_lock = threading.Lock()
+    # Loaded tile indices by layer file.
+    tile_indices = {}
+    tile_indices_lock = threading.Lock()
+
+    def send_head(self):
+        if self.path.startswith(TILE_PATH):
+            return self.send_tile()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split('?', 1)[0].endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if not os.path.isfile(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        stat = os.stat(path)
+        encoding = self.content_encoding(path)
+        etag = '"%x-%x%s"' % (int(stat.st_mtime*1000), stat.st_size,
+                              '' if encoding is None else '-'+encoding)
+        if self.not_modified(etag, stat.st_mtime):
+            self.send_response(304)
+            self.send_validators(path, etag, stat.st_mtime, encoding)
+            self.end_headers()
+            return None
+        if encoding is None:
+            (body, length) = (open(path, 'rb'), stat.st_size)
+        else:
+            (body, length) = self.compressed_body(path, encoding, stat)
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(length))
+        self.send_validators(path, etag, stat.st_mtime, encoding)
+        self.end_headers()
+        return body
+
+    ############################################################################
+    # Answers a tile request. Tiles are compressed on the fly; their ETag 
+    # depends on the layer's index and the query, so revisited tiles are served
+    # from the browser cache.
+    def send_tile(self):
+        url = urlparse.urlparse(self.path)
+        name = url.path[len(TILE_PATH):]
+        filename = os.path.join(DATA_DIRECTORY, name)
+        parameters = urlparse.parse_qs(url.query)
+        try:
+            if os.path.basename(name) != name or not name.endswith('.geojson') or \
+                    not os.path.isfile(filename):
+                raise KeyError(name)
+            bbox = [float(value) for value in parameters['bbox'][0].split(',')]
+            zoom = float(parameters['zoom'][0]) if 'zoom' in parameters else None
+            if len(bbox) != 4:
+                raise ValueError('A bbox has four values!')
+        except KeyError:
+            self.send_error(404, 'Layer not found or bbox missing')
+            return None
+        except ValueError:
+            self.send_error(400, 'Invalid bbox or zoom')
+            return None
+        index = self.load_tile_index(filename)
+        encoding = self.content_encoding(filename)
+        etag = '"%s%s"' % (hashlib.sha1('%r %r %r %r' % (name, index.mtime, bbox, zoom)).hexdigest(),
+                           '' if encoding is None else '-'+encoding)
+        if self.not_modified(etag, index.mtime):
+            self.send_response(304)
+            self.send_validators(filename, etag, index.mtime, encoding)
+            self.end_headers()
+            return None
+        data = index.feature_collection(bbox, zoom)
+        if encoding is not None:
+            data = precompression.compress(data, encoding, COMPRESSION_LEVEL)
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(filename))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_validators(filename, etag, index.mtime, encoding)
+        self.end_headers()
+        return StringIO(data)
+
+    ############################################################################
+    # Returns the tile index of a layer, building it if the detector did not.
+    def load_tile_index(self, filename):
+        with self.tile_indices_lock:
+            index = self.tile_indices.get(filename)
+            if index is None or not tile_index.is_fresh(filename) or \
+                    index.mtime != os.path.getmtime(tile_index.index_files(filename)[0]):
+                index = tile_index.load(filename)
+                self.tile_indices[filename] = index
+        return index
+
+    ############################################################################
+    # Returns the content encoding to send path with (None for no encoding).
+    def content_encoding(self, path):
+        if not path.endswith(COMPRESSED_EXTENSIONS):
+            return None
+        accepted = [value.split(';')[0].strip().lower()
+                        for value in self.headers.get('Accept-Encoding', '').split(',')]
+        for encoding in precompression.available_encodings():
+            if encoding in accepted:
+                return encoding
+        return None
+
+    ############################################################################
+    # Returns a file object with the compressed content of path and its length.
+    def compressed_body(self, path, encoding, stat):
+        if precompression.is_fresh(path, encoding):
+            filename = precompression.compressed_file(path, encoding)
+            return open(filename, 'rb'), os.path.getsize(filename)
+        key = (path, encoding)
+        with self.compressed_layers_lock:
+            cached = self.compressed_layers.get(key)
+        if cached is None or cached[0] != (stat.st_size, stat.st_mtime):
+            with open(path, 'rb') as original:
+                data = precompression.compress(original.read(), encoding, COMPRESSION_LEVEL)
+            cached = ((stat.st_size, stat.st_mtime), data)
+            with self.compressed_layers_lock:
+                self.compressed_layers[key] = cached
+        return StringIO(cached[1]), len(cached[1])
+
+    ############################################################################
+    # Returns whether the client's cached copy is still valid. If-None-Match
+    # takes precedence over If-Modified-Since.
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or \
+                   etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def send_validators(self, path, etag, mtime, encoding):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        # Browsers have to revalidate, so new results show up right away.
+        self.send_header('Cache-Control', 'no-cache')
+        if path.endswith(COMPRESSED_EXTENSIONS):
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+
+################################################################################
+# Serves every request in its own thread, so slow clients do not block others.
+class ResultServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves the map and the detection results.')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    arguments = parser.parse_args()
+    httpd = ResultServer(("", arguments.port), ResultRequestHandler)
+    print "serving at port", arguments.port
+    httpd.serve_forever()
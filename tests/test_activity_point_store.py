@@ -0,0 +1,55 @@
+import unittest
+
+import geojson_stream
+from detect_bus_stops import ActivityPointStore
+
+def feature(id, **properties):
+    defaults = {'id': id,
+                'timestamp': '2015-11-11T09:03:01+0300',
+                'created_at': '2015-11-11 06:03:12',
+                'previous_dominating_activity': 'still',
+                'previous_dominating_activity_confidence': 80,
+                'current_dominating_activity': 'in_vehicle',
+                'current_dominating_activity_confidence': 75,
+                'bearing': 90, 'altitude': 12.5, 'speed': 3,
+                'accuracy': 20.0, 'feature': 'passive_tracking'}
+    defaults.update(properties)
+    return geojson_stream.Feature({'type': 'Feature', 'properties': defaults,
+                                   'geometry': {'type': 'Point',
+                                                'coordinates': [39.28, -6.82]}})
+
+################################################################################
+# The ActivityPoint views return the properties as they were loaded.
+class TestActivityPointStore(unittest.TestCase):
+
+    def assert_properties(self, features, store):
+        for loaded in features:
+            point = store[loaded.properties['id']]
+            for (name, value) in loaded.properties.items():
+                self.assertEqual(getattr(point, name), value, name)
+                if isinstance(value, (int, float)):
+                    self.assertEqual(type(getattr(point, name)), type(value), name)
+
+    def test_missing_texts_are_none(self):
+        features = [feature(1, timestamp=None), feature(2, created_at=None, feature=None),
+                    feature(3, timestamp=u'2015-11-11T09:03:01+0300 \u00e4')]
+        store = ActivityPointStore.from_features(features)
+        self.assert_properties(features, store)
+        self.assert_properties(features, store.take(slice(None)))
+
+    def test_integer_properties_stay_integers(self):
+        features = [feature(1), feature(2, speed=None, bearing=None),
+                    feature(3, previous_dominating_activity_confidence=None)]
+        store = ActivityPointStore.from_feature_chunks([features[:1], features[1:]])
+        self.assert_properties(features, store)
+        self.assert_properties(features, store.copy())
+
+    def test_float_values_make_a_column_float(self):
+        features = [feature(1, speed=3), feature(2, speed=2.5)]
+        store = ActivityPointStore.from_features(features)
+        self.assertEqual(store[1].speed, 3.0)
+        self.assertEqual(type(store[1].speed), float)
+        self.assertEqual(store[2].speed, 2.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import dataset_cache
+
+################################################################################
+# Remembered content hashes are not used for files rewritten with the same size
+# and modification time.
+class TestContentHash(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'points.geojson')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rewrite(self, content, mtime):
+        with open(self.filename, 'wb') as out:
+            out.write(content)
+        os.utime(self.filename, (mtime, mtime))
+
+    def assert_fresh_hash(self, content):
+        self.assertEqual(dataset_cache.content_hash(self.filename, self.directory),
+                         hashlib.sha1(content).hexdigest())
+
+    def test_rewrite_within_the_same_mtime(self):
+        middle = 'x'*(3*dataset_cache.SAMPLE_SIZE)
+        for content in ('{"a": 1}', '{"b": 2}',
+                        '{'+middle+'}1', '{'+middle+'}2', '1{'+middle+'}', '2{'+middle+'}'):
+            self.rewrite(content, 1000000000)
+            self.assert_fresh_hash(content)
+            self.assert_fresh_hash(content)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import warnings
+
+from shapely.geometry import Point
+
+import detect_bus_stops
+import evaluation
+
+class TestGroundTruth(unittest.TestCase):
+
+    def setUp(self):
+        self.ground_truth = evaluation.GroundTruth([(0, 0), (100, 0), (0, 1000)])
+
+    def test_distances_and_matches(self):
+        detected = [(3, 4), (100, 30), (101, 0), (0, 600)]
+        self.assertEqual(self.ground_truth.nearest_distances(detected).tolist(),
+                         [5.0, 30.0, 1.0, 400.0])
+        # (101, 0) is matched to (100, 0) before the farther (100, 30).
+        self.assertEqual(self.ground_truth.match_counts(detected, [10, 50]), [2, 2])
+        metrics = self.ground_truth.evaluate(detected, [10])
+        self.assertEqual(metrics['mean_distance'], 109.0)
+        self.assertEqual(metrics['median_distance'], 17.5)
+        self.assertEqual(metrics['matches'][0]['precision'], 0.5)
+        self.assertAlmostEqual(metrics['matches'][0]['recall'], 2/3.0)
+
+    def test_no_detected_stops(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual(len(self.ground_truth.nearest_distances([])), 0)
+            self.assertIsNone(self.ground_truth.mean_distance([]))
+            metrics = self.ground_truth.evaluate([], [50])
+            self.assertIsNone(detect_bus_stops.avg_distance_to_ground_truth(
+                                    [], [Point(0, 0), Point(100, 0)]))
+        self.assertEqual(metrics['detected'], 0)
+        self.assertIsNone(metrics['mean_distance'])
+        self.assertIsNone(metrics['median_distance'])
+        self.assertEqual(metrics['matches'][0]['matched'], 0)
+        self.assertEqual(metrics['matches'][0]['f1'], 0.0)
+
+    def test_no_ground_truth(self):
+        ground_truth = evaluation.GroundTruth([])
+        self.assertEqual(ground_truth.nearest_distances([(0, 0)]).tolist(), [float('inf')])
+        self.assertIsNone(ground_truth.mean_distance([(0, 0)]))
+        self.assertEqual(ground_truth.match_counts([(0, 0)], [50]), [0])
+
+    def test_avg_distance_to_ground_truth(self):
+        self.assertEqual(detect_bus_stops.avg_distance_to_ground_truth(
+                                [Point(3, 4), Point(100, 10)], [Point(0, 0), Point(100, 0)]),
+                         7.5)
+
+if __name__ == '__main__':
+    unittest.main()
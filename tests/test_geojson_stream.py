@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from StringIO import StringIO
+
+import geojson_stream
+
+################################################################################
+# A stream that counts the bytes read from it.
+class CountingStream(StringIO):
+
+    def __init__(self, text):
+        StringIO.__init__(self, text)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = StringIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = StringIO.readline(self, size)
+        self.bytes_read += len(data)
+        return data
+
+def point_features(count):
+    return [OrderedDict([('type', 'Feature'),
+                         ('properties', {'id': i}),
+                         ('geometry', {'type': 'Point', 'coordinates': [39.2+i*1e-5, -6.8]})])
+            for i in xrange(count)]
+
+class TestGeoJSONStream(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as out:
+            out.write(text)
+        return filename
+
+    def test_minified_feature_collection_is_not_read_to_detect_format(self):
+        features = point_features(5000)
+        for collection in (OrderedDict([('type', 'FeatureCollection'), ('features', features)]),
+                           OrderedDict([('features', features), ('type', 'FeatureCollection')])):
+            text = json.dumps(collection, separators=(',', ':'))
+            self.assertNotIn('\n', text)
+            stream = CountingStream(text)
+            self.assertFalse(geojson_stream._is_newline_delimited(stream))
+            self.assertLessEqual(stream.bytes_read, geojson_stream.PEEK_SIZE)
+            self.assertEqual(stream.tell(), 0)
+
+    def test_minified_feature_collection(self):
+        features = point_features(3000)
+        filename = self.write('points.geojson',
+                              json.dumps({'type': 'FeatureCollection', 'features': features},
+                                         separators=(',', ':')))
+        read = list(geojson_stream.iter_features(filename, block_size=1000))
+        self.assertEqual([feature.properties['id'] for feature in read], range(3000))
+        self.assertEqual(read[-1].geometry.coordinates, features[-1]['geometry']['coordinates'])
+
+    def test_newline_delimited(self):
+        features = point_features(10)
+        filename = self.write('points.ndjson', '\n'.join(json.dumps(feature)
+                                                         for feature in features)+'\n')
+        with open(filename, 'rb') as stream:
+            self.assertTrue(geojson_stream._is_newline_delimited(stream))
+        chunks = list(geojson_stream.iter_feature_chunks(filename, chunk_size=4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+        self.assertEqual([feature.properties['id'] for chunk in chunks for feature in chunk],
+                         range(10))
+
+    def test_newline_delimited_with_type_last(self):
+        features = [OrderedDict(reversed(feature.items())) for feature in point_features(3)]
+        filename = self.write('points.ndjson', '\n'.join(json.dumps(feature)
+                                                         for feature in features))
+        self.assertEqual([feature.properties['id']
+                          for feature in geojson_stream.iter_features(filename)], range(3))
+
+    def test_pretty_printed_feature_collection(self):
+        filename = self.write('points.geojson',
+                              json.dumps({'type': 'FeatureCollection',
+                                          'features': point_features(3)}, indent=2))
+        self.assertEqual(len(list(geojson_stream.iter_features(filename))), 3)
+
+    def test_empty_file(self):
+        filename = self.write('empty.geojson', '')
+        self.assertRaises(geojson_stream.StreamError, list,
+                          geojson_stream.iter_features(filename))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import benchmark
+import detect_bus_stops
+import geojson_stream
+from detect_bus_stops import ActivityPointStore
+from incremental import IncrementalClusteringDetector
+
+PATTERN_RADIUS = 150
+DBSCAN_EPS = 60
+DBSCAN_MIN_POINTS = 3
+
+def stop_keys(bus_stops):
+    return sorted((tuple(sorted(ids)), round(point.x, 6), round(point.y, 6))
+                  for (point, ids) in bus_stops)
+
+################################################################################
+# Feeds a synthetic city in shuffled batches and compares the bus stops with the
+# clustering approach run on all points seen so far. Only two of the planted bus
+# stops are known, so a few activity points change the bus stop patterns a lot
+# and flip the decision of clusters far away from these bus stops.
+class TestIncrementalClusteringDetector(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.planted_stops = benchmark.generate_city(cls.directory, 3000, 8, seed=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def detect(self, seed):
+        activity_points = ActivityPointStore.from_feature_chunks(
+                            [geojson_stream.iter_features(os.path.join(self.directory,
+                                                                       'activity_points.geojson'))])
+        routes = detect_bus_stops.create_routes(
+                    geojson_stream.iter_features(os.path.join(self.directory, 'routes.geojson')),
+                    activity_points.utm_zone)
+        random = np.random.RandomState(seed)
+        known_stops = [self.planted_stops[i]
+                       for i in random.choice(len(self.planted_stops), 2, replace=False)]
+        osm_bus_stops = detect_bus_stops.create_bus_stops(known_stops, activity_points.utm_zone)
+        detector = IncrementalClusteringDetector(routes, osm_bus_stops, PATTERN_RADIUS,
+                                                 DBSCAN_EPS, DBSCAN_MIN_POINTS)
+        order = random.permutation(len(activity_points))
+        start = 0
+        while start < len(order):
+            end = start+random.randint(1, 300)
+            detector.ingest(activity_points.take(np.sort(order[start:end])))
+            start = end
+            if start >= len(order) or random.rand() < 0.2:
+                seen = activity_points.take(np.sort(order[:start]))
+                expected = detect_bus_stops.detect_bus_stops_clustering_approach(
+                                seen, routes, PATTERN_RADIUS, DBSCAN_EPS, DBSCAN_MIN_POINTS,
+                                osm_bus_stops=osm_bus_stops, visualize=False,
+                                dbscan_standardize=False)
+                self.assertEqual(stop_keys(detector.bus_stops()), stop_keys(expected))
+
+    def test_shuffled_batches_equal_full_detection(self):
+        for seed in (0, 1, 2):
+            self.detect(seed)
+
+if __name__ == '__main__':
+    unittest.main()
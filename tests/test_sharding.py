@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import detect_bus_stops
+import geojson_stream
+import projection
+import sharding
+from detect_bus_stops import ActivityPointStore
+
+ACTIVITY_POINTS_FILE = os.path.join(os.path.dirname(detect_bus_stops.__file__),
+                                    'data', 'activity_points.geojson')
+ROUTES_FILE = os.path.join(os.path.dirname(detect_bus_stops.__file__),
+                           'data', 'routes.geojson')
+
+def stop_keys(features):
+    return sorted((round(feature['geometry']['coordinates'][0], 6),
+                   round(feature['geometry']['coordinates'][1], 6)) for feature in features)
+
+def write_points(filename, features):
+    with open(filename, 'w') as out:
+        json.dump({'type': 'FeatureCollection',
+                   'features': [{'type': 'Feature', 'properties': feature.properties,
+                                 'geometry': {'type': 'Point',
+                                              'coordinates': feature.geometry.coordinates}}
+                                for feature in features]}, out)
+
+################################################################################
+# Compares the sharded detection on the sample data with both approaches run on
+# the whole sample data at once. Every ninth activity point stands in for a
+# known bus stop. The activities of the sample data are not consistent with the
+# ids; a copy is made consistent, and another copy of that gets a single
+# inconsistent pair of points.
+class TestShardedDetection(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        features = list(geojson_stream.iter_features(ACTIVITY_POINTS_FILE))
+        cls.stops_file = os.path.join(cls.directory, 'stops.geojson')
+        write_points(cls.stops_file, features[::9])
+        cls.points_files = {'sample': ACTIVITY_POINTS_FILE}
+        cls.unsharded = {'sample': cls.detect_unsharded(features)}
+        ########################################################################
+        # The previous activity of every point is set to the current activity
+        # of the point with the preceding id where both are known.
+        by_id = dict((feature.properties['id'], feature) for feature in features)
+        pairs = [(by_id[id], by_id[id+1]) for id in sorted(by_id) if id+1 in by_id]
+        for (feature, following) in pairs:
+            current = feature.properties['current_dominating_activity']
+            if current is not None and \
+                    following.properties['previous_dominating_activity'] is not None:
+                following.properties['previous_dominating_activity'] = current
+        cls.add_points('consistent', features)
+        (feature, following) = [(feature, following) for (feature, following) in pairs
+                                if following.properties['previous_dominating_activity']
+                                    is not None and
+                                   sharding.tile_of(*feature.geometry.coordinates[:2],
+                                                    tile_size=0.05) ==
+                                   sharding.tile_of(*following.geometry.coordinates[:2],
+                                                    tile_size=0.05)][0]
+        following.properties['previous_dominating_activity'] = \
+                'on_bicycle' if feature.properties['current_dominating_activity'] != \
+                                    'on_bicycle' else 'still'
+        cls.add_points('inconsistent', features)
+
+    @classmethod
+    def add_points(cls, name, features):
+        cls.points_files[name] = os.path.join(cls.directory, name+'.geojson')
+        write_points(cls.points_files[name], features)
+        cls.unsharded[name] = cls.detect_unsharded(
+                                list(geojson_stream.iter_features(cls.points_files[name])))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def detect_unsharded(cls, features):
+        activity_points = ActivityPointStore.from_feature_chunks([features])
+        if activity_points.is_consistent():
+            activity_points.fill_activity_gaps()
+        utm_zone = activity_points.utm_zone
+        routes = detect_bus_stops.create_routes(geojson_stream.iter_features(ROUTES_FILE),
+                                                utm_zone)
+        osm_bus_stops = detect_bus_stops.create_bus_stops(
+                            [feature.geometry.coordinates
+                             for feature in geojson_stream.iter_features(cls.stops_file)],
+                            utm_zone)
+        index = detect_bus_stops.create_activity_point_index(activity_points)
+        parameters = sharding.approach_parameters()
+        results = {}
+        clustering_stops = detect_bus_stops.detect_bus_stops_clustering_approach(
+                                activity_points, routes, index=index, osm_bus_stops=osm_bus_stops,
+                                visualize=False, dbscan_standardize=False,
+                                **parameters['clustering'])
+        traversing_stops = detect_bus_stops.detect_bus_stops_traversing_approach(
+                                activity_points, routes, index=index, osm_bus_stops=osm_bus_stops,
+                                visualize=False, **parameters['traversing'])
+        for (approach, points) in (('clustering', [point for (point, ids) in clustering_stops]),
+                                   ('traversing', [point for (point, score) in traversing_stops])):
+            (longitudes, latitudes) = projection.to_lonlat([point.x for point in points],
+                                                           [point.y for point in points],
+                                                           utm_zone)
+            results[approach] = stop_keys([{'geometry': {'coordinates': coordinates}}
+                                           for coordinates in zip(longitudes, latitudes)])
+        results['clustering_ids'] = sorted(ids for (point, ids) in clustering_stops)
+        return results
+
+    def assert_matches_unsharded_detection(self, name, tile_sizes):
+        unsharded = self.unsharded[name]
+        self.assertGreater(len(unsharded['clustering']), 0)
+        self.assertGreater(len(unsharded['traversing']), 0)
+        for tile_size in tile_sizes:
+            results = sharding.detect_sharded([self.points_files[name]], [ROUTES_FILE],
+                                              [self.stops_file], tile_size=tile_size,
+                                              processes=1)
+            bus_stops = results['bus_stops']
+            self.assertEqual(stop_keys(bus_stops['clustering']), unsharded['clustering'],
+                             (name, tile_size))
+            self.assertEqual(sorted(feature['properties']['activity_points']
+                                    for feature in bus_stops['clustering']),
+                             unsharded['clustering_ids'], (name, tile_size))
+            self.assertEqual(stop_keys(bus_stops['traversing']), unsharded['traversing'],
+                             (name, tile_size))
+        self.assertGreater(results['tiles'], 1)
+
+    def test_sharded_detection_matches_unsharded_detection(self):
+        self.assert_matches_unsharded_detection('sample', (5.0, 0.25, 0.1, 0.05))
+
+    def test_activities_are_filled_over_the_whole_dataset(self):
+        self.assert_matches_unsharded_detection('consistent', (0.25, 0.05))
+
+    def test_one_inconsistent_pair_prevents_filling_in_all_tiles(self):
+        self.assert_matches_unsharded_detection('inconsistent', (0.25, 0.05))
+
+    def test_halo_covers_snapping_distance(self):
+        self.assertGreaterEqual(sharding.halo_width(sharding.approach_parameters()),
+                                detect_bus_stops.MAX_PROJECTION_DISTANCE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import json
+import os
+
+import numpy as np
+from shapely.geometry import mapping, shape
+
+################################################################################
+# Spatial index of a GeoJSON layer for serving the features inside a bounding
+# box (see the tile endpoint of start_webserver.py). It consists of two files
+# next to the layer:
+# - <layer>.features: the serialized features, once per simplification level,
+# - <layer>.index.npz: the feature bounds and the offsets of the features in
+#   the .features file.
+# Features are ordered along a Z-order curve of their centers and grouped into
+# pages of PAGE_SIZE features, so a query tests the page bounds first and only
+# the features of the pages it hits (a one-level packed R-tree).
+# Layers with lines or polygons are also stored simplified for the zoom levels
+# in SIMPLIFIED_ZOOMS, with a tolerance of one pixel at that zoom; points are
+# stored once.
+
+PAGE_SIZE = 256
+SIMPLIFIED_ZOOMS = [6, 8, 10, 12, 14, 16]
+
+################################################################################
+# Returns the index files of a layer.
+def index_files(filename):
+    return filename+'.index.npz', filename+'.features'
+
+################################################################################
+# Returns whether the index of a layer exists and is up to date.
+def is_fresh(filename):
+    (index_file, features_file) = index_files(filename)
+    return all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(filename)
+               for f in (index_file, features_file))
+
+################################################################################
+# Returns the simplification tolerance (in degrees) for a zoom level: the size
+# of a pixel of a 256 pixel web mercator tile at the equator.
+def tolerance(zoom):
+    return 360.0/(256*2**zoom)
+
+################################################################################
+# Builds the index of a GeoJSON layer with longitude/latitude coordinates.
+def build(filename):
+    with open(filename) as layer:
+        features = json.load(layer)['features']
+    geometries = [shape(feature['geometry']) if feature.get('geometry') else None
+                  for feature in features]
+    bounds = np.array([geometry.bounds if geometry is not None and not geometry.is_empty
+                          else (np.nan,)*4 for geometry in geometries],
+                      dtype=float).reshape(-1, 4)
+    ############################################################################
+    # Order features along the Z-order curve; features without a geometry are
+    # never returned.
+    located = np.where(~np.isnan(bounds[:,0]))[0]
+    order = located[np.argsort(_morton_codes(bounds[located]), kind='mergesort')]
+    bounds = bounds[order]
+    page_starts = np.arange(0, len(order), PAGE_SIZE)
+    if len(order) > 0:
+        page_bounds = np.column_stack((np.minimum.reduceat(bounds[:,0], page_starts),
+                                       np.minimum.reduceat(bounds[:,1], page_starts),
+                                       np.maximum.reduceat(bounds[:,2], page_starts),
+                                       np.maximum.reduceat(bounds[:,3], page_starts)))
+    else:
+        page_bounds = np.zeros((0, 4))
+    ############################################################################
+    # Serialize every feature per level. Level 0 holds the original features.
+    simplify = any(geometries[i].geom_type not in ('Point', 'MultiPoint') for i in order)
+    zooms = SIMPLIFIED_ZOOMS if simplify else []
+    (index_file, features_file) = index_files(filename)
+    temporary_suffix = '.'+str(os.getpid())+'.tmp'
+    offsets = np.zeros((len(zooms)+1, len(order)+1), dtype=np.int64)
+    position = 0
+    with open(features_file+temporary_suffix, 'wb') as out:
+        for level in xrange(len(zooms)+1):
+            for (k, i) in enumerate(order):
+                feature = dict(features[i])
+                if feature.get('id') is None:
+                    feature['id'] = int(i)
+                if level > 0:
+                    feature['geometry'] = mapping(geometries[i].simplify(tolerance(zooms[level-1]),
+                                                                         preserve_topology=False))
+                text = json.dumps(feature, separators=(',', ':'))
+                out.write(text)
+                offsets[level,k] = position
+                position += len(text)
+            offsets[level,len(order)] = position
+    np.savez(index_file+temporary_suffix+'.npz', bounds=bounds, page_bounds=page_bounds,
+             offsets=offsets, zooms=np.array(zooms, dtype=np.int64))
+    os.rename(features_file+temporary_suffix, features_file)
+    os.rename(index_file+temporary_suffix+'.npz', index_file)
+
+################################################################################
+# Returns the Z-order curve positions of the centers of the given bounds.
+def _morton_codes(bounds):
+    if len(bounds) == 0:
+        return np.zeros(0, dtype=np.int64)
+    centers = np.column_stack(((bounds[:,0]+bounds[:,2])/2, (bounds[:,1]+bounds[:,3])/2))
+    low = centers.min(axis=0)
+    span = np.maximum(centers.max(axis=0)-low, 1e-12)
+    cells = np.minimum(((centers-low)/span*65536).astype(np.int64), 65535)
+    codes = np.zeros(len(cells), dtype=np.int64)
+    for bit in xrange(16):
+        codes |= ((cells[:,0] >> bit) & 1) << (2*bit)
+        codes |= ((cells[:,1] >> bit) & 1) << (2*bit+1)
+    return codes
+
+################################################################################
+# Index of a layer loaded for queries. The features file is memory-mapped, so
+# only the features that are returned are read.
+class TileIndex:
+
+    def __init__(self, filename):
+        (index_file, features_file) = index_files(filename)
+        saved = np.load(index_file)
+        try:
+            self.bounds = saved['bounds']
+            self.page_bounds = saved['page_bounds']
+            self.offsets = saved['offsets']
+            self.zooms = saved['zooms'].tolist()
+        finally:
+            saved.close()
+        self.mtime = os.path.getmtime(index_file)
+        if self.offsets[0,-1] > 0:
+            self.features = np.memmap(features_file, dtype=np.uint8, mode='r')
+        else:
+            self.features = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    ############################################################################
+    # Returns the positions (in index order) of the features whose bounds
+    # intersect bbox (min_lon, min_lat, max_lon, max_lat).
+    def query(self, bbox):
+        (min_x, min_y, max_x, max_y) = bbox
+        pages = np.where((self.page_bounds[:,0] <= max_x) & (self.page_bounds[:,2] >= min_x) &
+                         (self.page_bounds[:,1] <= max_y) & (self.page_bounds[:,3] >= min_y))[0]
+        if len(pages) == 0:
+            return np.zeros(0, dtype=np.intp)
+        candidates = np.concatenate([np.arange(page*PAGE_SIZE,
+                                               min((page+1)*PAGE_SIZE, len(self.bounds)))
+                                     for page in pages])
+        bounds = self.bounds[candidates]
+        return candidates[(bounds[:,0] <= max_x) & (bounds[:,2] >= min_x) &
+                          (bounds[:,1] <= max_y) & (bounds[:,3] >= min_y)]
+
+    ############################################################################
+    # Returns the level to serve a zoom level with: the coarsest level that is
+    # still exact to a pixel, the original features above SIMPLIFIED_ZOOMS.
+    def level(self, zoom):
+        if zoom is None:
+            return 0
+        for (level, level_zoom) in enumerate(self.zooms):
+            if level_zoom >= zoom:
+                return level+1
+        return 0
+
+    ############################################################################
+    # Returns a GeoJSON feature collection (as a string) of the features inside
+    # bbox, simplified for the given zoom level (None for the original ones).
+    def feature_collection(self, bbox, zoom=None):
+        offsets = self.offsets[self.level(zoom)]
+        parts = [self.features[offsets[i]:offsets[i+1]].tostring() for i in self.query(bbox)]
+        return '{"type":"FeatureCollection","features":['+','.join(parts)+']}'
+
+################################################################################
+# Returns the TileIndex of a layer, (re)building the index if it is not up to
+# date.
+def load(filename):
+    if not is_fresh(filename):
+        build(filename)
+    return TileIndex(filename)